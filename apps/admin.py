@@ -14,6 +14,9 @@ class ProductModelAdmin(ModelAdmin):
     list_display = 'name', 'get_in_stock', 'category', 'id'
     inlines = [ProductImageStackInline]
 
+    def get_queryset(self, request):
+        return super().get_queryset(request).for_listing()
+
     @action(description='Sotuvda bormi?')
     def get_in_stock(self, obj):
         return obj.in_stock
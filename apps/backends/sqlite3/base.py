@@ -0,0 +1,29 @@
+from django.conf import settings
+from django.db.backends.sqlite3 import base
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    """SQLite with the ``SQLITE_PRAGMAS`` settings run on every new connection.
+
+    ``OPTIONS['transaction_mode']`` (the option Django 5.1 adds) sets how
+    ``atomic()`` blocks begin. With ``IMMEDIATE`` a transaction takes the
+    write lock up front, so checkout, which reads the cart before writing,
+    waits for the busy timeout instead of failing with "database is locked"
+    when another writer commits first.
+    """
+
+    transaction_mode = None
+
+    def get_connection_params(self):
+        params = super().get_connection_params()
+        self.transaction_mode = params.pop('transaction_mode', None)
+        return params
+
+    def get_new_connection(self, conn_params):
+        conn = super().get_new_connection(conn_params)
+        for name, value in settings.SQLITE_PRAGMAS.items():
+            conn.execute(f'PRAGMA {name} = {value}')
+        return conn
+
+    def _start_transaction_under_autocommit(self):
+        self.cursor().execute(f'BEGIN {self.transaction_mode}' if self.transaction_mode else 'BEGIN')
@@ -0,0 +1,197 @@
+import json
+import random
+import statistics
+import time
+from itertools import islice
+
+from django.contrib.auth.hashers import make_password
+from django.db import connection, reset_queries, transaction
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from apps.catalog import CatalogImporter
+from apps.instrumentation import percentile
+from apps.models import Address, CartItem, Category, Order, OrderItem, Product, ProductImage, User
+from apps.views import ProductListView
+
+BENCHMARK_USER_PREFIX = 'bench-'
+DEPARTMENTS = ['Electronics', 'Computers', 'Home', 'Sports', 'Toys', 'Books', 'Garden', 'Beauty']
+SECTIONS = ['New', 'Popular', 'Premium', 'Budget', 'Refurbished']
+KINDS = ['Phones', 'Laptops', 'Tablets', 'Monitors', 'Cameras', 'Speakers']
+WORDS = ['wireless', 'pro', 'max', 'ultra', 'lite', 'mini', 'plus', 'gaming', 'portable', 'smart', 'classic', 'eco']
+SPECS = {'RAM': ['4GB', '8GB', '16GB', '32GB'], 'Color': ['Black', 'White', 'Silver', 'Blue', 'Red'],
+         'Storage': ['64GB', '128GB', '256GB', '512GB', '1TB'], 'Warranty': ['1 year', '2 years']}
+TAGS = ['sale', 'new', 'bestseller', 'gift', 'eco', 'limited']
+IMAGES = ['product_images/1.png', 'product_images/2.png']
+FLOWS = ['list', 'category', 'detail', 'add_to_cart', 'update_quantity', 'cart', 'start_checkout', 'checkout_page',
+         'place_order', 'order_list']
+
+
+def catalog_records(count, rng):
+    """Yield ``count`` synthetic catalog records spread over a three level category tree."""
+    for number in range(1, count + 1):
+        path = f'{rng.choice(DEPARTMENTS)}/{rng.choice(SECTIONS)}/{rng.choice(KINDS)}'
+        yield number, {
+            'name': f'{rng.choice(WORDS).title()} {rng.choice(KINDS)[:-1]} {rng.choice(WORDS)} {number}',
+            'price': rng.randrange(10, 5000) * 100,
+            'discount': rng.choice([0, 0, 0, 5, 10, 25]),
+            'quantity': rng.randrange(100, 1000),
+            'shipping_cost': rng.choice([0, 500, 1000]),
+            'category': path,
+            'tags': rng.sample(TAGS, rng.randrange(0, 3)),
+            'specification': {key: rng.choice(values) for key, values in SPECS.items()},
+            'info': f'<p>{" ".join(rng.choices(WORDS, k=20))}</p>',
+            'descriptions': f'<p>{" ".join(rng.choices(WORDS, k=60))}</p>',
+        }
+
+
+def seed(products=100_000, users=50, carts=3, orders=10, seed=22, progress=None):
+    """Fill the database with a synthetic shop and return the number of products created.
+
+    Products go through ``CatalogImporter``, so slugs, facets, the search
+    index and category counts are kept as an import would; two images per
+    product are added without renditions. Every user gets an address, a cart
+    of ``carts`` lines and ``orders`` past orders.
+    """
+    rng = random.Random(seed)
+    importer = CatalogImporter(batch_size=2000)
+    importer.run(catalog_records(products, rng), progress)
+
+    image_rows = (ProductImage(product_id=product_id, image=image)
+                  for product_id in Product.objects.values_list('pk', flat=True).iterator(chunk_size=5000)
+                  for image in IMAGES)
+    while batch := list(islice(image_rows, 5000)):
+        ProductImage.objects.bulk_create(batch)
+
+    product_ids = list(Product.objects.values_list('pk', flat=True))
+    password = make_password('bench')
+    with transaction.atomic():
+        people = User.objects.bulk_create([
+            User(username=f'{BENCHMARK_USER_PREFIX}{number}', email=f'{BENCHMARK_USER_PREFIX}{number}@example.com',
+                 password=password)
+            for number in range(users)
+        ])
+        addresses = Address.objects.bulk_create([
+            Address(user=user, full_name=user.username, street='Street 1', zip_code=100000, city='Tashkent',
+                    phone='901234567')
+            for user in people
+        ])
+        CartItem.objects.bulk_create([
+            CartItem(user=user, product_id=product_id, quantity=rng.randrange(1, 3))
+            for user in people for product_id in rng.sample(product_ids, carts)
+        ])
+        prices = {product.pk: product for product in Product.objects.filter(pk__in=product_ids[:5000])}
+        past, lines = [], []
+        for user, address in zip(people, addresses):
+            for _ in range(orders):
+                items = []
+                for product_id in rng.sample(list(prices), 3):
+                    item = OrderItem(product_id=product_id, quantity=rng.randrange(1, 4))
+                    item.set_prices(prices[product_id])
+                    items.append(item)
+                order = Order(owner=user, address=address, payment_method=Order.PaymentMethod.PAYPAL)
+                order.set_totals(items, 12)
+                past.append(order)
+                lines.append(items)
+        Order.objects.bulk_create(past)
+        for order, items in zip(past, lines):
+            for item in items:
+                item.order = order
+        OrderItem.objects.bulk_create([item for items in lines for item in items])
+    return importer.imported
+
+
+class ShopBenchmark:
+    """Drives the shop's main flows through the test client and records every request.
+
+    Each sample is ``(milliseconds, queries, status)``. Requests run one
+    at a time, so throughput is what a single worker could serve.
+    """
+
+    def __init__(self, seed=22):
+        self.rng = random.Random(seed)
+        self.samples = {flow: [] for flow in FLOWS}
+        self.product_ids = list(Product.objects.filter(quantity__gt=10).values_list('pk', flat=True))
+        self.category_slugs = list(Category.objects.values_list('slug', flat=True))
+        self.list_pages = max(1, min(99, Product.objects.count() // ProductListView.paginate_by))
+        self.clients = []
+        for user in User.objects.filter(username__startswith=BENCHMARK_USER_PREFIX).order_by('pk'):
+            client = Client(raise_request_exception=False)
+            client.force_login(user)
+            self.clients.append((client, user, Address.objects.filter(user=user).first()))
+        if not self.clients or not self.product_ids:
+            raise ValueError('No benchmark data; seed the database first')
+
+    def request(self, flow, client, method, path, data=None, **extra):
+        reset_queries()
+        with CaptureQueriesContext(connection) as queries:
+            started = time.perf_counter()
+            response = getattr(client, method)(path, data, **extra)
+            elapsed = (time.perf_counter() - started) * 1000
+        self.samples[flow].append((elapsed, len(queries), response.status_code))
+        return response
+
+    def iteration(self, client, user, address):
+        product_id = self.rng.choice(self.product_ids)
+        self.request('list', client, 'get', reverse('product_list_page'),
+                     {'page': self.rng.randrange(1, self.list_pages + 1)})
+        self.request('category', client, 'get',
+                     reverse('category_product_list_page', args=[self.rng.choice(self.category_slugs)]))
+        self.request('detail', client, 'get', reverse('product_detail_page', args=[product_id]))
+        self.request('add_to_cart', client, 'get', reverse('add_cart_page', args=[product_id]))
+        self.request('update_quantity', client, 'post', reverse('cart_items'),
+                     json.dumps({'operations': [{'op': 'set', 'product': product_id, 'quantity': 2}]}),
+                     content_type='application/json')
+        self.request('cart', client, 'get', reverse('cart_page'))
+        self.request('start_checkout', client, 'post', reverse('checkout_page'))
+        self.request('checkout_page', client, 'get', reverse('checkout_page'))
+        self.request('place_order', client, 'post', reverse('order_create_page'),
+                     {'payment_method': Order.PaymentMethod.PAYPAL, 'address': address.pk})
+        self.request('order_list', client, 'get', reverse('order_list_page'))
+
+    def run(self, iterations, warmup=3):
+        """Run ``iterations`` passes over every flow after ``warmup`` passes that are not recorded."""
+        for number in range(warmup + iterations):
+            if number == warmup:
+                self.samples = {flow: [] for flow in FLOWS}
+            self.iteration(*self.clients[number % len(self.clients)])
+        return summarize(self.samples)
+
+
+def summarize(samples):
+    """Return ``{flow: {requests, errors, rps, p50_ms, p95_ms, p99_ms, queries}}``; ``queries`` is the maximum."""
+    results = {}
+    for flow, flow_samples in samples.items():
+        if not flow_samples:
+            continue
+        durations = sorted(duration for duration, _, _ in flow_samples)
+        results[flow] = {
+            'requests': len(flow_samples),
+            'errors': sum(status >= 400 for _, _, status in flow_samples),
+            'rps': round(len(durations) / sum(durations) * 1000, 1),
+            **{f'p{pct}_ms': round(percentile(durations, pct), 2) for pct in (50, 95, 99)},
+            'mean_ms': round(statistics.mean(durations), 2),
+            'queries': max(queries for _, queries, _ in flow_samples),
+        }
+    return results
+
+
+def compare(results, baseline, tolerance=1.5, slack_ms=5):
+    """Return a description of every regression of ``results`` against ``baseline``.
+
+    Any error, any flow running more queries than in the baseline, and any
+    p95 above ``tolerance`` times the baseline (plus ``slack_ms`` to ignore
+    noise on very fast flows) is a regression.
+    """
+    regressions = []
+    for flow, current in results.items():
+        if current['errors']:
+            regressions.append(f'{flow}: {current["errors"]} of {current["requests"]} requests failed')
+        if (previous := baseline.get(flow)) is None:
+            continue
+        if current['queries'] > previous['queries']:
+            regressions.append(f'{flow}: {current["queries"]} queries per request, baseline {previous["queries"]}')
+        if current['p95_ms'] > previous['p95_ms'] * tolerance + slack_ms:
+            regressions.append(f'{flow}: p95 {current["p95_ms"]:.1f} ms, baseline {previous["p95_ms"]:.1f} ms')
+    return regressions
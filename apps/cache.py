@@ -0,0 +1,105 @@
+import time
+from functools import lru_cache
+
+from django.core.cache import cache
+
+from apps.models import Category, SiteSettings
+
+CATEGORY_TREE_VERSION_KEY = 'category_tree:version'
+CATEGORY_TREE_KEY = 'category_tree:{version}'
+CATEGORY_TREE_TIMEOUT = 60 * 60 * 24
+
+SITE_SETTINGS_VERSION_KEY = 'site_settings:version'
+SITE_SETTINGS_TTL = 60
+
+
+def get_version(key):
+    version = cache.get(key)
+    if version is None:
+        # A timestamp instead of 1 keeps a lost key from reusing a version another worker still holds.
+        cache.add(key, time.time_ns(), None)
+        version = cache.get(key)
+    return version
+
+
+def bump_version(key):
+    try:
+        return cache.incr(key)
+    except ValueError:
+        cache.set(key, time.time_ns(), None)
+        return cache.get(key)
+
+
+def get_category_tree_version():
+    return get_version(CATEGORY_TREE_VERSION_KEY)
+
+
+def bump_category_tree_version():
+    return bump_version(CATEGORY_TREE_VERSION_KEY)
+
+
+def _serialize_category_tree():
+    nodes, roots = {}, []
+    fields = 'id', 'name', 'slug', 'parent_id', 'tree_id', 'lft', 'rght', 'product_count'
+    for category in Category.objects.order_by('tree_id', 'lft').values(*fields):
+        node = {**category, 'children': []}
+        nodes[node['id']] = node
+        if node['parent_id'] in nodes:
+            nodes[node['parent_id']]['children'].append(node)
+        else:
+            roots.append(node)
+    return roots
+
+
+@lru_cache(maxsize=8)
+def _category_tree(version):
+    key = CATEGORY_TREE_KEY.format(version=version)
+    tree = cache.get(key)
+    if tree is None:
+        tree = _serialize_category_tree()
+        cache.set(key, tree, CATEGORY_TREE_TIMEOUT)
+    return tree
+
+
+def get_category_tree(version=None):
+    return _category_tree(version or get_category_tree_version())
+
+
+@lru_cache(maxsize=8)
+def _categories_by_slug(version):
+    categories, stack = {}, list(_category_tree(version))
+    while stack:
+        node = stack.pop()
+        categories[node['slug']] = node
+        stack.extend(node['children'])
+    return categories
+
+
+def get_category(slug, version=None):
+    """Return the cached tree node for ``slug`` with its ``(tree_id, lft, rght)`` range, or ``None``."""
+    return _categories_by_slug(version or get_category_tree_version()).get(slug)
+
+
+_site_settings = {'value': None, 'version': None, 'expires': 0.0}
+
+
+def get_site_settings():
+    """Return the ``SiteSettings`` row without touching the database on most requests.
+
+    The row is kept in process memory for ``SITE_SETTINGS_TTL`` seconds; after
+    that the shared version stamp decides whether it is still current.
+    """
+    if _site_settings['expires'] > time.monotonic():
+        return _site_settings['value']
+
+    version = get_version(SITE_SETTINGS_VERSION_KEY)
+    if version != _site_settings['version']:
+        _site_settings['value'] = SiteSettings.load()
+        _site_settings['version'] = version
+    _site_settings['expires'] = time.monotonic() + SITE_SETTINGS_TTL
+    return _site_settings['value']
+
+
+def invalidate_site_settings():
+    bump_version(SITE_SETTINGS_VERSION_KEY)
+    _site_settings['expires'] = 0.0
@@ -0,0 +1,178 @@
+from dataclasses import dataclass
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Count, Sum, F
+
+from apps.inventory import available_to
+from apps.models import CartItem, Product
+
+CART_SUMMARY_KEY = 'cart_summary:{user_id}'
+CART_OPERATIONS = 'add', 'remove', 'set'
+MAX_CART_OPERATIONS = 100
+
+
+class CartError(Exception):
+    pass
+
+
+@dataclass(frozen=True)
+class CartSummary:
+    count: int = 0
+    quantity: int = 0
+    subtotal: int = 0
+
+
+# Each line rounds its unit price down like Product.current_price, so totals match what the pages show.
+CART_LINE_SUBTOTAL = F('quantity') * (F('product__price') - F('product__price') * F('product__discount') / 100)
+
+CART_TOTALS = {
+    'total_count': Count('id'),
+    'total_quantity': Sum('quantity'),
+    'total_sum': Sum(CART_LINE_SUBTOTAL),
+}
+
+
+def _summary(totals):
+    return CartSummary(count=totals['total_count'], quantity=totals['total_quantity'] or 0,
+                       subtotal=totals['total_sum'] or 0)
+
+
+def checkout_totals(cart_items):
+    """Return the ``subtotal``, ``shipping_cost`` and ``total`` of the ``cart_items`` queryset."""
+    totals = cart_items.aggregate(subtotal=Sum(CART_LINE_SUBTOTAL), shipping_cost=Sum('product__shipping_cost'))
+    subtotal, shipping_cost = totals['subtotal'] or 0, totals['shipping_cost'] or 0
+    return {'subtotal': subtotal, 'shipping_cost': shipping_cost, 'total': subtotal + shipping_cost}
+
+
+def _aggregate_cart(user_id):
+    return _summary(CartItem.objects.filter(user_id=user_id).aggregate(**CART_TOTALS))
+
+
+async def _aaggregate_cart(user_id):
+    return _summary(await CartItem.objects.filter(user_id=user_id).aaggregate(**CART_TOTALS))
+
+
+def get_user_cart_summary(user):
+    if not user.is_authenticated:
+        return CartSummary()
+
+    timeout = getattr(settings, 'CART_SUMMARY_CACHE_TIMEOUT', 0)
+    if not timeout:
+        return _aggregate_cart(user.pk)
+
+    key = CART_SUMMARY_KEY.format(user_id=user.pk)
+    summary = cache.get(key)
+    if summary is None:
+        summary = _aggregate_cart(user.pk)
+        cache.set(key, summary, timeout)
+    return summary
+
+
+async def aget_user_cart_summary(user):
+    """``get_user_cart_summary`` for async views, using the async cache and ORM APIs."""
+    if not user.is_authenticated:
+        return CartSummary()
+
+    timeout = getattr(settings, 'CART_SUMMARY_CACHE_TIMEOUT', 0)
+    if not timeout:
+        return await _aaggregate_cart(user.pk)
+
+    key = CART_SUMMARY_KEY.format(user_id=user.pk)
+    summary = await cache.aget(key)
+    if summary is None:
+        summary = await _aaggregate_cart(user.pk)
+        await cache.aset(key, summary, timeout)
+    return summary
+
+
+def get_cart_summary(request):
+    if not hasattr(request, '_cart_summary'):
+        request._cart_summary = get_user_cart_summary(request.user)
+    return request._cart_summary
+
+
+def invalidate_cart_summary(user_id):
+    cache.delete(CART_SUMMARY_KEY.format(user_id=user_id))
+
+
+def _fold_operations(operations):
+    """Reduce ``[{'op', 'product', 'quantity'}, ...]`` to one ``(action, quantity)`` per product, in order."""
+    if not isinstance(operations, list) or not 0 < len(operations) <= MAX_CART_OPERATIONS:
+        raise CartError(f'Send between 1 and {MAX_CART_OPERATIONS} operations.')
+    actions = {}
+    for operation in operations:
+        try:
+            op, product_id = operation['op'], int(operation['product'])
+            quantity = int(operation.get('quantity', 1 if op == 'add' else 0))
+        except (KeyError, TypeError, ValueError):
+            raise CartError(f'Invalid operation: {operation!r}')
+        if op not in CART_OPERATIONS or quantity < 0 or (op == 'add' and quantity == 0):
+            raise CartError(f'Invalid operation: {operation!r}')
+
+        previous = actions.get(product_id)
+        if op == 'remove' or (op == 'set' and quantity == 0):
+            actions[product_id] = ('remove', 0)
+        elif op == 'set':
+            actions[product_id] = ('set', quantity)
+        elif previous is None:
+            actions[product_id] = ('add', quantity)
+        else:
+            action, current = previous
+            actions[product_id] = ('set' if action == 'remove' else action, current + quantity)
+    return actions
+
+
+def _check_stock(user, product_ids):
+    available = available_to(user, product_ids)
+    lines = CartItem.objects.filter(user=user, product_id__in=product_ids).values_list(
+        'product_id', 'product__name', 'quantity')
+    if over := [f'{available[product_id]} of {name}' for product_id, name, quantity in lines
+                if quantity > available[product_id]]:
+        raise CartError(f'Only {", ".join(over)} left in stock.')
+
+
+def apply_cart_operations(user, operations):
+    """Apply a batch of add/remove/set operations to ``user``'s cart in one transaction.
+
+    ``add`` increases the quantity (creating the line), ``set`` replaces it and
+    ``remove`` (or ``set`` to 0) deletes the line. Every statement is scoped to
+    ``user``, and adds are conditional UPDATEs, so concurrent requests do not
+    lose increments. A batch leaving more of a product in the cart than is in
+    stock is rolled back with ``CartError``. Returns the new ``CartSummary``.
+    """
+    actions = _fold_operations(operations)
+    wanted = [product_id for product_id, (action, _) in actions.items() if action != 'remove']
+    known = set(Product.objects.filter(pk__in=wanted).values_list('pk', flat=True)) if wanted else set()
+    if unknown := sorted(set(wanted) - known):
+        raise CartError(f'Unknown products: {unknown}')
+
+    removed = [product_id for product_id, (action, _) in actions.items() if action == 'remove']
+    replaced = [CartItem(user=user, product_id=product_id, quantity=quantity)
+                for product_id, (action, quantity) in actions.items() if action == 'set']
+    added = {}
+    for product_id, (action, quantity) in actions.items():
+        if action == 'add':
+            added.setdefault(quantity, []).append(product_id)
+
+    with transaction.atomic():
+        if removed:
+            CartItem.objects.filter(user=user, product_id__in=removed).delete()
+        if replaced:
+            CartItem.objects.bulk_create(replaced, update_conflicts=True, unique_fields=['user', 'product'],
+                                         update_fields=['quantity'])
+        if added:
+            # Missing lines start at 0 so every add is the same increment on an existing row.
+            CartItem.objects.bulk_create(
+                [CartItem(user=user, product_id=product_id, quantity=0)
+                 for product_ids in added.values() for product_id in product_ids],
+                ignore_conflicts=True)
+            for quantity, product_ids in added.items():
+                CartItem.objects.filter(user=user, product_id__in=product_ids).update(
+                    quantity=F('quantity') + quantity)
+        if wanted:
+            _check_stock(user, wanted)
+    # Bulk statements skip the post_save/post_delete signals that normally drop the cached summary.
+    invalidate_cart_summary(user.pk)
+    return _aggregate_cart(user.pk)
@@ -0,0 +1,306 @@
+import csv
+import json
+from itertools import islice
+
+from django.db import transaction
+from django.utils.timezone import now
+
+from apps.cache import bump_category_tree_version
+from apps.categories import recount_product_counts
+from apps.facets import spec_pairs, bump_facets_version
+from apps.models import Category, Product, ProductImage, ProductSpec, Tags
+from apps.pagecache import invalidate_products
+from apps.search import document_body, get_search_index
+from apps.slugs import assign_slugs
+from apps.tasks import generate_image_renditions
+
+CATALOG_FIELDS = ['id', 'name', 'price', 'discount', 'quantity', 'shipping_cost', 'category', 'tags', 'images',
+                  'specification', 'info', 'descriptions']
+FORMATS = 'csv', 'jsonl'
+PATH_SEPARATOR = '/'
+PATH_ESCAPE = '\\'
+LIST_SEPARATOR = '|'
+
+
+class CatalogError(Exception):
+    pass
+
+
+def detect_format(path, fmt=None):
+    if fmt:
+        return fmt
+    if path.endswith('.csv'):
+        return 'csv'
+    if path.endswith(('.jsonl', '.ndjson')):
+        return 'jsonl'
+    raise CatalogError(f'Cannot tell the format of {path!r}; pass --format')
+
+
+def join_path(names):
+    """Join category names into a ``Parent/Child`` path, escaping separators inside the names."""
+    return PATH_SEPARATOR.join(
+        name.replace(PATH_ESCAPE, PATH_ESCAPE * 2).replace(PATH_SEPARATOR, PATH_ESCAPE + PATH_SEPARATOR)
+        for name in names
+    )
+
+
+def split_path(path):
+    """Split a path written by ``join_path`` back into category names."""
+    parts, part, chars = [], [], iter(str(path))
+    for char in chars:
+        if char == PATH_ESCAPE:
+            part.append(next(chars, ''))
+        elif char == PATH_SEPARATOR:
+            parts.append(''.join(part))
+            part = []
+        else:
+            part.append(char)
+    parts.append(''.join(part))
+    return [part.strip() for part in parts if part.strip()]
+
+
+def read_records(stream, fmt):
+    """Yield ``(line number, record)`` pairs one at a time from a CSV or JSON Lines stream."""
+    if fmt == 'csv':
+        reader = csv.DictReader(stream)
+        for record in reader:
+            try:
+                yield reader.line_num, _from_csv(record)
+            except ValueError as e:
+                raise CatalogError(f'line {reader.line_num}: {e}')
+        return
+
+    for number, line in enumerate(stream, 1):
+        if line.strip():
+            try:
+                record = json.loads(line)
+            except ValueError as e:
+                raise CatalogError(f'line {number}: {e}')
+            if not isinstance(record, dict):
+                raise CatalogError(f'line {number}: expected an object, got {type(record).__name__}')
+            yield number, record
+
+
+def _from_csv(record):
+    record = dict(record)
+    for key in ('tags', 'images'):
+        record[key] = [value for value in (record.get(key) or '').split(LIST_SEPARATOR) if value]
+    record['specification'] = json.loads(record['specification']) if record.get('specification') else {}
+    return record
+
+
+def _to_csv(record):
+    record = dict(record)
+    for key in ('tags', 'images'):
+        record[key] = LIST_SEPARATOR.join(record[key])
+    record['specification'] = json.dumps(record['specification'], ensure_ascii=False)
+    return record
+
+
+class CatalogWriter:
+    def __init__(self, stream, fmt):
+        self.stream = stream
+        self.csv = None
+        if fmt == 'csv':
+            self.csv = csv.DictWriter(stream, CATALOG_FIELDS)
+            self.csv.writeheader()
+
+    def write(self, record):
+        if self.csv is not None:
+            self.csv.writerow(_to_csv(record))
+        else:
+            self.stream.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+
+def category_paths():
+    """Map every category id to the tuple of names from its root down, built from one query."""
+    rows = {pk: (name, parent_id) for pk, name, parent_id in
+            Category.objects.values_list('id', 'name', 'parent_id')}
+    paths = {}
+
+    def path(pk):
+        if pk not in paths:
+            name, parent_id = rows[pk]
+            paths[pk] = (name,) if parent_id is None else (*path(parent_id), name)
+        return paths[pk]
+
+    for pk in rows:
+        path(pk)
+    return paths
+
+
+def export_records(batch_size=2000):
+    """Yield one catalog record per product while holding at most ``batch_size`` products in memory."""
+    paths = category_paths()
+    products = Product.objects.order_by('pk').prefetch_related('tags', 'images')
+    for product in products.iterator(chunk_size=batch_size):
+        yield {
+            'id': product.pk,
+            'name': product.name,
+            'price': product.price,
+            'discount': product.discount,
+            'quantity': product.quantity,
+            'shipping_cost': product.shipping_cost,
+            'category': join_path(paths[product.category_id]),
+            'tags': [tag.name for tag in product.tags.all()],
+            'images': [image.image.name for image in product.images.all()],
+            'specification': product.specification,
+            'info': product.info,
+            'descriptions': product.descriptions,
+        }
+
+
+class CatalogImporter:
+    """Creates products from catalog records in ``batch_size`` chunks, one transaction per chunk.
+
+    A record whose ``id`` names an existing product updates that product and
+    replaces its tags, specs and images, so an export can be imported back.
+
+    Categories and tags are resolved against in-memory maps that are filled
+    with one query per chunk for names not seen yet. New categories are
+    written without tree positions and the MPTT tree is rebuilt once at the end.
+    """
+
+    def __init__(self, batch_size=1000):
+        self.batch_size = batch_size
+        self.categories = None
+        self.tags = {}
+        self.created_categories = 0
+        self.created_tags = 0
+        self.imported = 0
+
+    def run(self, records, progress=None):
+        records = iter(records)
+        try:
+            while chunk := list(islice(records, self.batch_size)):
+                with transaction.atomic():
+                    self.import_chunk(chunk)
+                self.imported += len(chunk)
+                if progress:
+                    progress(self)
+        finally:
+            self.finish()
+        return self.imported
+
+    def finish(self):
+        if self.created_categories:
+            Category.objects.rebuild()
+        if self.imported or self.created_categories:
+            recount_product_counts()
+            bump_category_tree_version()
+            bump_facets_version()
+
+    def load_categories(self):
+        self.categories = {path: pk for pk, path in category_paths().items()}
+
+    def resolve_categories(self, paths):
+        if self.categories is None:
+            self.load_categories()
+        missing = {path[:depth] for path in paths for depth in range(1, len(path) + 1)} - self.categories.keys()
+        for depth in sorted({len(path) for path in missing}):
+            level = sorted(path for path in missing if len(path) == depth)
+            categories = assign_slugs([
+                Category(name=path[-1], parent_id=self.categories.get(path[:-1]), tree_id=0, lft=0, rght=0,
+                         level=depth - 1)
+                for path in level
+            ])
+            Category.objects.bulk_create(categories)
+            self.categories.update(zip(level, (category.pk for category in categories)))
+            self.created_categories += len(categories)
+
+    def resolve_tags(self, names):
+        missing = set(names) - self.tags.keys()
+        if not missing:
+            return
+        self.tags.update(Tags.objects.filter(name__in=missing).values_list('name', 'id'))
+        new = sorted(missing - self.tags.keys())
+        if new:
+            tags = Tags.objects.bulk_create(assign_slugs([Tags(name=name) for name in new]))
+            self.tags.update((tag.name, tag.pk) for tag in tags)
+            self.created_tags += len(tags)
+
+    def build_product(self, number, record):
+        try:
+            path = tuple(split_path(record['category']))
+            if not record.get('name') or not path:
+                raise ValueError('name and category are required')
+            product = Product(
+                pk=int(record['id']) if record.get('id') not in (None, '') else None,
+                name=record['name'], price=int(record['price']), discount=int(record.get('discount') or 0),
+                quantity=int(record.get('quantity') or 0), shipping_cost=int(record.get('shipping_cost') or 0),
+                info=record.get('info') or '', descriptions=record.get('descriptions') or '',
+                specification=record.get('specification') or {},
+            )
+        except (KeyError, TypeError, ValueError) as e:
+            raise CatalogError(f'line {number}: {e!r}')
+        return product, path
+
+    def import_chunk(self, chunk):
+        built = [self.build_product(number, record) for number, record in chunk]
+        self.resolve_categories({path for _, path in built})
+        self.resolve_tags({name for _, record in chunk for name in record.get('tags') or ()})
+
+        previous = dict(Product.objects.filter(
+            pk__in=[product.pk for product, _ in built if product.pk is not None]).values_list('pk', 'category_id'))
+        products, new, updated = [], [], []
+        for (product, path), (_, record) in zip(built, chunk):
+            product.category_id = self.categories[path]
+            products.append(product)
+            if product.pk in previous:
+                updated.append((product, record))
+            else:
+                product.pk = None
+                new.append(product)
+        Product.objects.bulk_create(new)
+        kept_images = self.update_products(updated, previous)
+
+        images, specs, product_tags, documents = [], [], [], []
+        ProductTags = Product.tags.through
+        for product, (_, record) in zip(products, chunk):
+            tag_names = list(dict.fromkeys(record.get('tags') or ()))
+            images.extend(ProductImage(product_id=product.pk, image=image) for image in record.get('images') or ()
+                          if (product.pk, image) not in kept_images)
+            specs.extend(ProductSpec(product_id=product.pk, key=key, value=value)
+                         for key, value in dict.fromkeys(spec_pairs(product.specification)))
+            product_tags.extend(ProductTags(product_id=product.pk, tags_id=self.tags[name]) for name in tag_names)
+            documents.append((product.pk, product.name, document_body(
+                product.info, product.descriptions, tag_names, product.specification)))
+        ProductImage.objects.bulk_create(images)
+        if image_ids := [image.pk for image in images]:
+            transaction.on_commit(lambda: generate_image_renditions.delay(image_ids), robust=True)
+        ProductSpec.objects.bulk_create(specs)
+        ProductTags.objects.bulk_create(product_tags)
+        get_search_index().index_many(documents)
+
+    def update_products(self, updated, previous_categories):
+        """Write ``[(product, record), ...]`` over existing rows and drop the tags, specs and images they replace.
+
+        Returns the ``(product id, image name)`` pairs that are already stored,
+        so those images and their renditions are kept as they are.
+        """
+        if not updated:
+            return set()
+        products = [product for product, _ in updated]
+        for product in products:
+            product.updated = now()
+        Product.objects.bulk_update(products, ['name', 'price', 'discount', 'quantity', 'shipping_cost', 'category',
+                                               'info', 'descriptions', 'specification', 'updated'])
+        ids = [product.pk for product in products]
+        ProductSpec.objects.filter(product_id__in=ids).delete()
+        Product.tags.through.objects.filter(product_id__in=ids).delete()
+
+        listed = {(product.pk, image) for product, record in updated for image in record.get('images') or ()}
+        stored = ProductImage.objects.filter(product_id__in=ids).values_list('pk', 'product_id', 'image')
+        kept = set()
+        stale = []
+        for pk, product_id, image in stored:
+            if (product_id, image) in listed:
+                kept.add((product_id, image))
+            else:
+                stale.append(pk)
+        if stale:
+            ProductImage.objects.filter(pk__in=stale).delete()
+
+        invalidate_products([(product.pk, product.category_id) for product in products] +
+                            [(product.pk, previous_categories[product.pk]) for product in products])
+        return kept
@@ -0,0 +1,41 @@
+from django.db.models import Count, F
+
+from apps.models import Category, Product
+
+
+def subtree_filter(category, prefix='category__'):
+    """Return lookups matching everything under the ``category`` tree node, itself included."""
+    return {
+        f'{prefix}tree_id': category['tree_id'],
+        f'{prefix}lft__gte': category['lft'],
+        f'{prefix}rght__lte': category['rght'],
+    }
+
+
+def adjust_product_count(category_id, delta):
+    """Add ``delta`` to the product count of a category and all of its ancestors in one UPDATE."""
+    category = Category.objects.filter(pk=category_id).values('tree_id', 'lft', 'rght').first()
+    if category is None:
+        return 0
+    return Category.objects.filter(
+        tree_id=category['tree_id'], lft__lte=category['lft'], rght__gte=category['rght']
+    ).update(product_count=F('product_count') + delta)
+
+
+def recount_product_counts():
+    """Recompute every category's subtree product count from one GROUP BY.
+
+    Used after the tree is restructured or products are written without signals.
+    """
+    direct = dict(Product.objects.order_by().values_list('category_id').annotate(count=Count('id')))
+    categories = list(Category.objects.order_by('-level').only('id', 'parent_id', 'level', 'product_count'))
+    totals, changed = {}, []
+    for category in categories:
+        count = totals.get(category.pk, 0) + direct.get(category.pk, 0)
+        if category.parent_id:
+            totals[category.parent_id] = totals.get(category.parent_id, 0) + count
+        if category.product_count != count:
+            category.product_count = count
+            changed.append(category)
+    Category.objects.bulk_update(changed, ['product_count'], batch_size=1000)
+    return len(changed)
@@ -0,0 +1,11 @@
+from apps.cache import get_site_settings
+from apps.cart import get_cart_summary
+
+
+def cart(request):
+    summary = get_cart_summary(request)
+    return {'cart': summary, 'cart_len': summary.count}
+
+
+def site_settings(request):
+    return {'tax': get_site_settings().tax}
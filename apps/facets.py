@@ -0,0 +1,105 @@
+from django.core.cache import cache
+from django.db.models import Count
+
+from apps.cache import get_version, bump_version
+from apps.categories import subtree_filter
+from apps.models import Product, ProductSpec
+
+FACETS_VERSION_KEY = 'facets:version'
+FACETS_KEY = 'facets:{version}:{category}'
+FACETS_TIMEOUT = 60 * 60
+FACET_PARAM = 'spec'
+MAX_LENGTH = 255
+
+
+def spec_pairs(specification):
+    """Yield the ``(key, value)`` pairs of a specification that can be filtered on.
+
+    Scalars give one pair and lists give one pair per item; nested objects are skipped.
+    """
+    if not isinstance(specification, dict):
+        return
+    for key, value in specification.items():
+        values = value if isinstance(value, list) else [value]
+        for item in values:
+            if item is None or isinstance(item, (dict, list)):
+                continue
+            if isinstance(item, bool):
+                item = 'Yes' if item else 'No'
+            item = str(item).strip()
+            if item:
+                yield str(key).strip()[:MAX_LENGTH], item[:MAX_LENGTH]
+
+
+def sync_product_specs(product):
+    ProductSpec.objects.filter(product_id=product.pk).delete()
+    ProductSpec.objects.bulk_create(
+        [ProductSpec(product_id=product.pk, key=key, value=value)
+         for key, value in dict.fromkeys(spec_pairs(product.specification))]
+    )
+
+
+def rebuild_product_specs(batch_size=5000):
+    ProductSpec.objects.all().delete()
+    batch, count = [], 0
+    for product in Product.objects.only('pk', 'specification').iterator(chunk_size=2000):
+        batch.extend(ProductSpec(product_id=product.pk, key=key, value=value)
+                     for key, value in dict.fromkeys(spec_pairs(product.specification)))
+        count += 1
+        if len(batch) >= batch_size:
+            ProductSpec.objects.bulk_create(batch)
+            batch = []
+    ProductSpec.objects.bulk_create(batch)
+    bump_facets_version()
+    return count
+
+
+def bump_facets_version():
+    return bump_version(FACETS_VERSION_KEY)
+
+
+def parse_facets(values):
+    """Turn ``?spec=RAM:8GB&spec=Color:Black`` into ``{'RAM': ['8GB'], 'Color': ['Black']}``."""
+    selected = {}
+    for raw in values:
+        key, sep, value = raw.partition(':')
+        if sep and key and value:
+            selected.setdefault(key, [])
+            if value not in selected[key]:
+                selected[key].append(value)
+    return selected
+
+
+def filter_by_facets(queryset, selected):
+    """Keep products matching every selected key with any of its selected values."""
+    for key, values in selected.items():
+        queryset = queryset.filter(
+            pk__in=ProductSpec.objects.filter(key=key, value__in=values).values('product_id')
+        )
+    return queryset
+
+
+def _count_facets(category):
+    specs = ProductSpec.objects.all()
+    if category is not None:
+        specs = specs.filter(**subtree_filter(category, 'product__category__'))
+    facets = {}
+    rows = specs.values_list('key', 'value').annotate(count=Count('product_id')).order_by('key', 'value')
+    for key, value, count in rows:
+        facets.setdefault(key, []).append((value, count))
+    return list(facets.items())
+
+
+def get_facet_counts(category=None):
+    """Return ``[(key, [(value, product count), ...]), ...]`` for products under the ``category`` tree node.
+
+    Counts are cached per category and dropped as a whole when any product
+    or category changes.
+    """
+    key = FACETS_KEY.format(version=get_version(FACETS_VERSION_KEY),
+                            category=category['id'] if category is not None else 'all')
+    facets = cache.get(key)
+    if facets is None:
+        facets = _count_facets(category)
+        cache.set(key, facets, FACETS_TIMEOUT)
+    return facets
@@ -0,0 +1,43 @@
+from django.conf import settings
+from django.core.cache import cache
+
+from apps.models import Favorite
+
+FAVORITES_KEY = 'favorites:{user_id}'
+
+
+def _load_liked_ids(user_id):
+    return frozenset(Favorite.objects.filter(user_id=user_id).values_list('product_id', flat=True))
+
+
+def get_user_liked_ids(user):
+    if not user.is_authenticated:
+        return frozenset()
+
+    timeout = getattr(settings, 'FAVORITES_CACHE_TIMEOUT', 0)
+    if not timeout:
+        return _load_liked_ids(user.pk)
+
+    key = FAVORITES_KEY.format(user_id=user.pk)
+    liked = cache.get(key)
+    if liked is None:
+        liked = _load_liked_ids(user.pk)
+        cache.set(key, liked, timeout)
+    return liked
+
+
+def get_liked_product_ids(request):
+    if not hasattr(request, '_liked_product_ids'):
+        request._liked_product_ids = get_user_liked_ids(request.user)
+    return request._liked_product_ids
+
+
+def mark_liked(products, liked_ids):
+    """Set ``is_liked`` on each product from a set of liked ids fetched once for the page."""
+    for product in products:
+        product.is_liked = product.pk in liked_ids
+    return products
+
+
+def invalidate_favorites(user_id):
+    cache.delete(FAVORITES_KEY.format(user_id=user_id))
@@ -1,9 +1,11 @@
 from datetime import datetime
 
 from django.core.exceptions import ValidationError
+from django.db import transaction
 from django.forms import ModelForm, CharField, ModelChoiceField
 
-from apps.models import Address, Order, CreditCard, CartItem, OrderItem, User
+from apps.models import Address, Order, CreditCard, User
+from apps.orders import place_order
 
 
 class UserRegisterModelForm(ModelForm):
@@ -41,10 +43,12 @@ class OrderCreateModelForm(ModelForm):
         model = Order
         fields = 'payment_method', 'address', 'owner'
 
+    @transaction.atomic
     def save(self, commit=True):
-        obj: Order = super().save(commit)
+        obj: Order = super().save(commit=False)
+        place_order(obj)
 
-        if commit and obj.payment_method == 'credit_card':
+        if obj.payment_method == 'credit_card':
             cvv = self.data.get('cvv')
             month, year = map(int, self.data.get('expire_date').split('/'))
             expire_date = datetime(year + 2000, month, 1).date()
@@ -56,12 +60,4 @@ class OrderCreateModelForm(ModelForm):
                 expire_date=expire_date,
                 number=number
             )
-
-        for cart_item in obj.owner.user_cart.all():
-            OrderItem.objects.create(order=obj,
-                                     quantity=cart_item.quantity,
-                                     product=cart_item.product)
-            cart_item.product.quantity -= cart_item.quantity
-            cart_item.product.save()
-        CartItem.objects.filter(user=obj.owner).delete()
         return obj
@@ -0,0 +1,89 @@
+import hashlib
+import logging
+import os
+from io import BytesIO
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+from apps.models import ProductImage
+from apps.pagecache import touch_products
+
+logger = logging.getLogger(__name__)
+
+RENDITIONS_DIR = 'product_images/renditions'
+MIME_TYPES = {'webp': 'image/webp', 'jpeg': 'image/jpeg'}
+
+
+def rendition_name(product_image, digest, width, fmt):
+    """Name a copy after the source's content, so a new file under an old name never reuses the old copies."""
+    stem = os.path.splitext(os.path.basename(product_image.image.name))[0]
+    return f'{RENDITIONS_DIR}/{product_image.pk}/{stem}-{digest}-{width}w.{fmt}'
+
+
+def _encode(image, fmt):
+    if fmt == 'jpeg' and image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+    buffer = BytesIO()
+    image.save(buffer, format=fmt.upper(), quality=settings.PRODUCT_IMAGE_QUALITY, optimize=True)
+    return ContentFile(buffer.getvalue())
+
+
+def generate_renditions(product_image, force=False):
+    """Write the resized copies of ``product_image`` and record them on the row.
+
+    Copies of the same content already in storage are reused, so running it
+    twice does no image work, and copies of a previous source are deleted.
+    Returns whether the row was updated.
+    """
+    source = product_image.image.name
+    if not source or (not force and product_image.rendered_from == source and product_image.renditions):
+        return False
+
+    storage = product_image.image.storage
+    try:
+        with storage.open(source, 'rb') as f:
+            data = f.read()
+        with Image.open(BytesIO(data)) as original:
+            original = ImageOps.exif_transpose(original)
+            original.load()
+    except (OSError, UnidentifiedImageError) as e:
+        logger.warning('Cannot make renditions of product image %s (%s): %s', product_image.pk, source, e)
+        return False
+
+    digest = hashlib.sha256(data).hexdigest()[:12]
+    width, height = original.size
+    widths = sorted({min(target, width) for target in settings.PRODUCT_IMAGE_WIDTHS})
+    renditions = {}
+    for fmt in settings.PRODUCT_IMAGE_FORMATS:
+        for target in widths:
+            name = rendition_name(product_image, digest, target, fmt)
+            if force and storage.exists(name):
+                storage.delete(name)
+            if not storage.exists(name):
+                resized = original if target == width else original.resize(
+                    (target, max(1, round(height * target / width))), Image.LANCZOS)
+                name = storage.save(name, _encode(resized, fmt))
+            renditions.setdefault(fmt, {})[str(target)] = name
+
+    # Only record the copies if the image was not replaced while they were being made.
+    updated = ProductImage.objects.filter(pk=product_image.pk, image=source).update(
+        width=width, height=height, renditions=renditions, rendered_from=source)
+    if updated:
+        delete_renditions(product_image, keep=renditions)
+        product_image.width, product_image.height = width, height
+        product_image.renditions, product_image.rendered_from = renditions, source
+        touch_products([product_image.product_id])
+    return bool(updated)
+
+
+def _names(renditions):
+    return {name for names in renditions.values() for name in names.values()}
+
+
+def delete_renditions(product_image, keep=None):
+    """Delete the copies recorded on ``product_image`` except those also in the ``keep`` renditions."""
+    storage = product_image.image.storage
+    for name in _names(product_image.renditions) - _names(keep or {}):
+        storage.delete(name)
@@ -0,0 +1,203 @@
+import cProfile
+import logging
+import os
+import random
+import threading
+import time
+from collections import Counter, deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from types import SimpleNamespace
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.urls import Resolver404, resolve
+
+logger = logging.getLogger(__name__)
+
+METRICS = 'total_ms', 'db_ms', 'queries', 'duplicates', 'template_ms'
+PERCENTILES = 50, 95, 99
+
+
+class QueryRecorder:
+    """``execute_wrapper`` callable counting queries, their time and repeats of the same SQL."""
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.statements = Counter()
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.seconds += time.perf_counter() - started
+            self.count += 1
+            self.statements[sql] += 1
+
+    @property
+    def duplicates(self):
+        return sum(count - 1 for count in self.statements.values())
+
+    def repeated(self, threshold):
+        return [(sql, count) for sql, count in self.statements.most_common() if count >= threshold]
+
+
+class ViewStats:
+    """The last ``INSTRUMENTATION_SAMPLES`` requests of every view, kept in memory per process."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = {}
+
+    def add(self, view, sample):
+        with self.lock:
+            if view not in self.samples:
+                self.samples[view] = deque(maxlen=settings.INSTRUMENTATION_SAMPLES)
+            self.samples[view].append(sample)
+
+    def clear(self):
+        with self.lock:
+            self.samples.clear()
+
+    def summary(self):
+        with self.lock:
+            samples = {view: list(values) for view, values in self.samples.items()}
+        return {view: summarize(values) for view, values in sorted(samples.items())}
+
+
+def percentile(ordered, pct):
+    return ordered[min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))]
+
+
+def summarize(samples):
+    result = {'requests': len(samples)}
+    for index, metric in enumerate(METRICS):
+        ordered = sorted(sample[index] for sample in samples)
+        result[metric] = {f'p{pct}': round(percentile(ordered, pct), 2) for pct in PERCENTILES}
+        result[metric]['max'] = round(ordered[-1], 2)
+    return result
+
+
+view_stats = ViewStats()
+_active_recorder = ContextVar('query_recorder', default=None)
+
+
+def record_query(execute, sql, params, many, context):
+    """Passes queries to the recorder of the current request.
+
+    Connections are per thread while async views run their queries in
+    sync_to_async threads, so the request's recorder travels in a context
+    variable, which asgiref copies into those threads.
+    """
+    recorder = _active_recorder.get()
+    if recorder is None:
+        return execute(sql, params, many, context)
+    return recorder(execute, sql, params, many, context)
+
+
+def install_query_recorder(connection):
+    if settings.INSTRUMENTATION_ENABLED and record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+def server_timing(total_ms, db_ms, queries, template_ms):
+    return (f'db;dur={db_ms:.1f};desc="{queries} queries", tpl;dur={template_ms:.1f};desc="templates", '
+            f'total;dur={total_ms:.1f}')
+
+
+class InstrumentationMiddleware:
+    """Times every request and its queries, adds ``Server-Timing`` and feeds ``view_stats``.
+
+    Put it first in ``MIDDLEWARE`` so the numbers include the other
+    middleware. Requests repeating one statement ``INSTRUMENTATION_DUPLICATE_THRESHOLD``
+    times or more are logged as likely N+1 queries. With
+    ``INSTRUMENTATION_PROFILE_RATE`` above zero, that share of requests to
+    ``INSTRUMENTATION_PROFILE_VIEWS`` (all views if empty) is run under
+    cProfile and dumped to ``INSTRUMENTATION_PROFILE_DIR``.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not settings.INSTRUMENTATION_ENABLED:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        with self.measure(request) as measured:
+            measured.response = self.get_response(request)
+        return measured.response
+
+    async def __acall__(self, request):
+        with self.measure(request) as measured:
+            measured.response = await self.get_response(request)
+        return measured.response
+
+    @contextmanager
+    def measure(self, request):
+        recorder = QueryRecorder()
+        measured = SimpleNamespace(response=None)
+        request._template_seconds = 0.0
+        self.start_profile(request)
+        token = _active_recorder.set(recorder)
+        started = time.perf_counter()
+        try:
+            yield measured
+        finally:
+            _active_recorder.reset(token)
+            self.stop_profile(request)
+        total_ms = (time.perf_counter() - started) * 1000
+
+        db_ms, template_ms = recorder.seconds * 1000, request._template_seconds * 1000
+        measured.response['Server-Timing'] = server_timing(total_ms, db_ms, recorder.count, template_ms)
+        view = self.view_name(request)
+        view_stats.add(view, (total_ms, db_ms, recorder.count, recorder.duplicates, template_ms))
+        if repeated := recorder.repeated(settings.INSTRUMENTATION_DUPLICATE_THRESHOLD):
+            sql, count = repeated[0]
+            logger.warning('%s ran the same query %d times (likely N+1): %s', view, count, sql[:300])
+
+    @staticmethod
+    def view_name(request):
+        match = getattr(request, 'resolver_match', None)
+        return match.view_name if match is not None else 'unresolved'
+
+    def start_profile(self, request):
+        # Picked before the URL is resolved so no process_view hook costs ASGI requests a thread switch.
+        rate = settings.INSTRUMENTATION_PROFILE_RATE
+        if not rate or random.random() >= rate:
+            return
+        if views := settings.INSTRUMENTATION_PROFILE_VIEWS:
+            try:
+                if resolve(request.path_info).view_name not in views:
+                    return
+            except Resolver404:
+                return
+        request._profiler = cProfile.Profile()
+        request._profiler.enable()
+
+    def stop_profile(self, request):
+        profiler = getattr(request, '_profiler', None)
+        if profiler is None:
+            return
+        profiler.disable()
+        os.makedirs(settings.INSTRUMENTATION_PROFILE_DIR, exist_ok=True)
+        name = f'{self.view_name(request).replace(":", "-")}-{time.time_ns()}.prof'
+        profiler.dump_stats(os.path.join(settings.INSTRUMENTATION_PROFILE_DIR, name))
+
+    def process_template_response(self, request, response):
+        # Runs right before render() when this middleware comes first, so the callback sees render time only.
+        render_started = time.perf_counter()
+
+        def rendered(response):
+            request._template_seconds += time.perf_counter() - render_started
+
+        response.add_post_render_callback(rendered)
+        return response
@@ -0,0 +1,212 @@
+from collections import Counter
+from datetime import timedelta
+from functools import reduce
+from operator import or_
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Case, F, Q, Value, When
+from django.utils.timezone import now
+
+from apps.models import CartItem, Product, StockReservation
+from apps.pagecache import bump_tags, invalidate_products, product_tag
+
+STOCK_LEVEL_KEY = 'stock_level:{id}'
+
+
+def stock_key(product_id):
+    return STOCK_LEVEL_KEY.format(id=product_id)
+
+
+def get_stock_levels(product_ids):
+    """Return ``{product id: units available}``, from the cache for ``STOCK_CACHE_TIMEOUT`` seconds."""
+    product_ids = list(product_ids)
+    timeout = settings.STOCK_CACHE_TIMEOUT
+    if not timeout:
+        return dict(Product.objects.filter(pk__in=product_ids).values_list('pk', 'quantity'))
+    cached = cache.get_many([stock_key(product_id) for product_id in product_ids])
+    levels = {product_id: cached[key] for product_id in product_ids if (key := stock_key(product_id)) in cached}
+    if missing := [product_id for product_id in product_ids if product_id not in levels]:
+        fetched = dict(Product.objects.filter(pk__in=missing).values_list('pk', 'quantity'))
+        cache.set_many({stock_key(product_id): quantity for product_id, quantity in fetched.items()}, timeout)
+        levels.update(fetched)
+    return levels
+
+
+def mark_in_stock(products):
+    """Set ``in_stock`` on products loaded without their ``quantity`` from the cached stock levels."""
+    levels = get_stock_levels(product.pk for product in products)
+    for product in products:
+        product.in_stock = levels.get(product.pk, 0) > 0
+    return products
+
+
+def _add_to_quantity(deltas):
+    """``quantity`` plus ``{product id: units}`` for the product on each row, for one UPDATE over all of them."""
+    return F('quantity') + Case(*(When(pk=product_id, then=Value(delta)) for product_id, delta in deltas.items()),
+                                default=Value(0))
+
+
+def take_stock(quantities):
+    """Take ``{product id: units}`` out of stock with one UPDATE; return the ids that were short.
+
+    Each row is only updated while it still has the units, so checking and
+    taking are one statement and no rows need locking beforehand. When fewer
+    rows than asked were updated, the UPDATE is rolled back to its savepoint,
+    the short ids are read and the rest taken again. Must run in a transaction.
+    """
+    wanted, short = dict(quantities), []
+    while wanted:
+        with transaction.atomic():
+            guard = reduce(or_, (Q(pk=product_id, quantity__gte=units) for product_id, units in wanted.items()))
+            taken = {product_id: -units for product_id, units in wanted.items()}
+            if Product.objects.filter(guard).update(quantity=_add_to_quantity(taken)) == len(wanted):
+                break
+            transaction.set_rollback(True)
+        levels = dict(Product.objects.filter(pk__in=list(wanted)).values_list('pk', 'quantity'))
+        for product_id in [product_id for product_id, units in wanted.items() if levels.get(product_id, 0) < units]:
+            short.append(product_id)
+            del wanted[product_id]
+    return sorted(short)
+
+
+def return_stock(quantities):
+    if quantities:
+        Product.objects.filter(pk__in=list(quantities)).update(quantity=_add_to_quantity(quantities))
+
+
+def _apply_stock_changes(changes):
+    """Take or return ``{product id: delta}`` units; return the ids that could not be taken.
+
+    Must run in a transaction. Once it commits, cached stock levels and the
+    product pages are expired. Listings only show whether a product is in
+    stock, so only products that ran out or came back get a new ``updated``
+    and have their listings expired.
+    """
+    taken = {product_id: delta for product_id, delta in changes.items() if delta > 0}
+    returned = {product_id: -delta for product_id, delta in changes.items() if delta < 0}
+    short = take_stock(taken)
+    return_stock(returned)
+    changed = [product_id for product_id in changes if changes[product_id] and product_id not in short]
+    if not changed:
+        return short
+
+    levels = Product.objects.filter(pk__in=changed).values_list('pk', 'category_id', 'quantity')
+    flipped = [(product_id, category_id) for product_id, category_id, quantity in levels
+               if (product_id in taken and quantity == 0) or quantity == returned.get(product_id)]
+    if flipped:
+        Product.objects.filter(pk__in=[product_id for product_id, _ in flipped]).update(updated=now())
+
+    def expire():
+        cache.delete_many([stock_key(product_id) for product_id in changed])
+        bump_tags([product_tag(product_id) for product_id in changed])
+        invalidate_products(flipped)
+
+    transaction.on_commit(expire)
+    return short
+
+
+def reservation_deadline(started_at=None):
+    """Expiry for a hold renewed now, capped at ``STOCK_RESERVATION_MAX_HOLD`` seconds after it ``started_at``."""
+    deadline = now() + timedelta(seconds=settings.STOCK_RESERVATION_TIMEOUT)
+    if started_at is not None:
+        deadline = min(deadline, started_at + timedelta(seconds=settings.STOCK_RESERVATION_MAX_HOLD))
+    return deadline
+
+
+@transaction.atomic
+def reserve_cart(user):
+    """Hold the stock for ``user``'s cart until ``STOCK_RESERVATION_TIMEOUT`` seconds from now.
+
+    Called when checkout starts; calling it again extends the holds and
+    follows changes to the cart, but no hold outlives ``STOCK_RESERVATION_MAX_HOLD``
+    seconds from when it was first taken. Products that cannot be covered
+    keep whatever was held before and are returned, so the caller can tell
+    the user. Returns ``(short products, earliest expiry)``.
+    """
+    wanted = Counter()
+    for product_id, quantity in CartItem.objects.filter(user=user).values_list('product_id', 'quantity'):
+        wanted[product_id] += quantity
+    held = {product_id: (quantity, created_at) for product_id, quantity, created_at in
+            StockReservation.objects.select_for_update().filter(user=user)
+            .values_list('product_id', 'quantity', 'created_at')}
+
+    changes = {product_id: wanted[product_id] - held.get(product_id, (0, None))[0]
+               for product_id in wanted.keys() | held.keys()}
+    short = _apply_stock_changes(changes)
+    StockReservation.objects.filter(user=user).exclude(product_id__in=list(wanted)).delete()
+    holds = [StockReservation(user=user, product_id=product_id,
+                              quantity=held[product_id][0] if product_id in short else quantity,
+                              expires_at=reservation_deadline(held.get(product_id, (0, None))[1]))
+             for product_id, quantity in wanted.items() if product_id not in short or product_id in held]
+    # created_at is left alone on conflict, so it keeps marking when each hold started.
+    StockReservation.objects.bulk_create(holds, update_conflicts=True, unique_fields=['user', 'product'],
+                                         update_fields=['quantity', 'expires_at'])
+    expires_at = min((hold.expires_at for hold in holds), default=reservation_deadline())
+    return list(Product.objects.filter(pk__in=short).order_by('pk')), expires_at
+
+
+def checkout_status(user):
+    """Return ``(short products, earliest expiry of the holds or None)`` for ``user``'s cart without changing stock.
+
+    A product is short when free stock plus the user's own hold cannot cover the cart.
+    """
+    wanted = Counter()
+    for product_id, quantity in CartItem.objects.filter(user=user).values_list('product_id', 'quantity'):
+        wanted[product_id] += quantity
+    available = Counter(dict(Product.objects.filter(pk__in=list(wanted)).values_list('pk', 'quantity')))
+    holds = StockReservation.objects.filter(user=user, product_id__in=list(wanted))
+    expires_at = None
+    for product_id, quantity, hold_expires_at in holds.values_list('product_id', 'quantity', 'expires_at'):
+        available[product_id] += quantity
+        if expires_at is None or hold_expires_at < expires_at:
+            expires_at = hold_expires_at
+    short = [product_id for product_id in wanted if available[product_id] < wanted[product_id]]
+    return list(Product.objects.filter(pk__in=short).order_by('pk')), expires_at
+
+
+def commit_reservations(user, quantities):
+    """Take ``{product id: units}`` for an order from ``user``'s holds, topping up from free stock.
+
+    Holds are used up whether or not they have expired, as long as the sweep
+    has not released them yet; units held beyond what is ordered go back to
+    stock. Must run in the order's transaction. Returns the ids that were short.
+    """
+    held = dict(StockReservation.objects.select_for_update().filter(user=user).values_list('product_id', 'quantity'))
+    short = _apply_stock_changes({product_id: quantities.get(product_id, 0) - held.get(product_id, 0)
+                                  for product_id in quantities.keys() | held.keys()})
+    StockReservation.objects.filter(user=user).delete()
+    return short
+
+
+def release_expired_reservations(batch_size=500):
+    """Return the units of expired holds to stock and return how many holds were released.
+
+    Each batch is claimed and returned in one transaction; on PostgreSQL rows
+    locked by a checkout are skipped and left for the next sweep.
+    """
+    released = 0
+    while True:
+        with transaction.atomic():
+            expired = list(StockReservation.objects.select_for_update(skip_locked=True)
+                           .filter(expires_at__lte=now()).order_by('pk')
+                           .values_list('pk', 'product_id', 'quantity')[:batch_size])
+            if not expired:
+                return released
+            StockReservation.objects.filter(pk__in=[pk for pk, _, _ in expired]).delete()
+            changes = Counter()
+            for _, product_id, quantity in expired:
+                changes[product_id] -= quantity
+            _apply_stock_changes(changes)
+        released += len(expired)
+        if len(expired) < batch_size:
+            return released
+
+
+def available_to(user, product_ids):
+    """Return ``{product id: units}`` ``user`` may have in their cart: free stock plus their own holds."""
+    available = Counter(dict(Product.objects.filter(pk__in=product_ids).values_list('pk', 'quantity')))
+    available.update(dict(StockReservation.objects.filter(user=user, product_id__in=product_ids)
+                          .values_list('product_id', 'quantity')))
+    return available
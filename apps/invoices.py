@@ -0,0 +1,145 @@
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage
+from django.db import close_old_connections, connections
+from reportlab.lib.pagesizes import A4
+from reportlab.lib.units import mm
+from reportlab.pdfgen.canvas import Canvas
+
+from apps.models import Order
+
+logger = logging.getLogger(__name__)
+
+LINE_HEIGHT = 6 * mm
+MARGIN = 20 * mm
+
+
+def invoice_storage():
+    """Invoices carry names and addresses, so they live under ``INVOICE_ROOT``, outside ``MEDIA_ROOT``.
+
+    Nothing serves that folder directly; ``download_pdf`` checks the owner
+    and streams the file or hands it to an ``internal`` nginx location.
+    """
+    return FileSystemStorage(location=settings.INVOICE_ROOT)
+
+
+def invoice_dir(order_id):
+    return str(order_id)
+
+
+def invoice_name(order):
+    """Storage name of the invoice for the current state of ``order``; a changed order gets a new name."""
+    return f'{invoice_dir(order.pk)}/{order.updated_at:%Y%m%d%H%M%S%f}.pdf'
+
+
+def invoice_queryset():
+    return Order.objects.select_related('owner', 'address').prefetch_related('order_items__product')
+
+
+def render_invoice(order):
+    """Return the invoice PDF for ``order`` from the prices and totals stored at checkout."""
+    buffer = BytesIO()
+    canvas = Canvas(buffer, pagesize=A4, pageCompression=1)
+    canvas.setTitle(f'Invoice {order.pk}')
+    width, height = A4
+    columns = MARGIN, width - MARGIN - 75 * mm, width - MARGIN - 45 * mm, width - MARGIN - 20 * mm, width - MARGIN
+
+    def header():
+        canvas.setFont('Helvetica-Bold', 16)
+        canvas.drawString(MARGIN, height - MARGIN, f'Invoice #{order.pk}')
+        canvas.setFont('Helvetica', 10)
+        canvas.drawString(MARGIN, height - MARGIN - LINE_HEIGHT, f'Date: {order.created_at:%Y-%m-%d}')
+        canvas.drawString(MARGIN, height - MARGIN - 2 * LINE_HEIGHT,
+                          f'Payment: {order.get_payment_method_display()}   Status: {order.get_status_display()}')
+        address = order.address
+        canvas.drawString(MARGIN, height - MARGIN - 3 * LINE_HEIGHT,
+                          f'Bill to: {address.full_name}, {address.street}, {address.city} {address.zip_code}')
+        canvas.setFont('Helvetica-Bold', 10)
+        y = height - MARGIN - 5 * LINE_HEIGHT
+        canvas.drawString(columns[0], y, 'Product')
+        for x, title in zip(columns[2:], ('Price', 'Qty', 'Amount')):
+            canvas.drawRightString(x, y, title)
+        canvas.setFont('Helvetica', 10)
+        return y - LINE_HEIGHT
+
+    y = header()
+    for order_item in order.order_items.all():
+        if y < MARGIN + 5 * LINE_HEIGHT:
+            canvas.showPage()
+            y = header()
+        canvas.drawString(columns[0], y, order_item.product.name[:60])
+        canvas.drawRightString(columns[2], y, f'${order_item.price:,}')
+        canvas.drawRightString(columns[3], y, str(order_item.quantity))
+        canvas.drawRightString(columns[4], y, f'${order_item.amount:,}')
+        y -= LINE_HEIGHT
+
+    y -= LINE_HEIGHT
+    totals = [('Subtotal', order.subtotal), ('Shipping', order.shipping_cost),
+              (f'Tax ({order.tax_rate}%)', order.tax_amount), ('Total', order.total)]
+    for label, amount in totals:
+        canvas.setFont('Helvetica-Bold' if label == 'Total' else 'Helvetica', 10)
+        canvas.drawString(columns[1], y, label)
+        canvas.drawRightString(columns[4], y, f'${amount:,}')
+        y -= LINE_HEIGHT
+    canvas.save()
+    return buffer.getvalue()
+
+
+def get_invoice(order, storage=None):
+    """Return the storage name of the invoice for ``order``, rendering it only if it is missing.
+
+    Invoices for earlier versions of the order are deleted when a new one is written.
+    """
+    storage = storage or invoice_storage()
+    name = invoice_name(order)
+    if storage.exists(name):
+        return name
+    saved = storage.save(name, ContentFile(render_invoice(order)))
+    if saved != name:
+        # Another worker wrote the same invoice meanwhile; keep theirs.
+        storage.delete(saved)
+    try:
+        _, stale = storage.listdir(invoice_dir(order.pk))
+    except FileNotFoundError:
+        stale = []
+    for file_name in stale:
+        if f'{invoice_dir(order.pk)}/{file_name}' != name:
+            storage.delete(f'{invoice_dir(order.pk)}/{file_name}')
+    return name
+
+
+def build_invoices(order_ids):
+    count = 0
+    for order in invoice_queryset().filter(pk__in=order_ids):
+        get_invoice(order)
+        count += 1
+    return count
+
+
+def _build_in_worker(order_ids):
+    close_old_connections()
+    try:
+        return build_invoices(order_ids)
+    finally:
+        connections.close_all()
+
+
+def build_invoices_between(start, end, workers=1, chunk_size=200):
+    """Build the invoices of every order created in ``[start, end)`` and return how many were built.
+
+    With ``workers`` above one the orders are split into chunks rendered by a
+    process pool; each process opens its own database connection.
+    """
+    ids = list(Order.objects.filter(created_at__gte=start, created_at__lt=end).order_by('pk')
+               .values_list('pk', flat=True))
+    chunks = [ids[i:i + chunk_size] for i in range(0, len(ids), chunk_size)]
+    if workers <= 1:
+        return sum(map(build_invoices, chunks))
+    # Forked processes must not share the parent's connection.
+    connections.close_all()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return sum(pool.map(_build_in_worker, chunks))
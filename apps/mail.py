@@ -0,0 +1,165 @@
+import hashlib
+import logging
+import smtplib
+import time
+from datetime import timedelta
+from uuid import uuid4
+
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.db.models import Count, Q
+from django.utils.timezone import now
+
+from apps.models import OutgoingEmail
+
+logger = logging.getLogger(__name__)
+
+
+def make_dedupe_key(idempotency_key):
+    return hashlib.sha256(idempotency_key.encode()).hexdigest()
+
+
+def _over_hourly_limit(recipients):
+    limit = settings.EMAIL_RECIPIENT_HOURLY_LIMIT
+    if not limit:
+        return set()
+    recent = OutgoingEmail.objects.filter(recipient__in=recipients, created_at__gte=now() - timedelta(hours=1))
+    return set(recent.values('recipient').annotate(count=Count('id')).filter(count__gte=limit)
+               .values_list('recipient', flat=True))
+
+
+def queue_email(subject, body, recipients, from_email=None, dedupe_key=None):
+    """Store one message per recipient for the delivery worker and return how many were queued.
+
+    ``dedupe_key`` names the event the message is about, e.g.
+    ``'order-confirmation:42'``; a recipient who already has a message for
+    it is skipped, so retried tasks do not send it twice. Messages without
+    one are never deduplicated. Recipients that have reached
+    ``EMAIL_RECIPIENT_HOURLY_LIMIT`` messages in the last hour are skipped.
+    """
+    if isinstance(recipients, str):
+        recipients = [recipients]
+    recipients = list(dict.fromkeys(recipient.strip().lower() for recipient in recipients if recipient))
+    if dedupe_key:
+        key = make_dedupe_key(dedupe_key)
+        skipped = set(OutgoingEmail.objects.filter(recipient__in=recipients, dedupe_key=key)
+                      .values_list('recipient', flat=True))
+    else:
+        key, skipped = uuid4().hex, set()
+    limited = _over_hourly_limit(recipients)
+    if limited:
+        logger.warning('Not queueing %r for %d recipients over the hourly limit', subject, len(limited))
+
+    emails = [
+        OutgoingEmail(recipient=recipient, subject=subject, body=body, dedupe_key=key,
+                      from_email=from_email or settings.EMAIL_HOST_USER or settings.DEFAULT_FROM_EMAIL)
+        for recipient in recipients if recipient not in skipped | limited
+    ]
+    # A concurrent call may queue the same message first; the unique constraint keeps one copy.
+    OutgoingEmail.objects.bulk_create(emails, ignore_conflicts=True)
+    return len(emails)
+
+
+def _due():
+    current = now()
+    stale = current - timedelta(seconds=settings.EMAIL_CLAIM_TIMEOUT)
+    return (Q(status=OutgoingEmail.Status.PENDING, next_attempt_at__lte=current)
+            | Q(status=OutgoingEmail.Status.SENDING, claimed_at__lt=stale))
+
+
+def due_emails():
+    """Messages ready for a delivery attempt, oldest first."""
+    return OutgoingEmail.objects.filter(_due()).order_by('next_attempt_at', 'pk')
+
+
+def claim_batch(batch_size):
+    """Mark up to ``batch_size`` due messages as ours and return them.
+
+    Rows sent by a worker that died mid-batch become due again after
+    ``EMAIL_CLAIM_TIMEOUT`` seconds. The claim is a conditional UPDATE, so
+    concurrent workers never get the same row.
+    """
+    token = uuid4().hex
+    due = list(due_emails().values_list('pk', flat=True)[:batch_size])
+    if not due:
+        return []
+    OutgoingEmail.objects.filter(_due(), pk__in=due).update(
+        status=OutgoingEmail.Status.SENDING, claim=token, claimed_at=now())
+    return list(OutgoingEmail.objects.filter(claim=token, status=OutgoingEmail.Status.SENDING).order_by('pk'))
+
+
+def _retry(emails):
+    current = now()
+    for email, error in emails:
+        email.attempts += 1
+        email.last_error = str(error)[:1000]
+        email.claim = ''
+        if email.attempts >= settings.EMAIL_MAX_ATTEMPTS:
+            email.status = OutgoingEmail.Status.FAILED
+        else:
+            email.status = OutgoingEmail.Status.PENDING
+            delay = settings.EMAIL_RETRY_BACKOFF * 2 ** (email.attempts - 1)
+            email.next_attempt_at = current + timedelta(seconds=delay)
+    OutgoingEmail.objects.bulk_update([email for email, _ in emails],
+                                      ['attempts', 'last_error', 'claim', 'status', 'next_attempt_at'])
+
+
+def _send(emails, connection, throttle):
+    sent, failed = [], []
+    for email in emails:
+        throttle()
+        message = EmailMessage(email.subject, email.body, email.from_email, [email.recipient], connection=connection)
+        try:
+            delivered = connection.send_messages([message])
+        except (smtplib.SMTPException, OSError) as e:
+            failed.append((email, e))
+            # Start the next message on a fresh connection in case this one is broken.
+            connection.close()
+            try:
+                connection.open()
+            except (smtplib.SMTPException, OSError):
+                pass
+        else:
+            if delivered:
+                sent.append(email)
+            else:
+                failed.append((email, 'backend did not send the message'))
+    OutgoingEmail.objects.filter(pk__in=[email.pk for email in sent]).update(
+        status=OutgoingEmail.Status.SENT, sent_at=now(), claim='', last_error='')
+    if failed:
+        _retry(failed)
+    return len(sent), len(failed)
+
+
+def deliver_queued(batch_size=None, max_messages=None, connection=None, rate=None):
+    """Send due messages in batches over one connection and return ``(sent, failed)``.
+
+    Sending is paced to ``rate`` (default ``EMAIL_RATE_LIMIT``) messages per second. Failed
+    messages are retried with exponential backoff until ``EMAIL_MAX_ATTEMPTS``.
+    """
+    batch_size = batch_size or settings.EMAIL_BATCH_SIZE
+    rate = settings.EMAIL_RATE_LIMIT if rate is None else rate
+    started, handled = time.monotonic(), 0
+
+    def throttle():
+        nonlocal handled
+        if rate and (wait := handled / rate - (time.monotonic() - started)) > 0:
+            time.sleep(wait)
+        handled += 1
+
+    sent = failed = 0
+
+    def next_batch():
+        if max_messages is not None and sent + failed >= max_messages:
+            return []
+        return claim_batch(batch_size if max_messages is None else min(batch_size, max_messages - sent - failed))
+
+    # Claim before connecting, so polling an empty queue never logs in to the mail server.
+    if not (emails := next_batch()):
+        return sent, failed
+    with connection or get_connection() as connection:
+        while emails:
+            batch_sent, batch_failed = _send(emails, connection, throttle)
+            sent, failed = sent + batch_sent, failed + batch_failed
+            emails = next_batch()
+    return sent, failed
@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from apps.cache import get_site_settings
+from apps.models import Order, OrderItem
+
+
+class Command(BaseCommand):
+    help = 'Store prices and totals on orders placed before they were recorded at checkout'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', help='Recompute every order, not only those without totals')
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        orders = Order.objects.order_by('pk').prefetch_related('order_items__product')
+        if not options['all']:
+            orders = orders.filter(total=0)
+        tax_rate = get_site_settings().tax
+
+        last_pk, updated = 0, 0
+        while batch := list(orders.filter(pk__gt=last_pk)[:options['batch_size']]):
+            order_items = []
+            for order in batch:
+                for order_item in order.order_items.all():
+                    if not order_item.unit_price:
+                        order_item.set_prices(order_item.product)
+                    order_items.append(order_item)
+                order.set_totals(order.order_items.all(), order.tax_rate if order.total else tax_rate)
+
+            with transaction.atomic():
+                OrderItem.objects.bulk_update(order_items, ['unit_price', 'discount', 'shipping_cost'])
+                Order.objects.bulk_update(batch, ['subtotal', 'shipping_cost', 'tax_rate', 'tax_amount', 'total'])
+            last_pk = batch[-1].pk
+            updated += len(batch)
+
+        self.stdout.write(self.style.SUCCESS(f'Updated totals for {updated} orders'))
@@ -0,0 +1,93 @@
+import json
+import tempfile
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import override_settings
+
+from apps.benchmarks import FLOWS, ShopBenchmark, compare, seed
+from apps.models import Product
+from root.celery import app as celery_app
+
+
+class Command(BaseCommand):
+    help = ('Time the main shop flows against a seeded benchmark database and fail when they regress against the '
+            'stored baseline. The database is kept between runs, so only the first run seeds.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--products', type=int, default=100_000)
+        parser.add_argument('--users', type=int, default=50)
+        parser.add_argument('--seed', type=int, default=22)
+        parser.add_argument('--iterations', type=int, default=100, help='Passes over every flow')
+        parser.add_argument('--warmup', type=int, default=3, help='Passes run before timing starts')
+        parser.add_argument('--database', default=str(settings.BASE_DIR / 'benchmark.sqlite3'),
+                            help='SQLite file for the benchmark data; other engines use their test database')
+        parser.add_argument('--reseed', action='store_true', help='Drop the benchmark database and seed it again')
+        parser.add_argument('--baseline', default=str(settings.BASE_DIR / 'benchmark-baseline.json'))
+        parser.add_argument('--save-baseline', action='store_true', help='Store this run as the new baseline')
+        parser.add_argument('--tolerance', type=float, default=1.5, help='Allowed p95 growth over the baseline')
+
+    def handle(self, *args, **options):
+        params = {key: options[key] for key in ('products', 'users', 'seed')}
+        if connection.vendor == 'sqlite':
+            connection.settings_dict['TEST']['NAME'] = options['database']
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False,
+                                           keepdb=not options['reseed'])
+        try:
+            self.prepare(params)
+            results = self.run(options)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0, keepdb=True)
+        self.report(results)
+        self.check_baseline(params, results, options)
+
+    def prepare(self, params):
+        count = Product.objects.count()
+        if count == 0:
+            self.stdout.write(f'Seeding {params["products"]} products and {params["users"]} users...')
+            # DEBUG would keep every seeding query in memory.
+            with override_settings(DEBUG=False):
+                seed(params['products'], params['users'], seed=params['seed'],
+                     progress=lambda importer: self.stdout.write(f'  {importer.imported} products', ending='\r'))
+            self.stdout.write('')
+        elif count < params['products']:
+            raise CommandError(f'The benchmark database has {count} products, not {params["products"]}; '
+                               f'run with --reseed')
+
+    def run(self, options):
+        # Order confirmation runs inline, as a worker would, without writing into the real media folder.
+        celery_app.conf.update(CELERY_TASK_ALWAYS_EAGER=True)
+        with tempfile.TemporaryDirectory() as media, override_settings(
+                MEDIA_ROOT=media, INVOICE_ROOT=media, EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend'):
+            benchmark = ShopBenchmark(options['seed'])
+            return benchmark.run(options['iterations'], options['warmup'])
+
+    def report(self, results):
+        self.stdout.write(f'  {"flow":<16} {"requests":>8} {"req/s":>8} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8} '
+                          f'{"queries":>8} {"errors":>7}')
+        for flow in FLOWS:
+            if result := results.get(flow):
+                self.stdout.write(f'  {flow:<16} {result["requests"]:>8} {result["rps"]:>8.1f} '
+                                  f'{result["p50_ms"]:>8.1f} {result["p95_ms"]:>8.1f} {result["p99_ms"]:>8.1f} '
+                                  f'{result["queries"]:>8} {result["errors"]:>7}')
+
+    def check_baseline(self, params, results, options):
+        if options['save_baseline']:
+            with open(options['baseline'], 'w') as stream:
+                json.dump({'params': params, 'flows': results}, stream, indent=2, sort_keys=True)
+                stream.write('\n')
+            self.stdout.write(self.style.SUCCESS(f'Saved the baseline to {options["baseline"]}'))
+            return
+        try:
+            with open(options['baseline']) as stream:
+                baseline = json.load(stream)
+        except FileNotFoundError:
+            self.stdout.write(self.style.WARNING(f'No baseline at {options["baseline"]}; run with --save-baseline'))
+            baseline = {'params': params, 'flows': {}}
+        if baseline['params'] != params:
+            raise CommandError(f'The baseline was recorded with {baseline["params"]}, not {params}')
+        if regressions := compare(results, baseline['flows'], options['tolerance']):
+            raise CommandError('Regressions against the baseline:\n  ' + '\n  '.join(regressions))
+        self.stdout.write(self.style.SUCCESS('No regressions against the baseline'))
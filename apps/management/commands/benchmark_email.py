@@ -0,0 +1,71 @@
+import time
+
+from django.core.mail import EmailMessage
+from django.core.mail.backends.locmem import EmailBackend
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from apps.mail import deliver_queued, queue_email
+
+
+class SlowConnectBackend(EmailBackend):
+    """In-memory backend that sleeps on every ``open()`` like an SMTP handshake would."""
+
+    latency = 0
+    opened = 0
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.is_open = False
+
+    def open(self):
+        if self.is_open:
+            return False
+        time.sleep(self.latency)
+        type(self).opened += 1
+        self.is_open = True
+        return True
+
+    def close(self):
+        self.is_open = False
+
+    def send_messages(self, messages):
+        new_connection = self.open()
+        try:
+            return super().send_messages(messages)
+        finally:
+            if new_connection:
+                self.close()
+
+
+class Command(BaseCommand):
+    help = 'Compare one connection per message with the queued batch delivery; queued rows are rolled back'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--count', type=int, default=500)
+        parser.add_argument('--latency', type=float, default=20, help='Milliseconds to open one connection')
+        parser.add_argument('--batch-size', type=int, default=100)
+
+    def report(self, label, count, elapsed):
+        self.stdout.write(f'  {label:<26} {count:>6} messages  {elapsed:8.2f} s  {count / elapsed:9.1f} msg/s  '
+                          f'{SlowConnectBackend.opened:>6} connections')
+
+    def handle(self, *args, **options):
+        count = options['count']
+        SlowConnectBackend.latency = options['latency'] / 1000
+        recipients = [f'benchmark-{i}@example.com' for i in range(count)]
+
+        SlowConnectBackend.opened = 0
+        started = time.perf_counter()
+        for recipient in recipients:
+            EmailMessage('Benchmark', 'Body', 'shop@example.com', [recipient],
+                         connection=SlowConnectBackend()).send()
+        self.report('connection per message', count, time.perf_counter() - started)
+
+        with transaction.atomic():
+            SlowConnectBackend.opened = 0
+            started = time.perf_counter()
+            queue_email('Benchmark', 'Body', recipients, from_email='shop@example.com')
+            sent, failed = deliver_queued(batch_size=options['batch_size'], connection=SlowConnectBackend(), rate=0)
+            self.report('queue + batched delivery', sent, time.perf_counter() - started)
+            transaction.set_rollback(True)
@@ -0,0 +1,86 @@
+import random
+import sqlite3
+import statistics
+import time
+
+from django.core.management.base import BaseCommand
+
+from apps.search import InvertedIndex, fts_query, NAME_WEIGHT
+
+BRANDS = ['apple', 'samsung', 'xiaomi', 'huawei', 'lenovo', 'asus', 'acer', 'sony', 'lg', 'nokia']
+KINDS = ['phone', 'laptop', 'tablet', 'monitor', 'headphones', 'watch', 'camera', 'speaker', 'router', 'charger']
+WORDS = ['wireless', 'pro', 'max', 'ultra', 'lite', 'mini', 'plus', 'gaming', 'business', 'portable', 'fast',
+         'display', 'battery', 'memory', 'storage', 'black', 'white', 'silver', 'blue', 'red', 'aluminium',
+         'waterproof', 'bluetooth', 'usb', 'hdmi', 'oled', 'amoled', 'retina', 'dual', 'quad']
+SPECS = ['4GB', '8GB', '16GB', '32GB', '128GB', '256GB', '512GB', '1TB', '60Hz', '120Hz', '144Hz', '5G', 'WiFi6']
+
+
+def synthetic_products(count, rng):
+    for product_id in range(1, count + 1):
+        name = f'{rng.choice(BRANDS)} {rng.choice(KINDS)} {rng.choice(WORDS)} {product_id}'
+        body = ' '.join(rng.choices(WORDS, k=30) + rng.choices(SPECS, k=5))
+        yield product_id, name, body
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+class Command(BaseCommand):
+    help = 'Benchmark product search over a synthetic catalog without touching the database'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--products', type=int, default=100_000)
+        parser.add_argument('--queries', type=int, default=500)
+        parser.add_argument('--seed', type=int, default=22)
+
+    def report(self, label, samples):
+        self.stdout.write(f'  {label:<14} mean {statistics.mean(samples) * 1000:7.2f} ms   '
+                          f'p95 {percentile(samples, 0.95) * 1000:7.2f} ms')
+
+    def run_queries(self, search, queries, prefix):
+        samples = []
+        for query in queries:
+            started = time.perf_counter()
+            search(query, prefix)
+            samples.append(time.perf_counter() - started)
+        return samples
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        documents = list(synthetic_products(options['products'], rng))
+        queries = [f'{rng.choice(BRANDS)} {rng.choice(KINDS)}' for _ in range(options['queries'])]
+        prefixes = [rng.choice(WORDS)[:3] for _ in range(options['queries'])]
+        self.stdout.write(f'{len(documents)} synthetic products, {len(queries)} queries')
+
+        index = InvertedIndex()
+        started = time.perf_counter()
+        for document in documents:
+            index.index(*document)
+        self.stdout.write(f'python index: built in {time.perf_counter() - started:.2f} s, {len(index.postings)} terms')
+
+        def search(query, prefix):
+            return index.search(query, 20, prefix=prefix)
+
+        self.report('search', self.run_queries(search, queries, False))
+        self.report('autocomplete', self.run_queries(search, prefixes, True))
+
+        conn = sqlite3.connect(':memory:')
+        try:
+            conn.execute("CREATE VIRTUAL TABLE fts USING fts5(name, body, prefix = '2 3')")
+        except sqlite3.OperationalError:
+            self.stdout.write('sqlite fts5: not available')
+            return
+        started = time.perf_counter()
+        conn.executemany('INSERT INTO fts (rowid, name, body) VALUES (?, ?, ?)', documents)
+        conn.commit()
+        self.stdout.write(f'sqlite fts5: built in {time.perf_counter() - started:.2f} s')
+
+        def fts_search(query, prefix):
+            if match := fts_query(query, prefix):
+                sql = f'SELECT rowid FROM fts WHERE fts MATCH ? ORDER BY bm25(fts, {NAME_WEIGHT}.0, 1.0) LIMIT 20'
+                return conn.execute(sql, [match]).fetchall()
+
+        self.report('search', self.run_queries(fts_search, queries, False))
+        self.report('autocomplete', self.run_queries(fts_search, prefixes, True))
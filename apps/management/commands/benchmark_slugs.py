@@ -0,0 +1,59 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.models import Max
+from django.utils.text import slugify
+
+from apps.models import Category
+from apps.slugs import allocate_slug, assign_slugs
+
+
+class Command(BaseCommand):
+    help = 'Benchmark slug allocation for categories sharing one name; all rows are rolled back'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--count', type=int, default=10_000)
+        parser.add_argument('--legacy-count', type=int, default=300,
+                            help='Rows for the old exists() loop, which is quadratic')
+        parser.add_argument('--name', default='Benchmark Duplicate')
+
+    def report(self, label, count, elapsed, queries):
+        self.stdout.write(f'  {label:<22} {count:>6} rows  {elapsed:8.2f} s  '
+                          f'{elapsed / count * 1000:7.3f} ms/row  {queries / count:6.2f} queries/row')
+
+    def new_roots(self, count, tree_id):
+        return [Category(name=self.name, tree_id=tree_id + i, lft=1, rght=2, level=0) for i in range(1, count + 1)]
+
+    def measure(self, label, count, insert):
+        with transaction.atomic():
+            tree_id = Category.objects.aggregate(tree_id=Max('tree_id'))['tree_id'] or 0
+            queries = []
+            with connection.execute_wrapper(lambda execute, *args: queries.append(1) or execute(*args)):
+                started = time.perf_counter()
+                insert(self.new_roots(count, tree_id))
+                elapsed = time.perf_counter() - started
+            transaction.set_rollback(True)
+        self.report(label, count, elapsed, len(queries))
+
+    def legacy(self, categories):
+        for category in categories:
+            category.slug = slugify(category.name)
+            while Category.objects.filter(slug=category.slug).exists():
+                category.slug += '-1'
+            Category.objects.bulk_create([category])
+
+    def one_by_one(self, categories):
+        for category in categories:
+            category.slug = allocate_slug(Category, category.name)
+            Category.objects.bulk_create([category])
+
+    def bulk(self, categories):
+        Category.objects.bulk_create(assign_slugs(categories), batch_size=1000)
+
+    def handle(self, *args, **options):
+        self.name = options['name']
+        self.stdout.write(f'Inserting categories named {self.name!r}')
+        self.measure('legacy exists() loop', options['legacy_count'], self.legacy)
+        self.measure('allocate_slug', options['count'], self.one_by_one)
+        self.measure('assign_slugs + bulk', options['count'], self.bulk)
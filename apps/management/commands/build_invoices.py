@@ -0,0 +1,33 @@
+import os
+import time
+from datetime import datetime, time as day_start, timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.timezone import make_aware
+
+from apps.invoices import build_invoices_between
+
+
+def parse_date(value):
+    try:
+        return make_aware(datetime.combine(datetime.strptime(value, '%Y-%m-%d').date(), day_start.min))
+    except ValueError:
+        raise CommandError(f'Expected a YYYY-MM-DD date, got {value!r}')
+
+
+class Command(BaseCommand):
+    help = 'Render the missing invoice PDFs of orders created between two dates (inclusive)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('since', help='First day, YYYY-MM-DD')
+        parser.add_argument('until', help='Last day, YYYY-MM-DD')
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+        parser.add_argument('--chunk-size', type=int, default=200)
+
+    def handle(self, *args, **options):
+        start, end = parse_date(options['since']), parse_date(options['until']) + timedelta(days=1)
+        if end <= start:
+            raise CommandError('until must not be before since')
+        started = time.perf_counter()
+        count = build_invoices_between(start, end, workers=options['workers'], chunk_size=options['chunk_size'])
+        self.stdout.write(self.style.SUCCESS(f'Built {count} invoices in {time.perf_counter() - started:.1f}s'))
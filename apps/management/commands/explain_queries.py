@@ -0,0 +1,81 @@
+import re
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.http import HttpRequest
+
+from apps.categories import subtree_filter
+from apps.facets import filter_by_facets
+from apps.mail import due_emails
+from apps.models import Category, CartItem, Favorite, Product, ProductSpec, User
+from apps.views import CartListView, OrderDetailView, OrderListView, ProductListView
+
+# SQLite reports "SCAN table" for a full table walk and "SCAN table USING INDEX" for an index walk.
+FULL_SCAN = re.compile(r'\bSCAN (\S+)$|\bSeq Scan on (\S+)')
+TEMP_SORT = re.compile(r'USE TEMP B-TREE FOR (ORDER BY|GROUP BY|DISTINCT)')
+
+
+class Command(BaseCommand):
+    help = 'Print EXPLAIN output for the main querysets of the app and flag full table scans'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--fail-on-scan', action='store_true', help='Exit with an error if any query scans a table')
+
+    def view_queryset(self, view_class, user, path='/', **kwargs):
+        request = HttpRequest()
+        request.method, request.path, request.user = 'GET', path, user
+        view = view_class()
+        view.setup(request, **kwargs)
+        return view.get_queryset()
+
+    def querysets(self, user, product, category):
+        category_node = {'id': category.pk, 'tree_id': category.tree_id, 'lft': category.lft, 'rght': category.rght}
+        return [
+            ('product list', self.view_queryset(ProductListView, user)[:2]),
+            ('category product list',
+             Product.objects.for_listing().filter(category=category).order_by('-created_at')[:2]),
+            ('category subtree list',
+             Product.objects.for_listing().filter(**subtree_filter(category_node)).order_by('-created_at')[:2]),
+            ('facet filter', filter_by_facets(Product.objects.all(), {'RAM': ['8GB']})[:2]),
+            ('facet counts', ProductSpec.objects.filter(**subtree_filter(category_node, 'product__category__'))
+             .values_list('key', 'value').order_by('key', 'value')),
+            ('product detail', Product.objects.for_detail().filter(pk=product.pk)),
+            ('add to cart lookup', CartItem.objects.filter(user=user, product=product)),
+            ('cart', self.view_queryset(CartListView, user)),
+            ('liked product ids', Favorite.objects.filter(user=user).values_list('product_id', flat=True)),
+            ('favourite lookup', Favorite.objects.filter(user=user, product=product)),
+            ('order list', self.view_queryset(OrderListView, user).order_by('-created_at', '-id')[:11]),
+            ('order detail', self.view_queryset(OrderDetailView, user).filter(pk=1)),
+            ('due emails', due_emails()[:100]),
+        ]
+
+    def sample_rows(self):
+        user = User.objects.filter(is_staff=False).first() or User.objects.create_user('explain-queries')
+        category = Category.objects.first() or Category.objects.create(name='Explain queries')
+        product = Product.objects.first() or Product.objects.create(
+            name='Explain queries', category=category, price=1, info='', descriptions='')
+        return user, product, category
+
+    def handle(self, *args, **options):
+        flagged = []
+        with transaction.atomic():
+            # Sample rows created here are rolled back.
+            user, product, category = self.sample_rows()
+            for label, queryset in self.querysets(user, product, category):
+                plan = queryset.explain()
+                scans = [name for line in plan.splitlines() for match in FULL_SCAN.finditer(line)
+                         for name in match.groups() if name]
+                sorts = TEMP_SORT.findall(plan)
+                status = self.style.ERROR('FULL SCAN ' + ', '.join(scans)) if scans else self.style.SUCCESS('ok')
+                self.stdout.write(f'{label}: {status}{"  (temp sort)" if sorts else ""}')
+                if options['verbosity'] > 1 or scans:
+                    self.stdout.write(f'  {queryset.query}\n' if options['verbosity'] > 2 else '', ending='')
+                    for line in plan.splitlines():
+                        self.stdout.write(f'    {line}')
+                if scans:
+                    flagged.append(label)
+            transaction.set_rollback(True)
+
+        self.stdout.write(f'{len(flagged)} queries scan a whole table on {connection.vendor}')
+        if flagged and options['fail_on_scan']:
+            raise CommandError(f'Full table scans in: {", ".join(flagged)}')
@@ -0,0 +1,39 @@
+import sys
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from apps.catalog import FORMATS, CatalogError, CatalogWriter, detect_format, export_records
+
+
+class Command(BaseCommand):
+    help = 'Stream every product with its category path, tags, images and specification to CSV or JSON Lines'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="Output file, or '-' for stdout")
+        parser.add_argument('--format', choices=FORMATS)
+        parser.add_argument('--batch-size', type=int, default=2000)
+
+    def handle(self, *args, **options):
+        path = options['path']
+        try:
+            fmt = detect_format(path, options['format'] or ('jsonl' if path == '-' else None))
+        except CatalogError as e:
+            raise CommandError(e)
+
+        started = time.perf_counter()
+        stream = sys.stdout if path == '-' else open(path, 'w', newline='', encoding='utf-8')
+        try:
+            writer = CatalogWriter(stream, fmt)
+            count = 0
+            for record in export_records(options['batch_size']):
+                writer.write(record)
+                count += 1
+        finally:
+            if stream is not sys.stdout:
+                stream.close()
+
+        elapsed = time.perf_counter() - started
+        self.stderr.write(self.style.SUCCESS(
+            f'Exported {count} products in {elapsed:.1f}s ({count / max(elapsed, 1e-9):.0f}/s)'
+        ))
@@ -0,0 +1,36 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db.models import F
+
+from apps.images import generate_renditions
+from apps.models import ProductImage
+from apps.tasks import generate_image_renditions
+
+
+class Command(BaseCommand):
+    help = 'Create the resized copies of product images that do not have them yet'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--force', action='store_true', help='Regenerate every image, replacing existing copies')
+        parser.add_argument('--sync', action='store_true', help='Resize in this process instead of queueing tasks')
+        parser.add_argument('--batch-size', type=int, default=100)
+
+    def handle(self, *args, **options):
+        images = ProductImage.objects.exclude(image='').order_by('pk')
+        if not options['force']:
+            images = images.exclude(rendered_from=F('image'))
+
+        started, count = time.perf_counter(), 0
+        last_pk = 0
+        while batch := list(images.filter(pk__gt=last_pk)[:options['batch_size']]):
+            if options['sync']:
+                for product_image in batch:
+                    generate_renditions(product_image, options['force'])
+            else:
+                generate_image_renditions.delay([product_image.pk for product_image in batch], options['force'])
+            last_pk = batch[-1].pk
+            count += len(batch)
+
+        action = 'Processed' if options['sync'] else 'Queued'
+        self.stdout.write(self.style.SUCCESS(f'{action} {count} images in {time.perf_counter() - started:.1f}s'))
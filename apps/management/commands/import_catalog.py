@@ -0,0 +1,46 @@
+import sys
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from apps.catalog import FORMATS, CatalogError, CatalogImporter, detect_format, read_records
+
+
+class Command(BaseCommand):
+    help = 'Create or update products, categories, tags and images from a CSV or JSON Lines catalog file'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="Catalog file, or '-' for stdin")
+        parser.add_argument('--format', choices=FORMATS)
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        path = options['path']
+        try:
+            fmt = detect_format(path, options['format'] or ('jsonl' if path == '-' else None))
+        except CatalogError as e:
+            raise CommandError(e)
+
+        importer = CatalogImporter(batch_size=options['batch_size'])
+        started = time.perf_counter()
+
+        def progress(importer):
+            if options['verbosity'] > 1:
+                elapsed = time.perf_counter() - started
+                self.stdout.write(f'{importer.imported} products, {importer.imported / elapsed:.0f}/s')
+
+        stream = sys.stdin if path == '-' else open(path, newline='', encoding='utf-8')
+        try:
+            importer.run(read_records(stream, fmt), progress)
+        except CatalogError as e:
+            raise CommandError(f'{e} ({importer.imported} products imported before the error)')
+        finally:
+            if stream is not sys.stdin:
+                stream.close()
+
+        elapsed = time.perf_counter() - started
+        rate = importer.imported / max(elapsed, 1e-9)
+        self.stdout.write(self.style.SUCCESS(
+            f'Imported {importer.imported} products in {elapsed:.1f}s ({rate:.0f}/s), '
+            f'created {importer.created_categories} categories and {importer.created_tags} tags'
+        ))
@@ -0,0 +1,143 @@
+import asyncio
+import os
+import shutil
+import statistics
+import subprocess
+import tempfile
+import time
+from urllib.parse import urlencode
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test import Client
+from django.urls import reverse
+
+from apps.models import CartItem, Category, Product, User
+
+USER_PREFIX = 'loadtest-'
+SERVERS = {
+    'wsgi': ['gunicorn', 'root.wsgi:application', '--workers', '{workers}', '--bind', 'unix:{socket}'],
+    'asgi': ['uvicorn', 'root.asgi:application', '--workers', '{workers}', '--uds', '{socket}', '--no-access-log'],
+}
+
+
+class Command(BaseCommand):
+    help = ('Start the WSGI and ASGI servers on a unix socket with the same number of workers and compare req/s and '
+            'latency of the JSON endpoints under fast and slow clients; the rows it creates are deleted afterwards')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--servers', nargs='+', choices=sorted(SERVERS), default=['wsgi', 'asgi'])
+        parser.add_argument('--workers', type=int, default=2, help='Server processes')
+        parser.add_argument('--concurrency', type=int, default=32, help='Clients sending requests back to back')
+        parser.add_argument('--slow-clients', type=int, default=8,
+                            help='Clients that pause between the request line and the rest of the request')
+        parser.add_argument('--slow-delay', type=float, default=0.5, help='Seconds a slow client pauses')
+        parser.add_argument('--duration', type=float, default=10, help='Seconds to run against each server')
+
+    def setup(self):
+        category = Category.objects.create(name='Load test')
+        # Saved one by one so the search index picks them up.
+        products = [Product.objects.create(name=f'Loadtest product {i}', category=category, price=1000, quantity=10,
+                                           info='', descriptions='', specification={})
+                    for i in range(50)]
+        user = User.objects.create_user(f'{USER_PREFIX}asgi', password='x')
+        CartItem.objects.bulk_create([CartItem(user=user, product=product, quantity=2) for product in products[:5]])
+        client = Client()
+        client.force_login(user)
+        session = client.cookies[settings.SESSION_COOKIE_NAME].value
+        paths = [
+            (reverse('catalog_json'), None),
+            (f'{reverse("category_catalog_json", args=[category.slug])}?{urlencode({"page": 2})}', None),
+            (f'{reverse("search_autocomplete")}?{urlencode({"q": "loadt"})}', None),
+            (reverse('cart_summary'), f'{settings.SESSION_COOKIE_NAME}={session}'),
+        ]
+        return category, paths
+
+    def start_server(self, name, socket, workers, probe):
+        command = [part.format(workers=workers, socket=socket) for part in SERVERS[name]]
+        if shutil.which(command[0]) is None:
+            raise CommandError(f'{command[0]} is not installed; pip install -r requarements.txt')
+        process = subprocess.Popen(command, cwd=settings.BASE_DIR, stdout=subprocess.DEVNULL,
+                                   stderr=subprocess.DEVNULL, env={**os.environ, 'PYTHONPATH': str(settings.BASE_DIR)})
+        # The socket is bound before the workers have loaded Django, so wait for a real response.
+        deadline = time.monotonic() + 60
+        while True:
+            try:
+                if asyncio.run(self.request(socket, probe, None, 0)) == 200:
+                    return process
+            except (OSError, ValueError, IndexError):
+                pass
+            if process.poll() is not None or time.monotonic() > deadline:
+                process.kill()
+                raise CommandError(f'{name} server did not start: {" ".join(command)}')
+            time.sleep(0.2)
+
+    async def request(self, socket, path, cookie, pause):
+        reader, writer = await asyncio.open_unix_connection(socket)
+        try:
+            writer.write(f'GET {path} HTTP/1.1\r\n'.encode())
+            if pause:
+                await writer.drain()
+                await asyncio.sleep(pause)
+            headers = ['Host: localhost', 'Connection: close'] + ([f'Cookie: {cookie}'] if cookie else [])
+            writer.write(''.join(f'{header}\r\n' for header in headers).encode() + b'\r\n')
+            await writer.drain()
+            response = await reader.read()
+            return int(response.split(b' ', 2)[1])
+        finally:
+            writer.close()
+
+    async def client(self, socket, paths, offset, pause, deadline, samples):
+        i = offset
+        while time.monotonic() < deadline:
+            path, cookie = paths[i % len(paths)]
+            started = time.perf_counter()
+            try:
+                status = await asyncio.wait_for(self.request(socket, path, cookie, pause), 30)
+            except (OSError, asyncio.TimeoutError, ValueError, IndexError):
+                status = 599
+            samples.append((time.perf_counter() - started - pause, status))
+            i += 1
+
+    async def run_load(self, socket, paths, options):
+        fast, slow = [], []
+        deadline = time.monotonic() + options['duration']
+        await asyncio.gather(
+            *(self.client(socket, paths, i, 0, deadline, fast) for i in range(options['concurrency'])),
+            *(self.client(socket, paths, i, options['slow_delay'], deadline, slow)
+              for i in range(options['slow_clients'])),
+        )
+        return fast, slow
+
+    def report(self, label, samples, elapsed):
+        if not samples:
+            self.stdout.write(f'  {label:<14} no requests finished')
+            return
+        durations = sorted(duration * 1000 for duration, _ in samples)
+        errors = sum(status != 200 for _, status in samples)
+        p99 = durations[max(0, round(len(durations) * 0.99) - 1)]
+        self.stdout.write(f'  {label:<14} {len(samples):>6} requests  {len(samples) / elapsed:8.1f} req/s  '
+                          f'p50 {statistics.median(durations):7.1f} ms  p99 {p99:7.1f} ms  {errors:>4} errors')
+
+    def handle(self, *args, **options):
+        category, paths = self.setup()
+        try:
+            for name in options['servers']:
+                with tempfile.TemporaryDirectory() as directory:
+                    socket = os.path.join(directory, f'{name}.sock')
+                    process = self.start_server(name, socket, options['workers'], paths[0][0])
+                    try:
+                        started = time.perf_counter()
+                        fast, slow = asyncio.run(self.run_load(socket, paths, options))
+                        elapsed = time.perf_counter() - started
+                    finally:
+                        process.terminate()
+                        process.wait(30)
+                self.stdout.write(f'{name} ({options["workers"]} workers, {options["concurrency"]} clients, '
+                                  f'{options["slow_clients"]} slow):')
+                self.report('clients', fast, elapsed)
+                self.report('slow clients', slow, elapsed)
+        finally:
+            User.objects.filter(username__startswith=USER_PREFIX).delete()
+            Product.objects.filter(category=category).delete()
+            category.delete()
@@ -0,0 +1,111 @@
+import json
+import statistics
+import tempfile
+import threading
+import time
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections, connection
+from django.test import Client
+from django.test.utils import override_settings
+from django.urls import reverse
+
+from apps.models import Address, Category, Product, User
+from root.celery import app as celery_app
+
+USER_PREFIX = 'loadtest-'
+
+
+class Command(BaseCommand):
+    help = ('Run concurrent cart and checkout requests against the configured database profile '
+            '(DB_ENGINE, SQLITE_TUNING); the rows it creates are deleted afterwards')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=8, help='Concurrent clients')
+        parser.add_argument('--rounds', type=int, default=20, help='Add, update, view and checkout cycles per client')
+
+    def describe_profile(self):
+        settings_dict = connection.settings_dict
+        self.stdout.write(f'Database: {connection.vendor} {settings_dict["NAME"]}  '
+                          f'CONN_MAX_AGE={settings_dict["CONN_MAX_AGE"]}')
+        if connection.vendor == 'sqlite':
+            with connection.cursor() as cursor:
+                pragmas = {name: cursor.execute(f'PRAGMA {name}').fetchone()[0] for name in settings.SQLITE_PRAGMAS}
+            mode = settings_dict['OPTIONS'].get('transaction_mode')
+            self.stdout.write(f'PRAGMAs: {pragmas}  transaction mode: {mode}')
+
+    def setup(self, count):
+        category = Category.objects.create(name='Load test')
+        product = Product.objects.create(name='Load test product', category=category, price=1000,
+                                         quantity=10 ** 9, info='', descriptions='', specification={})
+        users = []
+        for i in range(count):
+            user = User.objects.create_user(f'{USER_PREFIX}{i}', password='x')
+            address = Address.objects.create(user=user, full_name='Load test', street='-', zip_code=1, city='-',
+                                             phone='-')
+            users.append((user, address))
+        return category, product, users
+
+    def client_loop(self, user, address, product, rounds, barrier, timings):
+        client = Client(raise_request_exception=False)
+        client.force_login(user)
+
+        def timed(endpoint, request, *args, **kwargs):
+            started = time.perf_counter()
+            try:
+                status = request(*args, **kwargs).status_code
+            except Exception:
+                status = 599
+            timings[endpoint].append((time.perf_counter() - started, status))
+
+        try:
+            barrier.wait()
+            for _ in range(rounds):
+                timed('add to cart', client.get, reverse('add_cart_page', args=[product.pk]))
+                timed('update quantity', client.post, reverse('cart_items'),
+                      json.dumps({'operations': [{'op': 'set', 'product': product.pk, 'quantity': 2}]}),
+                      content_type='application/json')
+                timed('cart page', client.get, reverse('cart_page'))
+                timed('checkout', client.post, reverse('order_create_page'),
+                      {'payment_method': 'paypal', 'address': address.pk})
+        finally:
+            close_old_connections()
+
+    def report(self, timings, elapsed):
+        total = errors = 0
+        for endpoint, samples in timings.items():
+            durations = sorted(duration * 1000 for duration, _ in samples)
+            failed = sum(status >= 500 for _, status in samples)
+            total, errors = total + len(samples), errors + failed
+            p95 = durations[int(len(durations) * 0.95) - 1] if len(durations) > 1 else durations[0]
+            p50 = statistics.median(durations)
+            self.stdout.write(f'  {endpoint:<16} {len(samples):>5} requests  p50 {p50:7.1f} ms  p95 {p95:7.1f} ms  '
+                              f'{failed:>4} errors')
+        self.stdout.write(f'  {"total":<16} {total:>5} requests  {total / elapsed:7.1f} req/s  {errors:>4} errors')
+
+    def handle(self, *args, **options):
+        self.describe_profile()
+        category, product, users = self.setup(options['users'])
+        timings = defaultdict(list)
+        barrier = threading.Barrier(len(users))
+        # Confirmation work runs inline, as a worker would, without writing into the real media folder.
+        celery_app.conf.update(CELERY_TASK_ALWAYS_EAGER=True)
+        try:
+            with tempfile.TemporaryDirectory() as media, override_settings(
+                    MEDIA_ROOT=media, INVOICE_ROOT=media,
+                    EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend'):
+                threads = [threading.Thread(target=self.client_loop,
+                                            args=(user, address, product, options['rounds'], barrier, timings))
+                           for user, address in users]
+                started = time.perf_counter()
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+                self.report(timings, time.perf_counter() - started)
+        finally:
+            User.objects.filter(username__startswith=USER_PREFIX).delete()
+            product.delete()
+            category.delete()
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from apps.facets import rebuild_product_specs
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the specification facet table from Product.specification'
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            count = rebuild_product_specs()
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt specifications for {count} products'))
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+
+from apps.cache import bump_category_tree_version
+from apps.categories import recount_product_counts
+
+
+class Command(BaseCommand):
+    help = 'Recompute the per-category product counts shown in the sidebar'
+
+    def handle(self, *args, **options):
+        changed = recount_product_counts()
+        bump_category_tree_version()
+        self.stdout.write(self.style.SUCCESS(f'Updated {changed} categories'))
@@ -0,0 +1,52 @@
+from django.db import migrations
+from django.utils.html import strip_tags
+
+FTS_TABLE = 'apps_product_fts'
+
+
+def product_document(product):
+    specification = product.specification if isinstance(product.specification, dict) else {}
+    return product.name, ' '.join([
+        strip_tags(product.info or ''),
+        strip_tags(product.descriptions or ''),
+        ' '.join(tag.name for tag in product.tags.all()),
+        ' '.join(str(value) for value in specification.values()),
+    ])
+
+
+def sqlite_has_fts5(cursor):
+    cursor.execute("SELECT sqlite_compileoption_used('ENABLE_FTS5')")
+    return bool(cursor.fetchone()[0])
+
+
+def create_fts_table(apps, schema_editor):
+    connection = schema_editor.connection
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        if not sqlite_has_fts5(cursor):
+            return
+        cursor.execute(
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5("
+            f"name, body, tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')"
+        )
+        Product = apps.get_model('apps', 'Product')
+        for product in Product.objects.prefetch_related('tags').iterator(chunk_size=2000):
+            cursor.execute(f'INSERT INTO {FTS_TABLE} (rowid, name, body) VALUES (%s, %s, %s)',
+                           [product.pk, *product_document(product)])
+
+
+def drop_fts_table(apps, schema_editor):
+    if schema_editor.connection.vendor == 'sqlite':
+        schema_editor.execute(f'DROP TABLE IF EXISTS {FTS_TABLE}')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('apps', '0003_order_list_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_fts_table, drop_fts_table),
+    ]
@@ -0,0 +1,61 @@
+# Generated by Django 5.0.6 on 2026-10-16 22:38
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+MAX_LENGTH = 255
+
+
+def spec_pairs(specification):
+    if not isinstance(specification, dict):
+        return
+    for key, value in specification.items():
+        values = value if isinstance(value, list) else [value]
+        for item in values:
+            if item is None or isinstance(item, (dict, list)):
+                continue
+            if isinstance(item, bool):
+                item = 'Yes' if item else 'No'
+            item = str(item).strip()
+            if item:
+                yield str(key).strip()[:MAX_LENGTH], item[:MAX_LENGTH]
+
+
+def backfill_specs(apps, schema_editor):
+    Product = apps.get_model('apps', 'Product')
+    ProductSpec = apps.get_model('apps', 'ProductSpec')
+    batch = []
+    for product_id, specification in Product.objects.values_list('pk', 'specification').iterator(chunk_size=2000):
+        batch.extend(ProductSpec(product_id=product_id, key=key, value=value)
+                     for key, value in dict.fromkeys(spec_pairs(specification)))
+        if len(batch) >= 5000:
+            ProductSpec.objects.bulk_create(batch)
+            batch = []
+    ProductSpec.objects.bulk_create(batch)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('apps', '0004_product_search'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProductSpec',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=255)),
+                ('value', models.CharField(max_length=255)),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='specs', to='apps.product')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['key', 'value', 'product'], name='product_spec_key_value_idx')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='productspec',
+            constraint=models.UniqueConstraint(fields=('product', 'key', 'value'), name='product_spec_unique'),
+        ),
+        migrations.RunPython(backfill_specs, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.0.6 on 2026-10-16 22:41
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def count_products(apps, schema_editor):
+    Category = apps.get_model('apps', 'Category')
+    Product = apps.get_model('apps', 'Product')
+    direct = dict(Product.objects.order_by().values_list('category_id').annotate(count=Count('id')))
+    categories = list(Category.objects.order_by('-level'))
+    totals = {}
+    for category in categories:
+        category.product_count = totals.get(category.pk, 0) + direct.get(category.pk, 0)
+        if category.parent_id:
+            totals[category.parent_id] = totals.get(category.parent_id, 0) + category.product_count
+    Category.objects.bulk_update(categories, ['product_count'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('apps', '0005_product_spec'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='category',
+            name='product_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(count_products, migrations.RunPython.noop),
+    ]
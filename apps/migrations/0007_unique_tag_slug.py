@@ -0,0 +1,48 @@
+# Generated by Django 5.0.6 on 2026-10-16 22:46
+
+from django.db import migrations, models
+from django.utils.text import slugify
+
+SUFFIX_RESERVE = 10
+
+
+def base_slug(model, value):
+    max_length = model._meta.get_field('slug').max_length
+    return (slugify(value) or model._meta.model_name)[:max_length - SUFFIX_RESERVE].strip('-')
+
+
+def deduplicate_tag_slugs(apps, schema_editor):
+    Tags = apps.get_model('apps', 'Tags')
+    tags = list(Tags.objects.order_by('pk'))
+    taken, changed = {tag.slug for tag in tags}, []
+    seen = set()
+    for tag in tags:
+        if tag.slug and tag.slug not in seen:
+            seen.add(tag.slug)
+            continue
+        base, suffix = base_slug(Tags, tag.name), 1
+        slug = base
+        while slug in taken:
+            slug = f'{base}-{suffix}'
+            suffix += 1
+        tag.slug = slug
+        taken.add(slug)
+        seen.add(slug)
+        changed.append(tag)
+    Tags.objects.bulk_update(changed, ['slug'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('apps', '0006_category_product_count'),
+    ]
+
+    operations = [
+        migrations.RunPython(deduplicate_tag_slugs, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='tags',
+            name='slug',
+            field=models.SlugField(max_length=255, unique=True),
+        ),
+    ]
@@ -0,0 +1,54 @@
+# Generated by Django 5.0.6 on 2026-10-16 23:06
+
+from django.db import migrations, models
+from django.db.models import Count, Min, Sum
+
+
+def merge_duplicate_rows(apps, schema_editor):
+    """Fold duplicate (user, product) rows into the oldest one before the unique constraints are added.
+
+    Duplicate cart rows add their quantities together; duplicate favourites are dropped.
+    """
+    CartItem = apps.get_model('apps', 'CartItem')
+    Favorite = apps.get_model('apps', 'Favorite')
+    duplicates = (CartItem.objects.values('user_id', 'product_id')
+                  .annotate(count=Count('id'), keep=Min('id'), quantity=Sum('quantity')).filter(count__gt=1))
+    for row in duplicates:
+        CartItem.objects.filter(pk=row['keep']).update(quantity=row['quantity'])
+        CartItem.objects.filter(user_id=row['user_id'], product_id=row['product_id']).exclude(pk=row['keep']).delete()
+
+    duplicates = (Favorite.objects.values('user_id', 'product_id')
+                  .annotate(count=Count('id'), keep=Min('id')).filter(count__gt=1))
+    for row in duplicates:
+        Favorite.objects.filter(user_id=row['user_id'], product_id=row['product_id']).exclude(pk=row['keep']).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('apps', '0009_outgoing_email'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_rows, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['owner', '-created_at', '-id'], name='order_owner_created_at_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['-created_at'], name='product_created_at_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['category', '-created_at'], name='product_category_created_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='cartitem',
+            constraint=models.UniqueConstraint(fields=('user', 'product'), name='cart_item_user_product_unique'),
+        ),
+        migrations.AddConstraint(
+            model_name='favorite',
+            constraint=models.UniqueConstraint(fields=('user', 'product'), name='favorite_user_product_unique'),
+        ),
+    ]
@@ -0,0 +1,47 @@
+from django.db import migrations
+from django.utils.html import strip_tags
+
+TABLE = 'apps_product_search'
+
+
+def product_document(product):
+    specification = product.specification if isinstance(product.specification, dict) else {}
+    return product.name, ' '.join([
+        strip_tags(product.info or ''),
+        strip_tags(product.descriptions or ''),
+        ' '.join(tag.name for tag in product.tags.all()),
+        ' '.join(str(value) for value in specification.values()),
+    ])
+
+
+def create_search_table(apps, schema_editor):
+    connection = schema_editor.connection
+    if connection.vendor != 'postgresql':
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(f'CREATE TABLE IF NOT EXISTS {TABLE} '
+                       f'(product_id integer PRIMARY KEY, document tsvector NOT NULL)')
+        cursor.execute(f'CREATE INDEX IF NOT EXISTS {TABLE}_document_gin ON {TABLE} USING gin (document)')
+        Product = apps.get_model('apps', 'Product')
+        cursor.executemany(
+            f"INSERT INTO {TABLE} (product_id, document) VALUES "
+            f"(%s, setweight(to_tsvector('simple', %s), 'A') || setweight(to_tsvector('simple', %s), 'B'))",
+            [(product.pk, *product_document(product))
+             for product in Product.objects.prefetch_related('tags').iterator(chunk_size=2000)]
+        )
+
+
+def drop_search_table(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute(f'DROP TABLE IF EXISTS {TABLE}')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('apps', '0011_stock_reservations'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_table, drop_search_table),
+    ]
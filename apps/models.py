@@ -4,12 +4,15 @@ from django.contrib.auth.models import AbstractUser
 from django.core.exceptions import ValidationError
 from django.db.models import Model, CharField, SlugField, IntegerField, PositiveSmallIntegerField, DateTimeField, \
     ForeignKey, CASCADE, ImageField, CheckConstraint, Q, BooleanField, TextChoices, PositiveIntegerField, DateField, \
-    TextField, EmailField, OneToOneField, JSONField, ManyToManyField, F, Sum
-from django.utils.text import slugify
+    TextField, EmailField, OneToOneField, JSONField, ManyToManyField, QuerySet, Index, \
+    UniqueConstraint
+from django.utils.functional import cached_property
 from django.utils.timezone import now
 from django_ckeditor_5.fields import CKEditor5Field
 from mptt.models import MPTTModel, TreeForeignKey
 
+from apps.slugs import UniqueSlugMixin
+
 
 class CreatedBaseModel(Model):
     updated_at = DateTimeField(auto_now=True)
@@ -19,17 +22,10 @@ class CreatedBaseModel(Model):
         abstract = True
 
 
-class SlugBaseModel(Model):
+class SlugBaseModel(UniqueSlugMixin, Model):
     name = CharField(max_length=255)
     slug = SlugField(max_length=255, unique=True, editable=False)
 
-    def save(self, force_insert=False, force_update=False, using=None, update_fields=None):
-        self.slug = slugify(self.name)
-        while self.__class__.objects.filter(slug=self.slug).exists():
-            self.slug += '-1'
-
-        super().save(force_insert, force_update, using, update_fields)
-
     class Meta:
         abstract = True
 
@@ -54,19 +50,34 @@ class SiteSettings(Model):
 
     def save(self, *args, **kwargs):
         self.clean()
+        if self.pk is None:
+            self.pk = SiteSettings.objects.order_by('pk').values_list('pk', flat=True).first()
         super().save(*args, **kwargs)
 
+    @classmethod
+    def load(cls):
+        return cls.objects.order_by('pk').first() or cls(tax=0)
+
     def __str__(self):
         return F"Tax: {self.tax}%"
 
 
 class Category(SlugBaseModel, MPTTModel):
     parent = TreeForeignKey('self', CASCADE, blank=True, null=True, related_name='children')
+    product_count = PositiveIntegerField(default=0, editable=False)
 
     class MPTTMete:
         order_insertion_by = ["name"]
 
 
+class ProductQuerySet(QuerySet):
+    def for_listing(self):
+        return self.select_related('category').prefetch_related('images', 'tags')
+
+    def for_detail(self):
+        return self.for_listing().prefetch_related('review_set')
+
+
 class Product(CreatedBaseModel):
     name = CharField(max_length=255)
     price = IntegerField()
@@ -81,6 +92,8 @@ class Product(CreatedBaseModel):
     updated = DateTimeField(auto_now=True)
     created_at = DateTimeField(auto_now_add=True)
 
+    objects = ProductQuerySet.as_manager()
+
     class Meta:
         constraints = [
             CheckConstraint(
@@ -88,16 +101,20 @@ class Product(CreatedBaseModel):
                 name='discount__lte__100',
             )
         ]
+        indexes = [
+            Index(fields=['-created_at'], name='product_created_at_idx'),
+            Index(fields=['category', '-created_at'], name='product_category_created_idx'),
+        ]
 
-    @property
+    @cached_property
     def is_new(self):
         return self.created_at >= now() - timedelta(days=7)
 
-    @property
+    @cached_property
     def in_stock(self):
         return self.quantity > 0
 
-    @property
+    @cached_property
     def current_price(self):
         return self.price - self.price * self.discount // 100
 
@@ -109,20 +126,82 @@ class Product(CreatedBaseModel):
 class ProductImage(Model):
     image = ImageField(upload_to="product_images/")
     product = ForeignKey('apps.Product', CASCADE, related_name='images')
+    width = PositiveIntegerField(null=True, blank=True, editable=False)
+    height = PositiveIntegerField(null=True, blank=True, editable=False)
+    renditions = JSONField(default=dict, blank=True, editable=False)
+    rendered_from = CharField(max_length=255, blank=True, editable=False)
+
+    def rendition_urls(self, fmt='jpeg'):
+        """Return ``[(width, url), ...]`` for the resized copies in ``fmt``, narrowest first."""
+        storage = self.image.storage
+        return sorted((int(width), storage.url(name)) for width, name in self.renditions.get(fmt, {}).items())
+
+    def srcset(self, fmt='jpeg'):
+        return ', '.join(f'{url} {width}w' for width, url in self.rendition_urls(fmt))
+
+    def url_for(self, width, fmt='jpeg'):
+        """Return the narrowest copy at least ``width`` pixels wide, falling back to the original."""
+        urls = self.rendition_urls(fmt)
+        for rendition_width, url in urls:
+            if rendition_width >= width:
+                return url
+        return urls[-1][1] if urls else self.image.url
 
     def __str__(self):
         return f"Images for {self.product.name}"
 
 
+class ProductSpec(Model):
+    product = ForeignKey('apps.Product', CASCADE, related_name='specs')
+    key = CharField(max_length=255)
+    value = CharField(max_length=255)
+
+    class Meta:
+        constraints = [
+            UniqueConstraint(fields=['product', 'key', 'value'], name='product_spec_unique'),
+        ]
+        indexes = [
+            Index(fields=['key', 'value', 'product'], name='product_spec_key_value_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.key}: {self.value}"
+
+
 class CartItem(Model):
     product = ForeignKey('apps.Product', CASCADE)
     user = ForeignKey('apps.User', CASCADE, related_name='user_cart')
     quantity = PositiveIntegerField(default=1)
 
+    class Meta:
+        constraints = [
+            UniqueConstraint(fields=['user', 'product'], name='cart_item_user_product_unique'),
+        ]
+
     def __str__(self):
         return f"{self.quantity} x {self.product.name}"
 
 
+class StockReservation(Model):
+    """Units held for a user's checkout; ``quantity`` is already taken out of ``Product.quantity``."""
+    product = ForeignKey('apps.Product', CASCADE, related_name='reservations')
+    user = ForeignKey('apps.User', CASCADE, related_name='stock_reservations')
+    quantity = PositiveIntegerField()
+    expires_at = DateTimeField()
+    created_at = DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            UniqueConstraint(fields=['user', 'product'], name='stock_reservation_user_product_unique'),
+        ]
+        indexes = [
+            Index(fields=['expires_at'], name='stock_reservation_expires_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.quantity} x {self.product_id} for {self.user_id} until {self.expires_at}"
+
+
 class Review(Model):
     name = CharField(max_length=255)
     posted_at = DateField(auto_now_add=True)
@@ -140,17 +219,18 @@ class Favorite(Model):
     user = ForeignKey('apps.User', CASCADE)
     product = ForeignKey('apps.Product', CASCADE, related_name='product_like')
 
+    class Meta:
+        constraints = [
+            UniqueConstraint(fields=['user', 'product'], name='favorite_user_product_unique'),
+        ]
+
     def __str__(self):
         return self.product.name
 
 
-class Tags(Model):
+class Tags(UniqueSlugMixin, Model):
     name = CharField(max_length=255, unique=True)
-    slug = SlugField(max_length=255, editable=True)
-
-    def save(self, force_insert=False, force_update=False, using=None, update_fields=None):
-        self.slug = slugify(self.name)
-        super().save(force_insert, force_update, update_fields, using)
+    slug = SlugField(max_length=255, unique=True, editable=True)
 
     def __str__(self):
         return self.name
@@ -171,26 +251,51 @@ class Order(CreatedBaseModel):
     payment_method = CharField(max_length=25, choices=PaymentMethod.choices)
     owner = ForeignKey('apps.User', CASCADE, related_name='orders')
     address = ForeignKey('apps.Address', CASCADE)
+    subtotal = PositiveIntegerField(default=0)
+    shipping_cost = PositiveIntegerField(default=0)
+    tax_rate = PositiveSmallIntegerField(default=0)
+    tax_amount = PositiveIntegerField(default=0)
+    total = PositiveIntegerField(default=0)
+
+    class Meta:
+        indexes = [
+            Index(fields=['-created_at', '-id'], name='order_created_at_id_idx'),
+            Index(fields=['status', '-created_at', '-id'], name='order_status_created_at_id_idx'),
+            Index(fields=['-total', '-id'], name='order_total_id_idx'),
+            Index(fields=['owner', '-created_at', '-id'], name='order_owner_created_at_id_idx'),
+        ]
 
     def __str__(self):
         return f'Order {self.id} - {self.status}'
 
-    @property
-    def total(self):
-        return (self.orderitem_set.aggregate(
-            total=Sum(F('quantity') * (F('product__price') * (
-                    100 - F('product__discount')) / 100)) + Sum(F('product__shipping_cost'))
-        ))
+    def set_totals(self, order_items, tax_rate):
+        self.subtotal = sum(order_item.amount for order_item in order_items)
+        self.shipping_cost = sum(order_item.shipping_cost for order_item in order_items)
+        self.tax_rate = tax_rate
+        self.tax_amount = (self.subtotal + self.shipping_cost) * tax_rate // 100
+        self.total = self.subtotal + self.shipping_cost + self.tax_amount
 
 
 class OrderItem(Model):
     product = ForeignKey('apps.Product', CASCADE)
-    order = ForeignKey('apps.Order', CASCADE)
+    order = ForeignKey('apps.Order', CASCADE, related_name='order_items')
     quantity = PositiveIntegerField(default=1)
+    unit_price = IntegerField(default=0)
+    discount = PositiveIntegerField(default=0)
+    shipping_cost = PositiveIntegerField(default=0)
+
+    def set_prices(self, product):
+        self.unit_price = product.price
+        self.discount = product.discount
+        self.shipping_cost = product.shipping_cost
+
+    @property
+    def price(self):
+        return self.unit_price - self.unit_price * self.discount // 100
 
     @property
     def amount(self):
-        return self.quantity * self.product.current_price
+        return self.quantity * self.price
 
 
 class Address(CreatedBaseModel):
@@ -211,3 +316,36 @@ class CreditCard(CreatedBaseModel):
     cvv = CharField(max_length=3)
     expire_date = DateField()
     owner = ForeignKey('apps.User', CASCADE)
+
+
+class OutgoingEmail(CreatedBaseModel):
+    class Status(TextChoices):
+        PENDING = 'pending', 'Pending'
+        SENDING = 'sending', 'Sending'
+        SENT = 'sent', 'Sent'
+        FAILED = 'failed', 'Failed'
+
+    recipient = EmailField()
+    subject = CharField(max_length=255)
+    body = TextField()
+    from_email = CharField(max_length=255, blank=True)
+    dedupe_key = CharField(max_length=64)
+    status = CharField(max_length=10, choices=Status.choices, default=Status.PENDING)
+    attempts = PositiveSmallIntegerField(default=0)
+    next_attempt_at = DateTimeField(default=now)
+    claim = CharField(max_length=32, blank=True)
+    claimed_at = DateTimeField(null=True, blank=True)
+    sent_at = DateTimeField(null=True, blank=True)
+    last_error = TextField(blank=True)
+
+    class Meta:
+        constraints = [
+            UniqueConstraint(fields=['recipient', 'dedupe_key'], name='outgoing_email_recipient_dedupe_key'),
+        ]
+        indexes = [
+            Index(fields=['status', 'next_attempt_at'], name='outgoing_email_due_idx'),
+            Index(fields=['claim'], name='outgoing_email_claim_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.subject} -> {self.recipient} ({self.status})"
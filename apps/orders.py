@@ -0,0 +1,60 @@
+from collections import Counter
+
+from django.db import transaction
+
+from apps.cache import get_site_settings
+from apps.inventory import commit_reservations
+from apps.models import CartItem, OrderItem
+from apps.tasks import confirm_order
+
+
+class CheckoutError(Exception):
+    pass
+
+
+class EmptyCartError(CheckoutError):
+    def __init__(self):
+        super().__init__('Your cart is empty.')
+
+
+class InsufficientStockError(CheckoutError):
+    def __init__(self, products):
+        self.products = products
+        names = ', '.join(product.name for product in products)
+        super().__init__(f'Not enough stock for: {names}.')
+
+
+@transaction.atomic
+def place_order(order):
+    """Move the owner's cart into ``order`` and take the ordered quantities out of stock.
+
+    The units held for the owner when checkout started are used first.
+    Prices, discounts, shipping and tax are copied onto the order and its items
+    so later price changes do not rewrite past orders. Runs in one transaction:
+    if any product is short, nothing is written and ``InsufficientStockError``
+    lists the products that could not be covered. The invoice and the
+    confirmation email are made by a worker once the order is committed.
+    """
+    cart_items = list(CartItem.objects.filter(user=order.owner).select_related('product'))
+    if not cart_items:
+        raise EmptyCartError()
+
+    quantities = Counter()
+    products = {}
+    for cart_item in cart_items:
+        quantities[cart_item.product_id] += cart_item.quantity
+        products[cart_item.product_id] = cart_item.product
+    if short := commit_reservations(order.owner, quantities):
+        raise InsufficientStockError([products[product_id] for product_id in short])
+
+    order_items = []
+    for cart_item in cart_items:
+        order_item = OrderItem(order=order, product=cart_item.product, quantity=cart_item.quantity)
+        order_item.set_prices(cart_item.product)
+        order_items.append(order_item)
+    order.set_totals(order_items, get_site_settings().tax)
+    order.save()
+    OrderItem.objects.bulk_create(order_items)
+    CartItem.objects.filter(pk__in=[cart_item.pk for cart_item in cart_items]).delete()
+    transaction.on_commit(lambda: confirm_order.delay(order.pk), robust=True)
+    return order_items
@@ -0,0 +1,148 @@
+import hashlib
+import time
+from urllib.parse import urlencode
+
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpResponse
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils.http import http_date
+from django.utils.timezone import now
+
+from apps.cache import CATEGORY_TREE_VERSION_KEY, get_category_tree, get_version
+from apps.models import Product
+
+PAGE_KEY = 'page:{digest}'
+PAGE_VERSIONS_KEY = 'page_versions:{digest}'
+PAGE_VERSIONS_TIMEOUT = 60 * 60 * 24
+PRODUCT_TAG = 'page_tag:product:{id}'
+LISTING_TAG = 'page_tag:listing:{id}'
+
+
+def product_tag(product_id):
+    return PRODUCT_TAG.format(id=product_id)
+
+
+def listing_tag(category_id=None):
+    """Tag of the listing page of ``category_id``, or of ``/`` for ``None``."""
+    return LISTING_TAG.format(id=category_id or 'all')
+
+
+def listing_tags(category_id=None):
+    """Tags of the listing pages that show a product of ``category_id``: its category, every ancestor and ``/``."""
+    tags = [listing_tag()]
+    if category_id is None:
+        return tags
+    nodes, stack = [], list(get_category_tree())
+    while stack:
+        node = stack.pop()
+        nodes.append(node)
+        stack.extend(node['children'])
+    target = next((node for node in nodes if node['id'] == category_id), None)
+    if target is None:
+        return tags + [listing_tag(category_id)]
+    return tags + [listing_tag(node['id']) for node in nodes
+                   if node['tree_id'] == target['tree_id'] and node['lft'] <= target['lft']
+                   and node['rght'] >= target['rght']]
+
+
+def tag_versions(tags):
+    versions = cache.get_many(tags)
+    for tag in set(tags) - versions.keys():
+        versions[tag] = get_version(tag)
+    return versions
+
+
+def versions_seen_at(versions):
+    """Return when the tag ``versions`` were first served, which is never before the last change to any of them."""
+    key = PAGE_VERSIONS_KEY.format(digest=hashlib.sha1(repr(sorted(versions.items())).encode()).hexdigest())
+    cache.add(key, int(now().timestamp()), PAGE_VERSIONS_TIMEOUT)
+    return cache.get(key)
+
+
+def bump_tags(tags):
+    """Give every tag in ``tags`` a new version with one cache call, expiring the pages stored under it."""
+    base = time.time_ns()
+    cache.set_many({tag: base + offset for offset, tag in enumerate(dict.fromkeys(tags))}, None)
+
+
+def invalidate_products(products):
+    """Expire the cached pages of ``[(product id, category id), ...]``."""
+    tags = []
+    for product_id, category_id in products:
+        tags.append(product_tag(product_id))
+        if category_id is not None:
+            tags.extend(listing_tags(category_id))
+    if tags:
+        bump_tags(tags)
+
+
+def touch_products(product_ids):
+    """Mark products as modified after a change that does not save them, such as a new image."""
+    if not product_ids:
+        return
+    Product.objects.filter(pk__in=product_ids).update(updated=now())
+    invalidate_products(Product.objects.filter(pk__in=product_ids).values_list('pk', 'category_id'))
+
+
+def page_key(request):
+    query = urlencode(sorted((key, value) for key, values in request.GET.lists() for value in values))
+    return PAGE_KEY.format(digest=hashlib.sha1(f'{request.path}?{query}'.encode()).hexdigest())
+
+
+class AnonymousPageCacheMixin:
+    """Serves whole pages to anonymous visitors from the cache for ``PAGE_CACHE_TIMEOUT`` seconds.
+
+    A page is stored with the versions of the tags from ``get_page_cache_tags``
+    and is served only while none of them has been bumped. Responses carry
+    an ETag of the content and a Last-Modified of ``self.last_modified`` or,
+    if later, when the tag versions were first seen, so browsers and proxies
+    can revalidate without the page being rendered.
+    """
+
+    last_modified = None
+
+    def get_page_cache_tags(self):
+        return [CATEGORY_TREE_VERSION_KEY]
+
+    def page_cacheable(self, request):
+        return (settings.PAGE_CACHE_TIMEOUT and request.method in ('GET', 'HEAD')
+                and not request.user.is_authenticated)
+
+    def dispatch(self, request, *args, **kwargs):
+        if not self.page_cacheable(request):
+            return super().dispatch(request, *args, **kwargs)
+
+        key = page_key(request)
+        tags = self.get_page_cache_tags()
+        versions = tag_versions(tags)
+        entry = cache.get(key)
+        if entry is not None and entry['versions'] == versions:
+            response = HttpResponse(entry['content'], content_type=entry['content_type'])
+            self.set_validators(response, entry['etag'], entry['last_modified'])
+            return get_conditional_response(request, entry['etag'], entry['last_modified'], response)
+
+        response = super().dispatch(request, *args, **kwargs)
+        if response.status_code == 200 and hasattr(response, 'add_post_render_callback'):
+            response.add_post_render_callback(lambda rendered: self.store_page(request, rendered, key, versions))
+        return response
+
+    def store_page(self, request, response, key, versions):
+        etag = f'"{hashlib.md5(response.content).hexdigest()}"'
+        # Category, facet and review changes reach the page through its tags, not self.last_modified.
+        last_modified = versions_seen_at(versions)
+        if self.last_modified:
+            last_modified = max(last_modified, int(self.last_modified.timestamp()))
+        self.set_validators(response, etag, last_modified)
+        # A page holding this visitor's CSRF token must not be shown to anyone else.
+        if not request.META.get('CSRF_COOKIE_NEEDS_UPDATE'):
+            cache.set(key, {'content': response.content, 'content_type': response['Content-Type'], 'etag': etag,
+                            'last_modified': last_modified, 'versions': versions}, settings.PAGE_CACHE_TIMEOUT)
+
+    @staticmethod
+    def set_validators(response, etag, last_modified):
+        response['ETag'] = etag
+        if last_modified:
+            response['Last-Modified'] = http_date(last_modified)
+        response['Cache-Control'] = 'max-age=0, must-revalidate'
+        patch_vary_headers(response, ['Cookie'])
@@ -0,0 +1,90 @@
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from binascii import Error as BinasciiError
+
+from django.core.exceptions import ValidationError
+from django.core.paginator import InvalidPage
+from django.db.models import Q
+
+
+class CursorPage:
+    def __init__(self, object_list, paginator, next_cursor=None, previous_cursor=None):
+        self.object_list = object_list
+        self.paginator = paginator
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+
+class CursorPaginator:
+    """Keyset pagination: every page is one indexed range scan, however deep it is.
+
+    ``ordering`` must end with a unique field (usually ``-id``) so that the
+    values of the last row on a page identify where the next page starts.
+    """
+
+    def __init__(self, queryset, ordering, per_page):
+        self.queryset = queryset
+        self.ordering = tuple(ordering)
+        self.per_page = per_page
+        self.fields = [queryset.model._meta.get_field(field.lstrip('-')) for field in self.ordering]
+
+    def encode_cursor(self, obj):
+        values = [field.value_to_string(obj) for field in self.fields]
+        return urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+    def decode_cursor(self, cursor):
+        try:
+            values = json.loads(urlsafe_b64decode(cursor.encode()))
+            if len(values) != len(self.fields):
+                raise ValueError
+            return [field.to_python(value) for field, value in zip(self.fields, values)]
+        except (BinasciiError, ValueError, TypeError, ValidationError):
+            raise InvalidPage('Invalid cursor')
+
+    def _after(self, values, backwards):
+        condition = Q()
+        for i, (ordering, field) in enumerate(zip(self.ordering, self.fields)):
+            descending = ordering.startswith('-') != backwards
+            equal = {other.name: value for other, value in zip(self.fields[:i], values[:i])}
+            condition |= Q(**equal, **{f'{field.name}__{"lt" if descending else "gt"}': values[i]})
+        return condition
+
+    def page(self, after=None, before=None):
+        backwards = before is not None
+        queryset = self.queryset.order_by(*self.ordering)
+        if backwards:
+            queryset = queryset.filter(self._after(self.decode_cursor(before), True))
+            queryset = queryset.reverse()
+        elif after is not None:
+            queryset = queryset.filter(self._after(self.decode_cursor(after), False))
+
+        rows = list(queryset[:self.per_page + 1])
+        has_more = len(rows) > self.per_page
+        rows = rows[:self.per_page]
+        if backwards:
+            rows.reverse()
+        if not rows:
+            return CursorPage(rows, self)
+
+        has_next = not backwards and has_more or backwards
+        has_previous = backwards and has_more or not backwards and after is not None
+        return CursorPage(
+            rows, self,
+            next_cursor=self.encode_cursor(rows[-1]) if has_next else None,
+            previous_cursor=self.encode_cursor(rows[0]) if has_previous else None,
+        )
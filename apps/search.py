@@ -0,0 +1,428 @@
+import math
+import re
+import threading
+from bisect import bisect_left
+from collections import defaultdict
+
+from django.core.cache import cache
+from django.db import connection, connections, transaction
+from django.db.models import Case, Q, When
+from django.utils.html import strip_tags
+
+from apps.cache import get_version, bump_version
+from apps.models import Product
+
+FTS_TABLE = 'apps_product_fts'
+POSTGRES_TABLE = 'apps_product_search'
+SEARCH_INDEX_VERSION_KEY = 'search_index:version'
+SEARCH_INDEX_DELTA_KEY = 'search_index:delta:{version}'
+NAME_WEIGHT = 3
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def tokenize(text):
+    return TOKEN_RE.findall(text.lower())
+
+
+def document_body(info, descriptions, tag_names, specification):
+    specification = specification if isinstance(specification, dict) else {}
+    return ' '.join([
+        strip_tags(info or ''),
+        strip_tags(descriptions or ''),
+        ' '.join(tag_names),
+        ' '.join(str(value) for value in specification.values()),
+    ])
+
+
+def product_document(product):
+    """Return the ``(name, body)`` text indexed for ``product``.
+
+    The body holds the CKEditor fields with markup stripped, tag names and
+    specification values.
+    """
+    tag_names = [tag.name for tag in product.tags.all()]
+    return product.name, document_body(product.info, product.descriptions, tag_names, product.specification)
+
+
+def sqlite_has_fts5(cursor):
+    cursor.execute("SELECT sqlite_compileoption_used('ENABLE_FTS5')")
+    return bool(cursor.fetchone()[0])
+
+
+_fts_tables = {}
+
+
+def fts_available():
+    if connection.vendor != 'sqlite':
+        return False
+    if connection.alias not in _fts_tables:
+        with connection.cursor() as cursor:
+            _fts_tables[connection.alias] = FTS_TABLE in connection.introspection.table_names(cursor)
+    return _fts_tables[connection.alias]
+
+
+def fts_query(query, prefix=False):
+    tokens = tokenize(query)
+    if not tokens:
+        return ''
+    terms = [f'"{token}"' for token in tokens]
+    if prefix:
+        terms[-1] += '*'
+    return ' '.join(terms)
+
+
+class SqliteSearchIndex:
+    """Product search on an SQLite FTS5 table ranked with bm25, product names weighted higher."""
+
+    def index(self, product_id, name, body):
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {FTS_TABLE} WHERE rowid = %s', [product_id])
+            cursor.execute(f'INSERT INTO {FTS_TABLE} (rowid, name, body) VALUES (%s, %s, %s)',
+                           [product_id, name, body])
+
+    def index_many(self, documents):
+        documents = list(documents)
+        with connection.cursor() as cursor:
+            cursor.executemany(f'DELETE FROM {FTS_TABLE} WHERE rowid = %s', [[document[0]] for document in documents])
+            cursor.executemany(f'INSERT INTO {FTS_TABLE} (rowid, name, body) VALUES (%s, %s, %s)', documents)
+
+    def remove(self, product_id):
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {FTS_TABLE} WHERE rowid = %s', [product_id])
+
+    def rebuild(self, products):
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {FTS_TABLE}')
+            count = 0
+            for product in products:
+                cursor.execute(f'INSERT INTO {FTS_TABLE} (rowid, name, body) VALUES (%s, %s, %s)',
+                               [product.pk, *product_document(product)])
+                count += 1
+        return count
+
+    def search(self, query, limit=1000, prefix=False, name_only=False):
+        match = fts_query(query, prefix)
+        if not match:
+            return []
+        if name_only:
+            match = f'name : ({match})'
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s '
+                f'ORDER BY bm25({FTS_TABLE}, {NAME_WEIGHT}.0, 1.0) LIMIT %s',
+                [match, limit]
+            )
+            return [row[0] for row in cursor.fetchall()]
+
+
+def tsquery(query, prefix=False, name_only=False):
+    tokens = tokenize(query)
+    if not tokens:
+        return ''
+    weight = 'A' if name_only else ''
+    terms = [f"'{token}':{weight}" if weight else f"'{token}'" for token in tokens]
+    if prefix:
+        terms[-1] = f"'{tokens[-1]}':*{weight}"
+    return ' & '.join(terms)
+
+
+class PostgresSearchIndex:
+    """Product search on a tsvector table with a GIN index, names weighted A and the body B."""
+
+    document_sql = "setweight(to_tsvector('simple', %s), 'A') || setweight(to_tsvector('simple', %s), 'B')"
+
+    def index(self, product_id, name, body):
+        self.index_many([(product_id, name, body)])
+
+    def index_many(self, documents):
+        with connection.cursor() as cursor:
+            cursor.executemany(
+                f'INSERT INTO {POSTGRES_TABLE} (product_id, document) VALUES (%s, {self.document_sql}) '
+                f'ON CONFLICT (product_id) DO UPDATE SET document = EXCLUDED.document',
+                list(documents)
+            )
+
+    def remove(self, product_id):
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {POSTGRES_TABLE} WHERE product_id = %s', [product_id])
+
+    def rebuild(self, products):
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {POSTGRES_TABLE}')
+        documents = [(product.pk, *product_document(product)) for product in products]
+        self.index_many(documents)
+        return len(documents)
+
+    def search(self, query, limit=1000, prefix=False, name_only=False):
+        match = tsquery(query, prefix, name_only)
+        if not match:
+            return []
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"SELECT product_id FROM {POSTGRES_TABLE}, to_tsquery('simple', %s) query "
+                f'WHERE document @@ query ORDER BY ts_rank(document, query) DESC, product_id LIMIT %s',
+                [match, limit]
+            )
+            return [row[0] for row in cursor.fetchall()]
+
+
+def database_search(query, limit=1000, prefix=False, name_only=False):
+    """Match every token with ``icontains``, name matches first; served while a process index is loading."""
+    tokens = tokenize(query)
+    if not tokens:
+        return []
+    matches = names = Q()
+    for token in tokens:
+        names &= Q(name__icontains=token)
+        if name_only:
+            matches &= Q(name__icontains=token)
+        else:
+            matches &= (Q(name__icontains=token) | Q(info__icontains=token) | Q(descriptions__icontains=token)
+                        | Q(tags__name__icontains=token))
+    products = (Product.objects.filter(matches).distinct()
+                .order_by(Case(When(names, then=0), default=1), 'pk').values_list('pk', flat=True))
+    return list(products[:limit])
+
+
+class InvertedIndex:
+    """Pure-Python BM25 index used when the database has no FTS5.
+
+    Postings map each term to ``{product_id: weighted term frequency}``; a
+    sorted term list answers prefix lookups with a binary search.
+    """
+    k1 = 1.2
+    b = 0.75
+
+    def __init__(self):
+        self.postings = defaultdict(dict)
+        self.name_postings = defaultdict(set)
+        self.lengths = {}
+        self.terms_by_doc = {}
+        self.total_length = 0
+        self._sorted_terms = None
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def index(self, product_id, name, body):
+        self.remove(product_id)
+        frequencies = defaultdict(int)
+        name_tokens = tokenize(name)
+        for token in name_tokens:
+            frequencies[token] += NAME_WEIGHT
+            self.name_postings[token].add(product_id)
+        for token in tokenize(body):
+            frequencies[token] += 1
+        for term, frequency in frequencies.items():
+            self.postings[term][product_id] = frequency
+        length = sum(frequencies.values())
+        self.lengths[product_id] = length
+        self.terms_by_doc[product_id] = (tuple(frequencies), tuple(set(name_tokens)))
+        self.total_length += length
+        self._sorted_terms = None
+
+    def remove(self, product_id):
+        if product_id not in self.lengths:
+            return
+        terms, name_terms = self.terms_by_doc.pop(product_id)
+        for term in terms:
+            self.postings[term].pop(product_id, None)
+            if not self.postings[term]:
+                del self.postings[term]
+        for term in name_terms:
+            self.name_postings[term].discard(product_id)
+            if not self.name_postings[term]:
+                del self.name_postings[term]
+        self.total_length -= self.lengths.pop(product_id)
+        self._sorted_terms = None
+
+    def clear(self):
+        self.__init__()
+
+    def rebuild(self, products):
+        self.clear()
+        for product in products:
+            self.index(product.pk, *product_document(product))
+        return len(self.lengths)
+
+    def expand(self, prefix):
+        if self._sorted_terms is None:
+            self._sorted_terms = sorted(self.postings)
+        terms = []
+        for term in self._sorted_terms[bisect_left(self._sorted_terms, prefix):]:
+            if not term.startswith(prefix):
+                break
+            terms.append(term)
+        return terms
+
+    def _idf(self, term):
+        frequency = len(self.postings.get(term, ()))
+        return math.log(1 + (len(self.lengths) - frequency + 0.5) / (frequency + 0.5))
+
+    def _scores(self, term):
+        postings = self.postings.get(term, {})
+        average = self.total_length / len(self.lengths)
+        idf = self._idf(term)
+        scores = {}
+        for product_id, tf in postings.items():
+            norm = self.k1 * (1 - self.b + self.b * self.lengths[product_id] / average)
+            scores[product_id] = idf * tf * (self.k1 + 1) / (tf + norm)
+        return scores
+
+    def search(self, query, limit=1000, prefix=False, name_only=False):
+        tokens = tokenize(query)
+        if not tokens or not self.lengths:
+            return []
+
+        scores = None
+        for i, token in enumerate(tokens):
+            terms = self.expand(token) if prefix and i == len(tokens) - 1 else [token]
+            token_scores = {}
+            for term in terms:
+                for product_id, score in self._scores(term).items():
+                    if name_only and product_id not in self.name_postings.get(term, ()):
+                        continue
+                    token_scores[product_id] = max(score, token_scores.get(product_id, 0))
+            if scores is None:
+                scores = token_scores
+            else:
+                scores = {product_id: scores[product_id] + score
+                          for product_id, score in token_scores.items() if product_id in scores}
+            if not scores:
+                return []
+        return sorted(scores, key=lambda product_id: (-scores[product_id], product_id))[:limit]
+
+
+class ProcessSearchIndex:
+    """Keeps an ``InvertedIndex`` per process in step with the other workers.
+
+    Every committed write bumps a shared version and logs the changed
+    product ids under it, so a process that falls behind re-indexes just
+    those products. Loading the whole catalog only happens in a background
+    thread: on start, after a ``rebuild``, or when the log has a gap. Until
+    the first load finishes searches fall back to ``database_search``.
+    """
+    max_catch_up = 1000
+    delta_timeout = 60 * 60
+
+    def __init__(self):
+        self.index_ = InvertedIndex()
+        self.version = None
+        self.loading = False
+        self.lock = threading.RLock()
+
+    def load(self):
+        """Index every product into a new ``InvertedIndex`` and swap it in once done."""
+        version = get_version(SEARCH_INDEX_VERSION_KEY)
+        index = InvertedIndex()
+        index.rebuild(Product.objects.prefetch_related('tags').iterator(chunk_size=2000))
+        with self.lock:
+            # Writes made while loading are newer than ``version`` and are caught up from the log.
+            self.index_, self.version = index, version
+        return len(index)
+
+    def _load_in_background(self):
+        try:
+            self.load()
+        finally:
+            self.loading = False
+            connections.close_all()
+
+    def schedule_load(self):
+        with self.lock:
+            if self.loading:
+                return
+            self.loading = True
+        threading.Thread(target=self._load_in_background, name='search-index-load', daemon=True).start()
+
+    def _catch_up(self):
+        version = get_version(SEARCH_INDEX_VERSION_KEY)
+        if version == self.version:
+            return
+        if self.version is None or not 0 < version - self.version <= self.max_catch_up:
+            self.schedule_load()
+            return
+        keys = [SEARCH_INDEX_DELTA_KEY.format(version=number) for number in range(self.version + 1, version + 1)]
+        deltas = cache.get_many(keys)
+        product_ids = set().union(*deltas.values())
+        if len(deltas) != len(keys) or len(product_ids) > self.max_catch_up:
+            self.schedule_load()
+            return
+        for product in Product.objects.filter(pk__in=product_ids).prefetch_related('tags'):
+            self.index_.index(product.pk, *product_document(product))
+            product_ids.discard(product.pk)
+        for product_id in product_ids:
+            self.index_.remove(product_id)
+        self.version = version
+
+    def _publish(self, product_ids, apply):
+        with self.lock:
+            version = bump_version(SEARCH_INDEX_VERSION_KEY)
+            cache.set(SEARCH_INDEX_DELTA_KEY.format(version=version), product_ids, self.delta_timeout)
+            if self.version is not None and version == self.version + 1:
+                apply()
+                self.version = version
+
+    def _write(self, product_ids, apply):
+        # Published on commit so other workers never re-read a row before the change is visible to them.
+        transaction.on_commit(lambda: self._publish(product_ids, apply))
+
+    def index(self, product_id, name, body):
+        self._write([product_id], lambda: self.index_.index(product_id, name, body))
+
+    def index_many(self, documents):
+        documents = list(documents)
+
+        def apply():
+            for document in documents:
+                self.index_.index(*document)
+
+        self._write([document[0] for document in documents], apply)
+
+    def remove(self, product_id):
+        self._write([product_id], lambda: self.index_.remove(product_id))
+
+    def rebuild(self, products):
+        with self.lock:
+            count = self.index_.rebuild(products)
+            # A version with no logged delta reads as a gap, so every other worker reloads in the background.
+            self.version = bump_version(SEARCH_INDEX_VERSION_KEY)
+            return count
+
+    def search(self, query, limit=1000, prefix=False, name_only=False):
+        with self.lock:
+            self._catch_up()
+            if self.version is None:
+                return database_search(query, limit, prefix, name_only)
+            return self.index_.search(query, limit, prefix, name_only)
+
+
+_process_index = ProcessSearchIndex()
+
+
+def get_search_index():
+    if connection.vendor == 'postgresql':
+        return PostgresSearchIndex()
+    if fts_available():
+        return SqliteSearchIndex()
+    return _process_index
+
+
+def index_product(product):
+    get_search_index().index(product.pk, *product_document(product))
+
+
+def remove_product(product_id):
+    get_search_index().remove(product_id)
+
+
+def rebuild_index():
+    return get_search_index().rebuild(Product.objects.prefetch_related('tags').iterator(chunk_size=2000))
+
+
+def search_products(query, limit=1000):
+    return get_search_index().search(query, limit)
+
+
+def autocomplete(query, limit=10):
+    return get_search_index().search(query, limit, prefix=True, name_only=True)
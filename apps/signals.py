@@ -0,0 +1,204 @@
+from django.db import transaction
+from django.db.backends.signals import connection_created
+from django.db.models.signals import pre_save, post_save, pre_delete, post_delete, m2m_changed
+from django.dispatch import receiver
+
+from apps.cache import bump_category_tree_version, invalidate_site_settings
+from apps.cart import invalidate_cart_summary
+from apps.categories import adjust_product_count, recount_product_counts
+from apps.favorites import invalidate_favorites
+from apps.facets import sync_product_specs, bump_facets_version
+from apps.images import delete_renditions
+from apps.instrumentation import install_query_recorder
+from apps.models import Category, CartItem, SiteSettings, Product, Tags, Favorite, ProductImage, Review
+from apps.pagecache import bump_tags, invalidate_products, product_tag, touch_products
+from apps.search import index_product, remove_product
+from apps.tasks import generate_image_renditions
+
+
+@receiver(pre_save, sender=Category)
+def remember_saved_category(sender, instance, **kwargs):
+    instance._previous_parent_id = None
+    if not instance._state.adding:
+        instance._previous_parent_id = Category.objects.filter(pk=instance.pk).values_list(
+            'parent_id', flat=True).first()
+
+
+@receiver(post_save, sender=Category)
+def recount_moved_category(sender, instance, created, **kwargs):
+    if not created and instance.parent_id != getattr(instance, '_previous_parent_id', None):
+        recount_product_counts()
+
+
+@receiver([post_save, post_delete], sender=Category)
+def invalidate_category_tree(sender, **kwargs):
+    bump_category_tree_version()
+    bump_facets_version()
+
+
+@receiver(pre_save, sender=Product)
+def remember_saved_product(sender, instance, **kwargs):
+    instance._previous_category_id = instance._previous_specification = None
+    if not instance._state.adding:
+        instance._previous_category_id, instance._previous_specification = Product.objects.filter(
+            pk=instance.pk).values_list('category_id', 'specification').first() or (None, None)
+
+
+@receiver(post_save, sender=Product)
+def count_saved_product(sender, instance, created, **kwargs):
+    previous = None if created else getattr(instance, '_previous_category_id', None)
+    if previous == instance.category_id:
+        return
+    if previous is not None:
+        adjust_product_count(previous, -1)
+    adjust_product_count(instance.category_id, 1)
+    bump_category_tree_version()
+
+
+@receiver(post_delete, sender=Product)
+def count_deleted_product(sender, instance, **kwargs):
+    adjust_product_count(instance.category_id, -1)
+    bump_category_tree_version()
+
+
+@receiver([post_save, post_delete], sender=CartItem)
+def invalidate_cart(sender, instance, **kwargs):
+    invalidate_cart_summary(instance.user_id)
+
+
+@receiver([post_save, post_delete], sender=Favorite)
+def invalidate_liked(sender, instance, **kwargs):
+    invalidate_favorites(instance.user_id)
+
+
+@receiver([post_save, post_delete], sender=SiteSettings)
+def invalidate_settings(sender, **kwargs):
+    invalidate_site_settings()
+
+
+@receiver(post_save, sender=Product)
+def index_saved_product(sender, instance, **kwargs):
+    index_product(instance)
+
+
+@receiver(post_delete, sender=Product)
+def unindex_deleted_product(sender, instance, **kwargs):
+    remove_product(instance.pk)
+
+
+@receiver(post_save, sender=Product)
+def sync_saved_product_specs(sender, instance, created, **kwargs):
+    if created or instance.specification != getattr(instance, '_previous_specification', None):
+        sync_product_specs(instance)
+    elif instance.category_id == getattr(instance, '_previous_category_id', None):
+        return
+    # Counts are kept per category, so a product moving with the same specification changes them too.
+    bump_facets_version()
+
+
+@receiver(post_delete, sender=Product)
+def invalidate_facets(sender, **kwargs):
+    bump_facets_version()
+
+
+def reindex_products(product_ids):
+    for product in Product.objects.filter(pk__in=product_ids).prefetch_related('tags'):
+        index_product(product)
+
+
+@receiver(m2m_changed, sender=Product.tags.through)
+def reindex_product_tags(sender, instance, action, reverse, pk_set, **kwargs):
+    if not reverse:
+        if action in ('post_add', 'post_remove', 'post_clear'):
+            index_product(instance)
+    elif action in ('post_add', 'post_remove'):
+        reindex_products(pk_set)
+    elif action == 'pre_clear':
+        # The products are only known before the rows go, and the index is only right after.
+        instance._cleared_product_ids = list(instance.product_set.values_list('pk', flat=True))
+    elif action == 'post_clear':
+        reindex_products(instance.__dict__.pop('_cleared_product_ids', []))
+
+
+@receiver(post_save, sender=Tags)
+def reindex_tagged_products(sender, instance, created, **kwargs):
+    if not created:
+        for product in instance.product_set.prefetch_related('tags'):
+            index_product(product)
+
+
+@receiver(pre_delete, sender=Tags)
+def remember_deleted_tag_products(sender, instance, **kwargs):
+    instance._tagged_product_ids = list(instance.product_set.values_list('pk', flat=True))
+
+
+@receiver(post_delete, sender=Tags)
+def reindex_untagged_products(sender, instance, **kwargs):
+    # The cascade deletes the through rows without m2m_changed, so the products still hold the name.
+    reindex_products(instance.__dict__.pop('_tagged_product_ids', []))
+
+
+@receiver(pre_save, sender=ProductImage)
+def forget_replaced_image(sender, instance, **kwargs):
+    # Storages that overwrite files keep the old name for a new upload, so the name alone cannot tell it apart.
+    if not instance.image._committed:
+        instance.rendered_from = ''
+
+
+@receiver(post_save, sender=ProductImage)
+def render_uploaded_image(sender, instance, **kwargs):
+    if instance.image.name and instance.image.name != instance.rendered_from:
+        transaction.on_commit(lambda: generate_image_renditions.delay([instance.pk]), robust=True)
+
+
+@receiver(post_delete, sender=ProductImage)
+def delete_image_renditions(sender, instance, **kwargs):
+    transaction.on_commit(lambda: delete_renditions(instance))
+
+
+@receiver(post_save, sender=Product)
+def expire_saved_product_pages(sender, instance, **kwargs):
+    products = [(instance.pk, instance.category_id)]
+    previous = getattr(instance, '_previous_category_id', None)
+    if previous not in (None, instance.category_id):
+        products.append((instance.pk, previous))
+    invalidate_products(products)
+
+
+@receiver(post_delete, sender=Product)
+def expire_deleted_product_pages(sender, instance, **kwargs):
+    invalidate_products([(instance.pk, instance.category_id)])
+
+
+@receiver([post_save, post_delete], sender=ProductImage)
+def expire_product_image_pages(sender, instance, **kwargs):
+    touch_products([instance.product_id])
+
+
+@receiver([post_save, post_delete], sender=Review)
+def expire_reviewed_product_pages(sender, instance, **kwargs):
+    bump_tags([product_tag(instance.product_id)])
+
+
+@receiver(m2m_changed, sender=Product.tags.through)
+def expire_retagged_product_pages(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+    if not reverse:
+        product_ids = [instance.pk]
+    elif pk_set is not None:
+        product_ids = pk_set
+    else:
+        product_ids = instance.product_set.values_list('pk', flat=True)
+    bump_tags([product_tag(product_id) for product_id in product_ids])
+
+
+@receiver([post_save, pre_delete], sender=Tags)
+def expire_tagged_product_pages(sender, instance, **kwargs):
+    if instance.pk is not None:
+        bump_tags([product_tag(product_id) for product_id in instance.product_set.values_list('pk', flat=True)])
+
+
+@receiver(connection_created)
+def instrument_connection(sender, connection, **kwargs):
+    install_query_recorder(connection)
@@ -0,0 +1,135 @@
+import re
+from functools import reduce
+from operator import or_
+
+from django.db import IntegrityError, router, transaction
+from django.db.models import Q
+from django.db.models.functions import Length
+from django.utils.text import slugify
+
+SLUG_RETRIES = 5
+SUFFIX_RESERVE = 10
+BULK_QUERY_BASES = 200
+
+
+def base_slug(model, value):
+    max_length = model._meta.get_field('slug').max_length
+    return (slugify(value) or model._meta.model_name)[:max_length - SUFFIX_RESERVE].strip('-')
+
+
+def _prefix_range(base):
+    # '.' sorts right after '-', so this range is every slug starting with "<base>-" and can use the index.
+    return Q(slug=base) | Q(slug__gt=f'{base}-', slug__lt=f'{base}.')
+
+
+def _suffix(base, slug):
+    """Return 0 for ``base`` itself, ``n`` for ``base-n`` and ``None`` for anything else.
+
+    Zero-padded suffixes such as ``base-007`` come from names like "Base 007"
+    and are not counted, so ordering by length still finds the highest one.
+    """
+    if slug == base:
+        return 0
+    match = re.fullmatch(rf'{re.escape(base)}-([1-9][0-9]*)', slug)
+    return int(match.group(1)) if match else None
+
+
+def _with_suffix(base, suffix):
+    return base if suffix is None else f'{base}-{suffix + 1}'
+
+
+def allocate_slug(model, value, exclude_pk=None, using=None):
+    """Return the next free slug for ``value`` with one query.
+
+    The query scans the index range of slugs starting with the base slug,
+    longest first, and normally stops at the first row, which holds the
+    highest numeric suffix.
+    """
+    base = base_slug(model, value)
+    queryset = model._default_manager.db_manager(using).filter(_prefix_range(base))
+    if exclude_pk is not None:
+        queryset = queryset.exclude(pk=exclude_pk)
+    slugs = queryset.order_by(Length('slug').desc(), '-slug').values_list('slug', flat=True)
+    for slug in slugs.iterator(chunk_size=100):
+        if (suffix := _suffix(base, slug)) is not None:
+            return _with_suffix(base, suffix)
+    return base
+
+
+def assign_slugs(objs, using=None):
+    """Give every object in ``objs`` a free slug before ``bulk_create``.
+
+    Taken suffixes are read with one query per ``BULK_QUERY_BASES`` distinct
+    names, and duplicates within ``objs`` are numbered in memory.
+    """
+    if not objs:
+        return objs
+    model = type(objs[0])
+    bases = {}
+    for obj in objs:
+        bases.setdefault(base_slug(model, obj.name), []).append(obj)
+
+    names = list(bases)
+    manager = model._default_manager.db_manager(using)
+    for start in range(0, len(names), BULK_QUERY_BASES):
+        chunk = names[start:start + BULK_QUERY_BASES]
+        highest = dict.fromkeys(chunk)
+        lookup = reduce(or_, map(_prefix_range, chunk))
+        for slug in manager.filter(lookup).values_list('slug', flat=True).iterator():
+            for base in _candidate_bases(slug, highest):
+                suffix = _suffix(base, slug)
+                if suffix is not None and (highest[base] is None or suffix > highest[base]):
+                    highest[base] = suffix
+        for base in chunk:
+            suffix = highest[base]
+            for obj in bases[base]:
+                obj.slug = _with_suffix(base, suffix)
+                obj._slug_name = obj.name
+                suffix = 0 if suffix is None else suffix + 1
+    return objs
+
+
+def _candidate_bases(slug, bases):
+    if slug in bases:
+        yield slug
+    head, sep, _ = slug.rpartition('-')
+    if sep and head in bases:
+        yield head
+
+
+class UniqueSlugMixin:
+    """Keeps ``slug`` unique and derived from ``name``.
+
+    The slug is only recomputed when ``name`` changes. A concurrent insert
+    that takes the same slug fails on the unique constraint and the save is
+    retried with a fresh suffix.
+    """
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._slug_name = instance.__dict__.get('name')
+        return instance
+
+    def _needs_slug(self):
+        return not self.slug or self.name != getattr(self, '_slug_name', None)
+
+    def save(self, force_insert=False, force_update=False, using=None, update_fields=None):
+        if not self._needs_slug():
+            return super().save(force_insert, force_update, using, update_fields)
+
+        if update_fields is not None:
+            update_fields = {*update_fields, 'slug'}
+        using = using or router.db_for_write(type(self), instance=self)
+        for attempt in range(SLUG_RETRIES):
+            self.slug = allocate_slug(type(self), self.name, exclude_pk=self.pk, using=using)
+            try:
+                with transaction.atomic(using=using):
+                    super().save(force_insert, force_update, using, update_fields)
+            except IntegrityError:
+                taken = type(self)._default_manager.db_manager(using).filter(slug=self.slug).exclude(pk=self.pk)
+                if attempt == SLUG_RETRIES - 1 or not taken.exists():
+                    raise
+            else:
+                self._slug_name = self.name
+                return
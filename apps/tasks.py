@@ -1,10 +1,44 @@
 from celery import shared_task
-from django.core.mail import send_mail
+from django.db import transaction
 
-from root import settings
+from apps.images import generate_renditions
+from apps.inventory import release_expired_reservations
+from apps.invoices import get_invoice, invoice_queryset
+from apps.mail import deliver_queued, queue_email
+from apps.models import ProductImage
 
 
 @shared_task
-def send_to_email(msg: str, email: str):
-    subject = 'Tema'
-    send_mail(subject, msg, settings.EMAIL_HOST_USER, [email])
+def send_to_email(msg: str, email: str, subject: str = 'Tema', dedupe_key: str = None):
+    if queue_email(subject, msg, [email], dedupe_key=dedupe_key):
+        # The message is stored, so with the broker down the beat schedule still delivers it.
+        transaction.on_commit(deliver_queued_emails.delay, robust=True)
+
+
+@shared_task(ignore_result=True)
+def deliver_queued_emails(max_messages=None):
+    deliver_queued(max_messages=max_messages)
+
+
+@shared_task(ignore_result=True)
+def generate_image_renditions(image_ids, force=False):
+    for product_image in ProductImage.objects.filter(pk__in=image_ids):
+        generate_renditions(product_image, force)
+
+
+@shared_task(ignore_result=True)
+def confirm_order(order_id):
+    """Render the invoice of a new order and queue the confirmation email."""
+    order = invoice_queryset().filter(pk=order_id).first()
+    if order is None:
+        return
+    get_invoice(order)
+    lines = [f'{item.product.name} x {item.quantity}: ${item.amount:,}' for item in order.order_items.all()]
+    lines += ['', f'Total: ${order.total:,}', 'The invoice can be downloaded from your order page.']
+    send_to_email('\n'.join(lines), order.owner.email, subject=f'Order #{order.pk} confirmation',
+                  dedupe_key=f'order-confirmation:{order.pk}')
+
+
+@shared_task(ignore_result=True)
+def release_stock_reservations():
+    release_expired_reservations()
@@ -1,5 +1,8 @@
 from django import template
-from apps.models import Favorite
+from django.conf import settings
+from django.utils.html import format_html, format_html_join
+
+from apps.images import MIME_TYPES
 
 register = template.Library()
 
@@ -17,8 +20,28 @@ def str_to_phone(value, arg=None):
 
 
 @register.filter()
-def is_liked(user, product) -> bool:
-    return Favorite.objects.filter(user=user, product=product).exists()
+def get_last_chars(value, count):
+    return str(value)[-count:]
+
+
+@register.simple_tag
+def responsive_image(product_image, width, sizes=None, **attrs):
+    """Render a product image shown ``width`` CSS pixels wide as ``<picture>`` with a ``srcset`` per format."""
+    attrs = {'alt': '', 'loading': 'lazy', 'width': width, **attrs}
+    if 'height' not in attrs and product_image.width:
+        attrs['height'] = round(width * product_image.height / product_image.width)
+    attributes = format_html_join('', ' {}="{}"', attrs.items())
+    formats = [fmt for fmt in settings.PRODUCT_IMAGE_FORMATS if product_image.renditions.get(fmt)]
+    if not formats:
+        return format_html('<img src="{}"{}>', product_image.image.url, attributes)
+
+    sizes = sizes or f'{width}px'
+    fallback = 'jpeg' if 'jpeg' in formats else formats[-1]
+    sources = format_html_join('', '<source type="{}" srcset="{}" sizes="{}">', [
+        (MIME_TYPES[fmt], product_image.srcset(fmt), sizes) for fmt in formats if fmt != fallback
+    ])
+    return format_html('<picture>{}<img src="{}" srcset="{}" sizes="{}"{}></picture>', sources,
+                       product_image.url_for(width, fallback), product_image.srcset(fallback), sizes, attributes)
 
 
 # @register.filter()
@@ -0,0 +1,179 @@
+import sys
+from contextlib import ContextDecorator
+from itertools import count
+
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.template.base import Template
+
+from apps.cache import invalidate_site_settings
+from apps.models import Address, CartItem, Favorite, Order, OrderItem, Product, ProductImage, Review
+
+SCALES = 1, 10, 100
+
+_names = count(1)
+_TEMPLATE_RENDER = Template.render.__code__
+
+
+def _rendering_template():
+    """Whether the current thread is inside ``Template.render``, found by walking the call stack."""
+    frame = sys._getframe(1)
+    while frame is not None:
+        if frame.f_code is _TEMPLATE_RENDER:
+            return True
+        frame = frame.f_back
+    return False
+
+
+class QueryCounter(ContextDecorator):
+    """Counts the queries a block runs and checks them against a budget on the way out.
+
+    Works as a context manager and as a decorator::
+
+        with QueryCounter(exactly=6, rendering=1):
+            client.get(url)
+
+    ``exactly`` and ``at_most`` bound every query, ``rendering`` bounds the
+    ones run while a template renders, where lazy querysets and related
+    lookups in loops hide N+1s. Bounds left as ``None`` are not checked.
+    Failures list each statement, marking the ones run from templates.
+    """
+
+    def __init__(self, exactly=None, at_most=None, rendering=None, using=DEFAULT_DB_ALIAS):
+        self.exactly = exactly
+        self.at_most = at_most
+        self.max_rendering = rendering
+        self.connection = connections[using]
+        self.queries = []
+
+    def record(self, execute, sql, params, many, context):
+        self.queries.append((sql, _rendering_template()))
+        return execute(sql, params, many, context)
+
+    @property
+    def count(self):
+        return len(self.queries)
+
+    @property
+    def rendering(self):
+        return sum(rendering for _, rendering in self.queries)
+
+    def __enter__(self):
+        self.queries = []
+        self.connection.execute_wrappers.append(self.record)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.connection.execute_wrappers.remove(self.record)
+        if exc_type is None and (problems := self.problems()):
+            raise AssertionError(f'{"; ".join(problems)}:\n{self.report()}')
+
+    def problems(self):
+        problems = []
+        if self.exactly is not None and self.count != self.exactly:
+            problems.append(f'{self.count} queries executed, {self.exactly} expected')
+        if self.at_most is not None and self.count > self.at_most:
+            problems.append(f'{self.count} queries executed, at most {self.at_most} expected')
+        if self.max_rendering is not None and self.rendering > self.max_rendering:
+            problems.append(f'{self.rendering} queries executed by templates, at most {self.max_rendering} expected')
+        return problems
+
+    def report(self):
+        return '\n'.join(f'{number}.{" [template]" if rendering else ""} {sql}'
+                         for number, (sql, rendering) in enumerate(self.queries, start=1))
+
+
+def reset_caches():
+    """Clear the shared cache and the copies each process keeps in front of it, so the next request starts cold."""
+    cache.clear()
+    invalidate_site_settings()
+
+
+class QueryCountMixin:
+    """``TestCase`` helpers built on ``QueryCounter``."""
+
+    def queryBudget(self, exactly=None, at_most=None, rendering=None, using=DEFAULT_DB_ALIAS):
+        """Return a ``QueryCounter`` that fails the block on exit if it breaks these bounds."""
+        return QueryCounter(exactly, at_most, rendering, using)
+
+    def assertQueriesConstant(self, add, request, scales=SCALES, exactly=None, at_most=None, rendering=None):
+        """Fail if ``request()`` runs more queries as ``add(n)`` grows the data to each of ``scales`` rows.
+
+        ``add`` is given how many rows to add to reach the next scale. Caches
+        are reset before every request so each starts equally cold; the
+        bounds are checked at every scale. Returns the counters by scale.
+        """
+        counters, total = {}, 0
+        for scale in scales:
+            add(scale - total)
+            total = scale
+            reset_caches()
+            with QueryCounter(exactly, at_most, rendering) as counters[scale]:
+                request()
+        counts = {scale: counter.count for scale, counter in counters.items()}
+        if len(set(counts.values())) > 1:
+            self.fail(f'The query count grows with the data, {counts}:\n{counters[scales[-1]].report()}')
+        return counters
+
+
+def add_products(count, category, **fields):
+    """Create ``count`` products with stock and two images each and return them."""
+    products = []
+    for _ in range(count):
+        product = Product.objects.create(
+            name=f'Product {next(_names)}', category=category,
+            **{'price': 1000, 'quantity': 100, 'info': 'info', 'descriptions': 'descriptions',
+               'specification': {'RAM': '8GB', 'Color': 'Black'}, **fields})
+        ProductImage.objects.bulk_create([ProductImage(product=product, image='product_images/1.png'),
+                                          ProductImage(product=product, image='product_images/2.png')])
+        products.append(product)
+    return products
+
+
+def add_reviews(product, count):
+    Review.objects.bulk_create([Review(product=product, name=f'Reviewer {number}', review_text='Review',
+                                       email_address=f'reviewer{number}@example.com') for number in range(count)])
+
+
+def add_cart_items(user, count, category):
+    CartItem.objects.bulk_create([CartItem(user=user, product=product, quantity=1)
+                                  for product in add_products(count, category)])
+
+
+def add_favorites(user, count, category):
+    Favorite.objects.bulk_create([Favorite(user=user, product=product, quantity=1, is_like=True)
+                                  for product in add_products(count, category)])
+
+
+def add_address(user):
+    return Address.objects.create(user=user, full_name=user.username, street='Street 1', zip_code=100000,
+                                  city='Tashkent', phone='901234567')
+
+
+def add_orders(user, count, category, items=2):
+    """Create ``count`` orders for ``user`` of ``items`` products each and return them."""
+    address = Address.objects.filter(user=user).first() or add_address(user)
+    products = add_products(items, category)
+    orders = []
+    for _ in range(count):
+        lines = [OrderItem(product=product, quantity=1) for product in products]
+        for line in lines:
+            line.set_prices(line.product)
+        order = Order(owner=user, address=address, payment_method=Order.PaymentMethod.PAYPAL)
+        order.set_totals(lines, 12)
+        order.save()
+        for line in lines:
+            line.order = order
+        OrderItem.objects.bulk_create(lines)
+        orders.append(order)
+    return orders
+
+
+def add_order_items(order, count, category):
+    """Add ``count`` new products to ``order`` and recompute its totals."""
+    lines = [OrderItem(order=order, product=product, quantity=1) for product in add_products(count, category)]
+    for line in lines:
+        line.set_prices(line.product)
+    OrderItem.objects.bulk_create(lines)
+    order.set_totals(list(order.order_items.select_related('product')), 12)
+    order.save()
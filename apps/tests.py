@@ -1,3 +1,1718 @@
-from django.test import TestCase
+import json
+import os
+import re
+import shutil
+import smtplib
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from io import BytesIO, StringIO
+from unittest import mock
 
-# Create your tests here.
+from allauth.socialaccount.models import SocialApp
+from django.contrib.sites.models import Site
+from django.core import mail
+from django.core.cache import cache
+from django.core.cache.utils import make_template_fragment_key
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.mail.backends.locmem import EmailBackend
+from django.core.management import call_command, CommandError
+from django.db import connection, close_old_connections, IntegrityError, OperationalError, transaction
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from PIL import Image
+from django.utils.http import parse_http_date
+from django.utils.timezone import now
+
+from apps import cache as app_cache
+from apps.cache import get_category_tree, get_category, get_site_settings, get_version, invalidate_site_settings
+from apps.benchmarks import FLOWS, ShopBenchmark, compare, seed
+from apps.cart import CartError, CartSummary, apply_cart_operations, checkout_totals, get_user_cart_summary
+from apps.models import (Category, Product, ProductImage, Tags, User, CartItem, Address, Order, OrderItem,
+                         SiteSettings, ProductSpec, Favorite, OutgoingEmail, StockReservation, Review)
+from apps.orders import place_order, InsufficientStockError, EmptyCartError
+from apps.search import InvertedIndex, ProcessSearchIndex, product_document, search_products, fts_available, tsquery
+from apps.slugs import allocate_slug, assign_slugs
+from apps.images import generate_renditions
+from apps.templatetags.custom_tags import responsive_image
+from apps.facets import FACETS_VERSION_KEY, bump_facets_version, get_facet_counts, spec_pairs
+from apps.favorites import get_user_liked_ids
+from apps.mail import deliver_queued, queue_email
+from apps.instrumentation import QueryRecorder, view_stats
+from apps.inventory import get_stock_levels, reserve_cart, stock_key, take_stock
+from apps.invoices import build_invoices_between, get_invoice, invoice_name, invoice_storage
+from apps.tasks import confirm_order, release_stock_reservations
+from apps.testing import (QueryCountMixin, QueryCounter, add_address, add_cart_items, add_favorites, add_order_items,
+                          add_orders, add_products, add_reviews, reset_caches)
+from root.celery import app as celery_app
+
+# Tasks queued by signals run in-process so the suite needs no broker.
+celery_app.conf.update(CELERY_TASK_ALWAYS_EAGER=True)
+
+
+def create_product(category, name='Phone', **kwargs):
+    fields = {'price': 1000, 'info': 'info', 'descriptions': 'descriptions',
+              'specification': {'RAM': '8GB', 'Color': 'Black'}, **kwargs}
+    product = Product.objects.create(name=name, category=category, **fields)
+    ProductImage.objects.create(product=product, image='product_images/1.png')
+    ProductImage.objects.create(product=product, image='product_images/2.png')
+    return product
+
+
+class ProductQuerySetTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.category = Category.objects.create(name='Phones')
+        self.tag = Tags.objects.create(name='Sale')
+
+    def _count_queries(self, url):
+        self.client.get(url)
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(ctx.captured_queries)
+
+    def test_list_query_count_does_not_depend_on_page_size(self):
+        create_product(self.category).tags.add(self.tag)
+        one = self._count_queries(reverse('product_list_page'))
+        for i in range(5):
+            create_product(self.category, name=f'Phone {i}').tags.add(self.tag)
+        many = self._count_queries(reverse('product_list_page'))
+        self.assertEqual(one, many)
+
+    def test_detail_query_count_does_not_depend_on_images(self):
+        product = create_product(self.category)
+        url = reverse('product_detail_page', args=(product.pk,))
+        before = self._count_queries(url)
+        for _ in range(5):
+            ProductImage.objects.create(product=product, image='product_images/3.png')
+        self.assertEqual(before, self._count_queries(url))
+
+
+class CategoryTreeCacheTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.phones = Category.objects.create(name='Phones')
+        self.smartphones = Category.objects.create(name='Smartphones', parent=self.phones)
+
+    def test_tree_is_nested(self):
+        tree = get_category_tree()
+        self.assertEqual([node['slug'] for node in tree], ['phones'])
+        self.assertEqual([node['slug'] for node in tree[0]['children']], ['smartphones'])
+
+    def test_warm_request_runs_no_category_queries(self):
+        url = reverse('product_list_page')
+        self.client.get(url)
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(url)
+        self.assertContains(response, 'Smartphones')
+        self.assertFalse([q for q in ctx.captured_queries if 'apps_category' in q['sql']])
+
+    def test_save_and_delete_invalidate_sidebar(self):
+        url = reverse('product_list_page')
+        self.client.get(url)
+        self.smartphones.name = 'Tablets'
+        self.smartphones.save()
+        self.assertContains(self.client.get(url), 'Tablets')
+        self.smartphones.delete()
+        self.assertNotContains(self.client.get(url), 'Tablets')
+
+
+class CategorySubtreeTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.phones = Category.objects.create(name='Phones')
+        self.android = Category.objects.create(name='Android', parent=self.phones)
+        self.laptops = Category.objects.create(name='Laptops')
+        self.pixel = create_product(self.android, name='Pixel')
+        self.nokia = create_product(self.phones, name='Nokia')
+        self.macbook = create_product(self.laptops, name='MacBook')
+
+    def _counts(self):
+        return dict(Category.objects.values_list('name', 'product_count'))
+
+    def _list(self, slug, **params):
+        return self.client.get(reverse('category_product_list_page', args=[slug]), params)
+
+    def test_parent_category_lists_descendant_products(self):
+        self.assertEqual(set(self._list('phones').context['products']), {self.pixel, self.nokia})
+        self.assertEqual(list(self._list('android').context['products']), [self.pixel])
+
+    def test_query_parameter_still_filters(self):
+        response = self.client.get(reverse('product_list_page'), {'category': 'laptops'})
+        self.assertEqual(list(response.context['products']), [self.macbook])
+
+    def test_unknown_category_is_404(self):
+        self.assertEqual(self._list('tablets').status_code, 404)
+
+    def test_range_lookup_is_cached(self):
+        self._list('phones')
+        with CaptureQueriesContext(connection) as ctx:
+            self._list('phones')
+        self.assertFalse([q for q in ctx.captured_queries if 'FROM "apps_category"' in q['sql']])
+
+    def test_counts_follow_product_changes(self):
+        self.assertEqual(self._counts(), {'Phones': 2, 'Android': 1, 'Laptops': 1})
+        self.nokia.category = self.laptops
+        self.nokia.save()
+        self.assertEqual(self._counts(), {'Phones': 1, 'Android': 1, 'Laptops': 2})
+        self.pixel.delete()
+        self.assertEqual(self._counts(), {'Phones': 0, 'Android': 0, 'Laptops': 2})
+        self.assertEqual(get_category('laptops')['product_count'], 2)
+
+    def test_counts_follow_category_moves(self):
+        self.android.parent = self.laptops
+        self.android.save()
+        self.assertEqual(self._counts(), {'Phones': 1, 'Android': 1, 'Laptops': 2})
+
+    def test_only_moves_recount_categories(self):
+        with mock.patch('apps.signals.recount_product_counts') as recount:
+            self.android.name = 'Android phones'
+            self.android.save()
+            recount.assert_not_called()
+            self.android.parent = None
+            self.android.save()
+            recount.assert_called_once_with()
+
+    def test_sidebar_shows_counts(self):
+        self.assertContains(self._list('phones'), reverse('category_product_list_page', args=['android']))
+
+
+class SlugAllocationTest(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_duplicates_get_numbered_suffixes(self):
+        slugs = [Category.objects.create(name='Phones').slug for _ in range(3)]
+        self.assertEqual(slugs, ['phones', 'phones-1', 'phones-2'])
+
+    def test_allocation_is_one_query(self):
+        for _ in range(12):
+            Category.objects.create(name='Phones')
+        Category.objects.create(name='Phones case')
+        with self.assertNumQueries(1):
+            self.assertEqual(allocate_slug(Category, 'Phones'), 'phones-12')
+
+    def test_zero_padded_names_do_not_hide_the_highest_suffix(self):
+        for name in ('Phonez', 'Phonez', 'Phonez', 'Phonez 007'):
+            Category.objects.create(name=name)
+        slugs = [Category.objects.create(name='Phonez').slug for _ in range(2)]
+        self.assertEqual(slugs, ['phonez-3', 'phonez-4'])
+        tags = [Tags(name='Phonez')]
+        Tags.objects.create(name='Phonez')
+        Tags.objects.create(name='Phonez 007')
+        assign_slugs(tags)
+        self.assertEqual(tags[0].slug, 'phonez-1')
+
+    def test_slug_changes_only_with_name(self):
+        category = Category.objects.create(name='Phones')
+        Category.objects.create(name='Phones')
+        category = Category.objects.get(pk=category.pk)
+        category.save()
+        self.assertEqual(category.slug, 'phones')
+        category.name = 'Tablets'
+        category.save()
+        self.assertEqual(Category.objects.get(pk=category.pk).slug, 'tablets')
+
+    def test_tag_slugs_are_unique(self):
+        self.assertEqual([Tags.objects.create(name=name).slug for name in ('New Year', 'new-year')],
+                         ['new-year', 'new-year-1'])
+
+    def test_bulk_assignment_reads_taken_slugs_once(self):
+        Tags.objects.create(name='Sale')
+        tags = [Tags(name=name) for name in ('SALE', 'sale!', 'Summer')]
+        with self.assertNumQueries(1):
+            assign_slugs(tags)
+        self.assertEqual([tag.slug for tag in tags], ['sale-1', 'sale-2', 'summer'])
+
+    def test_save_retries_when_a_concurrent_insert_takes_the_slug(self):
+        Category.objects.create(name='Phones')
+        with mock.patch('apps.slugs.allocate_slug', side_effect=['phones', 'phones-1']):
+            category = Category.objects.create(name='Phones')
+        self.assertEqual(category.slug, 'phones-1')
+
+
+class CatalogImportExportTest(TestCase):
+    records = [
+        {'name': 'Pixel 8', 'price': 700, 'category': 'Phones/Android', 'tags': ['Sale', 'New'],
+         'images': ['product_images/pixel.png'], 'specification': {'RAM': '8GB'}, 'info': '<p>Google</p>'},
+        {'name': 'Galaxy S24', 'price': 800, 'discount': 10, 'category': 'Phones/Android', 'tags': ['Sale'],
+         'specification': {'RAM': '12GB'}},
+        {'name': 'Nokia 3310', 'price': 50, 'category': 'Phones', 'tags': []},
+    ]
+
+    def setUp(self):
+        cache.clear()
+        self.tmp = tempfile.mkdtemp()
+        Tags.objects.create(name='Sale')
+
+    def tearDown(self):
+        for name in os.listdir(self.tmp):
+            os.remove(os.path.join(self.tmp, name))
+        os.rmdir(self.tmp)
+
+    def _write_jsonl(self, records):
+        path = os.path.join(self.tmp, 'catalog.jsonl')
+        with open(path, 'w') as f:
+            f.writelines(json.dumps(record) + '\n' for record in records)
+        return path
+
+    def _import(self, path, **options):
+        call_command('import_catalog', path, stdout=StringIO(), **options)
+
+    def test_import_builds_tree_tags_and_indexes(self):
+        self._import(self._write_jsonl(self.records), batch_size=2)
+        phones = Category.objects.get(name='Phones')
+        self.assertEqual(list(phones.get_descendants().values_list('name', flat=True)), ['Android'])
+        self.assertEqual(Category.objects.get(name='Android').product_count, 2)
+        self.assertEqual(Category.objects.get(name='Phones').product_count, 3)
+        self.assertEqual(Tags.objects.count(), 2)
+        pixel = Product.objects.get(name='Pixel 8')
+        self.assertEqual(sorted(pixel.tags.values_list('name', flat=True)), ['New', 'Sale'])
+        self.assertEqual(list(pixel.images.values_list('image', flat=True)), ['product_images/pixel.png'])
+        self.assertEqual(list(pixel.specs.values_list('value', flat=True)), ['8GB'])
+        self.assertEqual(search_products('google'), [pixel.pk])
+
+    def test_queries_grow_per_chunk_not_per_product(self):
+        def count(records):
+            with CaptureQueriesContext(connection) as ctx:
+                self._import(self._write_jsonl(records), batch_size=100)
+            return len(ctx.captured_queries)
+
+        self._import(self._write_jsonl(self.records))
+        small = count(self.records)
+        large = count([{**record, 'name': f"{record['name']} {i}"} for i in range(20) for record in self.records])
+        self.assertEqual(small, large)
+
+    def test_export_round_trips_through_csv(self):
+        self._import(self._write_jsonl(self.records))
+        path = os.path.join(self.tmp, 'catalog.csv')
+        call_command('export_catalog', path, batch_size=2, stderr=StringIO())
+        Product.objects.all().delete()
+        self._import(path)
+        galaxy = Product.objects.get(name='Galaxy S24')
+        self.assertEqual((galaxy.discount, galaxy.category.name, galaxy.specification),
+                         (10, 'Android', {'RAM': '12GB'}))
+        self.assertEqual(Product.objects.count(), 3)
+        self.assertEqual(Category.objects.count(), 2)
+
+    def test_reimporting_an_export_updates_products(self):
+        self._import(self._write_jsonl(self.records))
+        pixel = Product.objects.get(name='Pixel 8')
+        image = pixel.images.get()
+        path = os.path.join(self.tmp, 'export.jsonl')
+        call_command('export_catalog', path, stderr=StringIO())
+        with open(path) as f:
+            records = [json.loads(line) for line in f]
+        records[0].update(price=650, tags=['Clearance'], info='<p>Pixel by Alphabet</p>')
+        self._import(self._write_jsonl(records))
+        self.assertEqual(Product.objects.count(), 3)
+        pixel.refresh_from_db()
+        self.assertEqual(pixel.price, 650)
+        self.assertEqual(list(pixel.tags.values_list('name', flat=True)), ['Clearance'])
+        self.assertEqual(list(pixel.images.all()), [image])
+        self.assertEqual(pixel.specs.count(), 1)
+        self.assertEqual(search_products('google'), [])
+        self.assertEqual(search_products('alphabet'), [pixel.pk])
+        self.assertEqual(Category.objects.get(name='Phones').product_count, 3)
+
+    def test_category_names_may_contain_the_separator(self):
+        self._import(self._write_jsonl([{'name': 'Vinyl', 'price': 30, 'category': 'Music/AC\\/DC'}]))
+        self.assertEqual(Category.objects.get(name='AC/DC').parent.name, 'Music')
+        path = os.path.join(self.tmp, 'catalog.csv')
+        call_command('export_catalog', path, stderr=StringIO())
+        Product.objects.all().delete()
+        self._import(path)
+        self.assertEqual(Product.objects.get().category.name, 'AC/DC')
+        self.assertEqual(Category.objects.count(), 2)
+
+    def test_non_object_line_is_a_bad_record(self):
+        path = self._write_jsonl([self.records[0], ['Broken', 'Phones']])
+        with self.assertRaisesMessage(CommandError, 'line 2: expected an object, got list'):
+            self._import(path)
+
+    def test_invalid_line_reports_line_number(self):
+        path = self._write_jsonl([self.records[0], {'name': 'Broken', 'category': 'Phones'}])
+        with self.assertRaisesMessage(CommandError, 'line 2'):
+            self._import(path)
+
+
+def png_upload(width=800, height=400, name='photo.png'):
+    buffer = BytesIO()
+    Image.new('RGB', (width, height), 'orange').save(buffer, format='PNG')
+    return SimpleUploadedFile(name, buffer.getvalue(), content_type='image/png')
+
+
+class ImageRenditionTest(TestCase):
+    def setUp(self):
+        self.media = tempfile.mkdtemp()
+        self.override = override_settings(MEDIA_ROOT=self.media, PRODUCT_IMAGE_WIDTHS=[160, 320, 1280],
+                                          PRODUCT_IMAGE_FORMATS=['webp', 'jpeg'])
+        self.override.enable()
+        self.product = create_product(Category.objects.create(name='Phones'))
+
+    def tearDown(self):
+        self.override.disable()
+        shutil.rmtree(self.media)
+
+    def test_upload_renders_widths_capped_at_original(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            image = ProductImage.objects.create(product=self.product, image=png_upload())
+        image.refresh_from_db()
+        self.assertEqual((image.width, image.height), (800, 400))
+        self.assertEqual(sorted(image.renditions['webp'], key=int), ['160', '320', '800'])
+        with image.image.storage.open(image.renditions['jpeg']['160']) as f, Image.open(f) as rendition:
+            self.assertEqual(rendition.size, (160, 80))
+
+    def test_upload_survives_unreachable_broker(self):
+        def delay(image_ids):
+            raise OSError('broker down')
+
+        with mock.patch('apps.signals.generate_image_renditions.delay', delay), \
+                self.assertLogs('django.test', 'ERROR'), self.captureOnCommitCallbacks(execute=True):
+            image = ProductImage.objects.create(product=self.product, image=png_upload())
+        image.refresh_from_db()
+        self.assertEqual(image.renditions, {})
+
+    def test_generation_is_idempotent(self):
+        image = ProductImage.objects.create(product=self.product, image=png_upload())
+        self.assertTrue(generate_renditions(image))
+        self.assertFalse(generate_renditions(image))
+        image.image = png_upload(name='other.png')
+        image.save()
+        self.assertTrue(generate_renditions(image))
+
+    def test_replacing_the_file_replaces_the_renditions(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            image = ProductImage.objects.create(product=self.product, image=png_upload())
+        image.refresh_from_db()
+        storage, old = image.image.storage, image.renditions['webp']['160']
+        storage.delete(image.image.name)
+        with self.captureOnCommitCallbacks(execute=True):
+            image.image = png_upload(width=400, height=400)
+            image.save()
+        image.refresh_from_db()
+        self.assertEqual(image.rendered_from, image.image.name)
+        self.assertEqual((image.width, image.height), (400, 400))
+        self.assertNotEqual(image.renditions['webp']['160'], old)
+        self.assertFalse(storage.exists(old))
+        with storage.open(image.renditions['webp']['160']) as f, Image.open(f) as rendition:
+            self.assertEqual(rendition.size, (160, 160))
+
+    def test_missing_file_is_skipped(self):
+        image = self.product.images.first()
+        self.assertFalse(generate_renditions(image))
+
+    def test_tag_emits_srcset_per_format(self):
+        image = ProductImage.objects.create(product=self.product, image=png_upload())
+        generate_renditions(image)
+        html = responsive_image(image, 60)
+        self.assertIn('<source type="image/webp"', html)
+        self.assertIn('160w', html)
+        self.assertIn(f'src="{image.url_for(60)}"', html)
+        self.assertIn('height="30"', html)
+        original = self.product.images.first()
+        self.assertIn(f'src="{original.image.url}"', responsive_image(original, 60))
+
+    def test_backfill_command(self):
+        image = ProductImage.objects.create(product=self.product, image=png_upload())
+        call_command('generate_image_renditions', '--sync', stdout=StringIO())
+        image.refresh_from_db()
+        self.assertEqual(image.rendered_from, image.image.name)
+
+
+class ProductSearchTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.category = Category.objects.create(name='Phones')
+        self.iphone = create_product(self.category, name='iPhone 15 Pro', specification={'Color': 'Titanium'})
+        self.case = create_product(self.category, name='Leather case', info='<p>Fits the <strong>iPhone</strong></p>')
+
+    def test_uses_fts5_on_sqlite(self):
+        self.assertTrue(fts_available())
+
+    def test_name_matches_rank_first(self):
+        self.assertEqual(search_products('iphone'), [self.iphone.pk, self.case.pk])
+
+    def test_markup_is_stripped(self):
+        self.assertEqual(search_products('strong'), [])
+
+    def test_specification_and_tags_are_indexed(self):
+        self.assertEqual(search_products('titanium'), [self.iphone.pk])
+        self.case.tags.add(Tags.objects.create(name='Accessories'))
+        self.assertEqual(search_products('accessories'), [self.case.pk])
+
+    def test_untagging_from_the_tag_side_reindexes_products(self):
+        tag = Tags.objects.create(name='Accessories')
+        tag.product_set.add(self.case, self.iphone)
+        self.assertEqual(sorted(search_products('accessories')), sorted([self.iphone.pk, self.case.pk]))
+        tag.product_set.remove(self.iphone)
+        self.assertEqual(search_products('accessories'), [self.case.pk])
+        tag.product_set.clear()
+        self.assertEqual(search_products('accessories'), [])
+
+    def test_deleting_a_tag_reindexes_its_products(self):
+        tag = Tags.objects.create(name='Accessories')
+        self.case.tags.add(tag)
+        tag.delete()
+        self.assertEqual(search_products('accessories'), [])
+
+    def test_delete_removes_product(self):
+        self.case.delete()
+        self.assertEqual(search_products('leather'), [])
+
+    def test_list_view_filters_by_query(self):
+        response = self.client.get(reverse('product_list_page'), {'q': 'leather'})
+        self.assertEqual(list(response.context['products']), [self.case])
+
+    def test_autocomplete_matches_name_prefix(self):
+        response = self.client.get(reverse('search_autocomplete'), {'q': 'iph'})
+        self.assertEqual([result['id'] for result in response.json()['results']], [self.iphone.pk])
+
+
+class InvertedIndexTest(SimpleTestCase):
+    def setUp(self):
+        self.index = InvertedIndex()
+        self.index.index(1, 'iPhone 15 Pro', 'titanium phone')
+        self.index.index(2, 'Leather case', 'fits the iphone')
+        self.index.index(3, 'Galaxy S24', 'android phone')
+
+    def test_ranking_prefers_name_matches(self):
+        self.assertEqual(self.index.search('iphone'), [1, 2])
+
+    def test_all_terms_must_match(self):
+        self.assertEqual(self.index.search('android phone'), [3])
+
+    def test_prefix_and_name_only(self):
+        self.assertEqual(self.index.search('iph', prefix=True), [1, 2])
+        self.assertEqual(self.index.search('iph', prefix=True, name_only=True), [1])
+
+    def test_reindex_and_remove(self):
+        self.index.index(2, 'Silicone case', 'soft')
+        self.assertEqual(self.index.search('iphone'), [1])
+        self.index.remove(1)
+        self.assertEqual(self.index.search('iphone'), [])
+        self.assertNotIn('titanium', self.index.postings)
+
+    def test_postgres_query(self):
+        self.assertEqual(tsquery('iPhone case'), "'iphone' & 'case'")
+        self.assertEqual(tsquery('iphone ca', prefix=True, name_only=True), "'iphone':A & 'ca':*A")
+
+
+class ProcessSearchIndexTest(TestCase):
+    """The per-process index used without FTS5, with two instances standing in for two workers."""
+
+    def setUp(self):
+        cache.clear()
+        self.category = Category.objects.create(name='Phones')
+        self.iphone = create_product(self.category, name='iPhone 15 Pro')
+        self.case = create_product(self.category, name='Leather case', info='Fits the iPhone')
+        self.worker, self.other = ProcessSearchIndex(), ProcessSearchIndex()
+
+    def test_searches_the_database_until_loaded(self):
+        with mock.patch.object(ProcessSearchIndex, 'schedule_load') as schedule_load:
+            self.assertEqual(self.worker.search('iphone'), [self.iphone.pk, self.case.pk])
+            self.assertEqual(self.worker.search('iph', prefix=True, name_only=True), [self.iphone.pk])
+        schedule_load.assert_called()
+        self.assertEqual(len(self.worker.index_), 0)
+
+    def test_catches_up_with_other_workers_without_reloading(self):
+        self.worker.load()
+        self.other.load()
+        self.case.info = 'Soft silicone'
+        self.case.save()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.other.index(self.case.pk, *product_document(self.case))
+            iphone_id = self.iphone.pk
+            self.iphone.delete()
+            self.other.remove(iphone_id)
+        with mock.patch.object(ProcessSearchIndex, 'schedule_load') as schedule_load:
+            self.assertEqual(self.worker.search('silicone'), [self.case.pk])
+            self.assertEqual(self.worker.search('iphone'), [])
+        schedule_load.assert_not_called()
+        self.assertEqual(self.worker.version, self.other.version)
+
+    def test_changes_are_published_on_commit(self):
+        self.worker.load()
+        self.worker.remove(self.case.pk)
+        self.assertEqual(self.worker.search('leather'), [self.case.pk])
+
+    def test_rebuild_reloads_other_workers_in_background(self):
+        self.worker.load()
+        self.other.rebuild(Product.objects.prefetch_related('tags'))
+        with mock.patch.object(ProcessSearchIndex, 'schedule_load') as schedule_load:
+            self.assertEqual(self.worker.search('leather'), [self.case.pk])
+        schedule_load.assert_called_once()
+
+
+class SpecificationFacetTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.phones = Category.objects.create(name='Phones')
+        self.android = Category.objects.create(name='Android', parent=self.phones)
+        self.laptops = Category.objects.create(name='Laptops')
+        self.black = create_product(self.phones, specification={'RAM': '8GB', 'Color': 'Black'})
+        self.white = create_product(self.android, specification={'RAM': 8, 'Color': ['White', 'Blue']})
+        self.laptop = create_product(self.laptops, specification={'RAM': '16GB', 'Ports': {'USB': 2}})
+
+    def test_spec_pairs_flattens_lists_and_skips_objects(self):
+        self.assertEqual(list(spec_pairs({'RAM': 8, 'Color': ['White', 'Blue'], 'Ports': {'USB': 2}, 'NFC': True})),
+                         [('RAM', '8'), ('Color', 'White'), ('Color', 'Blue'), ('NFC', 'Yes')])
+
+    def test_specs_follow_product_saves(self):
+        self.black.specification = {'RAM': '12GB'}
+        self.black.save()
+        self.assertEqual(list(ProductSpec.objects.filter(product=self.black).values_list('key', 'value')),
+                         [('RAM', '12GB')])
+
+    def test_saves_that_keep_the_specification_do_not_resync(self):
+        version = get_version(FACETS_VERSION_KEY)
+        self.black.name = 'Renamed'
+        with CaptureQueriesContext(connection) as ctx:
+            self.black.save()
+        self.assertFalse([query for query in ctx.captured_queries if 'apps_productspec' in query['sql']])
+        self.assertEqual(get_version(FACETS_VERSION_KEY), version)
+
+        self.black.category = self.laptops
+        self.black.save()
+        self.assertNotEqual(get_version(FACETS_VERSION_KEY), version)
+
+    def test_counts_cover_category_subtree(self):
+        self.assertEqual(get_facet_counts(get_category('phones')), [
+            ('Color', [('Black', 1), ('Blue', 1), ('White', 1)]),
+            ('RAM', [('8', 1), ('8GB', 1)]),
+        ])
+        self.assertEqual(get_facet_counts(), [
+            ('Color', [('Black', 1), ('Blue', 1), ('White', 1)]),
+            ('RAM', [('16GB', 1), ('8', 1), ('8GB', 1)]),
+        ])
+
+    def test_counts_are_cached_until_a_product_changes(self):
+        get_facet_counts(get_category('phones'))
+        with self.assertNumQueries(0):
+            get_facet_counts(get_category('phones'))
+        create_product(self.android, specification={'Color': 'Black'})
+        self.assertIn(('Black', 2), dict(get_facet_counts(get_category('phones')))['Color'])
+
+    def test_list_view_filters_by_selected_values(self):
+        url = reverse('product_list_page')
+        response = self.client.get(url, {'spec': ['Color:Black', 'Color:White']})
+        self.assertEqual(set(response.context['products']), {self.black, self.white})
+        response = self.client.get(url, {'spec': ['Color:White', 'RAM:8GB']})
+        self.assertEqual(list(response.context['products']), [])
+        self.assertIn('spec=Color%3AWhite', response.context['query'])
+
+
+class SiteSettingsCacheTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        invalidate_site_settings()
+
+    def test_missing_row_defaults_to_zero_tax(self):
+        self.assertEqual(get_site_settings().tax, 0)
+
+    def test_warm_lookup_runs_no_queries(self):
+        SiteSettings.objects.create(tax=12)
+        get_site_settings()
+        with self.assertNumQueries(0):
+            self.assertEqual(get_site_settings().tax, 12)
+
+    def test_save_invalidates(self):
+        site_settings = SiteSettings.objects.create(tax=12)
+        get_site_settings()
+        site_settings.tax = 15
+        site_settings.save()
+        self.assertEqual(get_site_settings().tax, 15)
+        self.assertEqual(SiteSettings.objects.count(), 1)
+
+    def test_other_worker_change_is_seen_after_ttl(self):
+        SiteSettings.objects.create(tax=12)
+        get_site_settings()
+        SiteSettings.objects.update(tax=20)
+        app_cache.bump_version(app_cache.SITE_SETTINGS_VERSION_KEY)
+        self.assertEqual(get_site_settings().tax, 12)
+        app_cache._site_settings['expires'] = 0.0
+        self.assertEqual(get_site_settings().tax, 20)
+
+    def test_context_processor_exposes_tax(self):
+        SiteSettings.objects.create(tax=12)
+        self.assertEqual(self.client.get(reverse('product_list_page')).context['tax'], 12)
+
+
+class CartSummaryTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        category = Category.objects.create(name='Phones')
+        self.product = create_product(category, discount=10)
+        self.user = User.objects.create_user('buyer', password='secret')
+        other = User.objects.create_user('other', password='secret')
+        CartItem.objects.create(user=self.user, product=self.product, quantity=2)
+        CartItem.objects.create(user=other, product=self.product, quantity=5)
+
+    def test_summary_is_scoped_to_user(self):
+        with self.assertNumQueries(1):
+            summary = get_user_cart_summary(self.user)
+        self.assertEqual(summary, CartSummary(count=1, quantity=2, subtotal=1800))
+
+    def test_context_processor_reports_user_cart(self):
+        self.client.force_login(self.user)
+        response = self.client.get(reverse('cart_page'))
+        self.assertEqual(response.context['cart_len'], 1)
+        self.assertEqual(response.context['total_count'], 2)
+        self.assertEqual(response.context['total_sum'], 1800)
+
+    def test_totals_round_like_current_price(self):
+        product = create_product(self.product.category, name='Case', price=999, discount=15, shipping_cost=5)
+        CartItem.objects.filter(user=self.user).delete()
+        CartItem.objects.create(user=self.user, product=product, quantity=3)
+        order_item = OrderItem(product=product, quantity=3)
+        order_item.set_prices(product)
+        self.assertEqual(product.current_price * 3, 2550)
+        self.assertEqual(order_item.amount, 2550)
+        self.assertEqual(get_user_cart_summary(self.user).subtotal, 2550)
+        self.assertEqual(checkout_totals(CartItem.objects.filter(user=self.user)),
+                         {'subtotal': 2550, 'shipping_cost': 5, 'total': 2555})
+
+    @override_settings(CART_SUMMARY_CACHE_TIMEOUT=60)
+    def test_cached_summary_is_invalidated_by_cart_writes(self):
+        get_user_cart_summary(self.user)
+        with self.assertNumQueries(0):
+            get_user_cart_summary(self.user)
+        CartItem.objects.create(user=self.user, product=create_product(self.product.category, name='Case'))
+        self.assertEqual(get_user_cart_summary(self.user).count, 2)
+
+
+class CartItemsApiTest(TestCase):
+    def setUp(self):
+        category = Category.objects.create(name='Phones')
+        self.phone = create_product(category, price=1000, quantity=10)
+        self.case = create_product(category, name='Case', price=100, discount=10, quantity=10)
+        self.user = User.objects.create_user('buyer', password='secret')
+        other = User.objects.create_user('other', password='secret')
+        CartItem.objects.create(user=other, product=self.phone, quantity=7)
+        self.client.force_login(self.user)
+
+    def post(self, *operations):
+        return self.client.post(reverse('cart_items'), json.dumps({'operations': list(operations)}),
+                                content_type='application/json')
+
+    def quantities(self):
+        return dict(CartItem.objects.filter(user=self.user).values_list('product_id', 'quantity'))
+
+    def test_batch_returns_totals_of_own_cart(self):
+        response = self.post({'op': 'add', 'product': self.phone.pk}, {'op': 'add', 'product': self.phone.pk},
+                             {'op': 'set', 'product': self.case.pk, 'quantity': 3})
+        self.assertEqual(response.json(), {'count': 2, 'total_count': 5, 'total_sum': 2 * 1000 + 3 * 90})
+        self.assertEqual(self.quantities(), {self.phone.pk: 2, self.case.pk: 3})
+
+        response = self.post({'op': 'remove', 'product': self.case.pk}, {'op': 'add', 'product': self.phone.pk,
+                                                                         'quantity': 2})
+        self.assertEqual(response.json()['total_count'], 4)
+        self.assertEqual(self.quantities(), {self.phone.pk: 4})
+        self.assertEqual(self.post({'op': 'set', 'product': self.phone.pk, 'quantity': 0}).json()['count'], 0)
+        self.assertEqual(CartItem.objects.get(product=self.phone).quantity, 7)
+
+    def test_set_uses_one_write_and_one_aggregate(self):
+        CartItem.objects.create(user=self.user, product=self.phone, quantity=1)
+        with CaptureQueriesContext(connection) as ctx:
+            self.post({'op': 'set', 'product': self.phone.pk, 'quantity': 2},
+                      {'op': 'set', 'product': self.case.pk, 'quantity': 1})
+        statements = [query['sql'].split()[0] for query in ctx.captured_queries]
+        self.assertEqual(statements.count('INSERT'), 1)
+        self.assertEqual(statements.count('UPDATE'), 0)
+        self.assertEqual(self.quantities(), {self.phone.pk: 2, self.case.pk: 1})
+
+    def test_invalid_batches_change_nothing(self):
+        self.assertEqual(self.post({'op': 'add', 'product': 0}).status_code, 400)
+        self.assertEqual(self.post({'op': 'set', 'product': self.phone.pk, 'quantity': -1}).status_code, 400)
+        self.assertEqual(self.post({'op': 'buy', 'product': self.phone.pk}).status_code, 400)
+        self.assertEqual(self.client.post(reverse('cart_items'), 'nope', content_type='application/json').status_code,
+                         400)
+        self.assertEqual(self.quantities(), {})
+
+    @override_settings(CART_SUMMARY_CACHE_TIMEOUT=60)
+    def test_cached_summary_is_invalidated(self):
+        cache.clear()
+        self.assertEqual(get_user_cart_summary(self.user).quantity, 0)
+        self.post({'op': 'add', 'product': self.phone.pk, 'quantity': 3})
+        self.assertEqual(get_user_cart_summary(self.user).quantity, 3)
+
+
+class FavoritesTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        category = Category.objects.create(name='Phones')
+        self.products = [create_product(category, name=f'Phone {i}') for i in range(2)]
+        self.user = User.objects.create_user('buyer', password='secret')
+        self.client.force_login(self.user)
+
+    def _list_queries(self):
+        url = reverse('product_list_page')
+        self.client.get(url)
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(url)
+        return response, len(ctx.captured_queries)
+
+    def test_list_marks_liked_products_in_one_query(self):
+        _, baseline = self._list_queries()
+        for product in self.products:
+            Favorite.objects.create(user=self.user, product=product, quantity=1)
+        response, queries = self._list_queries()
+        self.assertEqual(queries, baseline)
+        self.assertTrue(all(product.is_liked for product in response.context['products']))
+
+    def test_detail_marks_liked_product(self):
+        Favorite.objects.create(user=self.user, product=self.products[0], quantity=1)
+        response = self.client.get(reverse('product_detail_page', args=[self.products[0].pk]))
+        self.assertTrue(response.context['product'].is_liked)
+        self.assertContains(response, reverse('remove_from_favorites', args=[self.products[0].pk]))
+
+    @override_settings(FAVORITES_CACHE_TIMEOUT=60)
+    def test_add_and_remove_invalidate_cached_ids(self):
+        product = self.products[0]
+        self.assertEqual(get_user_liked_ids(self.user), frozenset())
+        self.client.get(reverse('add_favourites_page', args=[product.pk]))
+        self.client.get(reverse('add_favourites_page', args=[product.pk]))
+        self.assertEqual(get_user_liked_ids(self.user), {product.pk})
+        self.assertEqual(Favorite.objects.filter(user=self.user).count(), 1)
+        self.client.post(reverse('remove_from_favorites', args=[product.pk]))
+        self.assertEqual(get_user_liked_ids(self.user), frozenset())
+
+    def test_favourites_page_lists_user_items(self):
+        for product in self.products:
+            Favorite.objects.create(user=self.user, product=product, quantity=1)
+        Favorite.objects.create(user=User.objects.create(username='other'), product=self.products[0], quantity=1)
+        response = self.client.get(reverse('favorites_page'))
+        self.assertEqual(len(response.context['favourite_items']), 2)
+        self.assertContains(response, 'Phone 1')
+
+
+def create_order(user):
+    address = Address.objects.create(user=user, full_name='Buyer', street='Street', zip_code=100000,
+                                     city='Tashkent', phone='901234567')
+    return Order(owner=user, address=address, payment_method=Order.PaymentMethod.PAYPAL)
+
+
+class LookupConstraintTest(TestCase):
+    def setUp(self):
+        self.product = create_product(Category.objects.create(name='Phones'), quantity=5)
+        self.user = User.objects.create_user('buyer', password='secret')
+
+    def test_add_to_cart_keeps_one_row_per_product(self):
+        self.client.force_login(self.user)
+        for _ in range(2):
+            self.client.get(reverse('add_cart_page', args=[self.product.pk]))
+        self.assertEqual(list(CartItem.objects.filter(user=self.user).values_list('quantity', flat=True)), [2])
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            CartItem.objects.create(user=self.user, product=self.product)
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Favorite.objects.bulk_create([Favorite(user=self.user, product=self.product, quantity=1)] * 2)
+
+    def test_main_queries_use_indexes(self):
+        out = StringIO()
+        call_command('explain_queries', '--fail-on-scan', stdout=out)
+        self.assertIn('0 queries scan a whole table', out.getvalue())
+
+
+class AsyncEndpointTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.phones = Category.objects.create(name='Phones')
+        self.android = Category.objects.create(name='Android', parent=self.phones)
+        self.laptops = Category.objects.create(name='Laptops')
+        self.pixel = create_product(self.android, name='Pixel', price=1000, discount=10, quantity=5)
+        self.iphone = create_product(self.phones, name='iPhone', price=2000)
+        self.laptop = create_product(self.laptops, name='Laptop')
+        self.user = User.objects.create_user('buyer', password='secret')
+
+    async def test_catalog_json(self):
+        response = await self.async_client.get(reverse('catalog_json'))
+        self.assertEqual(response.json()['count'], 3)
+        self.assertEqual([product['name'] for product in response.json()['results']], ['Laptop', 'iPhone', 'Pixel'])
+
+        response = await self.async_client.get(reverse('category_catalog_json', args=[self.phones.slug]))
+        results = response.json()['results']
+        self.assertEqual(response.json()['num_pages'], 1)
+        self.assertEqual(results[1], {'id': self.pixel.pk, 'name': 'Pixel', 'price': 1000, 'discount': 10,
+                                      'quantity': 5, 'current_price': 900,
+                                      'url': reverse('product_detail_page', args=[self.pixel.pk])})
+        response = await self.async_client.get(reverse('catalog_json'), {'page': 2})
+        self.assertEqual(response.json()['results'], [])
+        response = await self.async_client.get(reverse('catalog_json'), {'page': 'x'})
+        self.assertEqual(response.status_code, 400)
+        response = await self.async_client.get(reverse('category_catalog_json', args=['missing']))
+        self.assertEqual(response.status_code, 404)
+
+    async def test_cart_endpoints(self):
+        response = await self.async_client.get(reverse('cart_summary'))
+        self.assertEqual(response.status_code, 403)
+        await self.async_client.aforce_login(self.user)
+        response = await self.async_client.post(
+            reverse('cart_items'), {'operations': [{'op': 'set', 'product': self.pixel.pk, 'quantity': 2}]},
+            content_type='application/json')
+        self.assertEqual(response.json(), {'count': 1, 'total_count': 2, 'total_sum': 1800})
+        response = await self.async_client.get(reverse('cart_summary'))
+        self.assertEqual(response.json(), {'count': 1, 'total_count': 2, 'total_sum': 1800})
+
+    async def test_autocomplete(self):
+        response = await self.async_client.get(reverse('search_autocomplete'), {'q': 'pix'})
+        self.assertEqual([result['id'] for result in response.json()['results']], [self.pixel.pk])
+
+    async def test_async_requests_are_instrumented(self):
+        response = await self.async_client.get(reverse('catalog_json'))
+        self.assertRegex(response['Server-Timing'], r'desc="2 queries"')
+
+
+@override_settings(PAGE_CACHE_TIMEOUT=60)
+class AnonymousPageCacheTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.phones = Category.objects.create(name='Phones')
+        self.laptops = Category.objects.create(name='Laptops')
+        self.phone = create_product(self.phones, name='Phone')
+        self.laptop = create_product(self.laptops, name='Laptop')
+        self.phones_url = reverse('category_product_list_page', args=[self.phones.slug])
+        self.detail_url = reverse('product_detail_page', args=[self.phone.pk])
+
+    def test_pages_are_served_from_cache_until_their_products_change(self):
+        for url in (self.phones_url, self.detail_url):
+            self.client.get(url)
+            with self.assertNumQueries(0):
+                self.assertEqual(self.client.get(url).status_code, 200)
+
+        self.laptop.name = 'Renamed laptop'
+        self.laptop.save()
+        with self.assertNumQueries(0):
+            self.client.get(self.phones_url)
+            self.client.get(self.detail_url)
+
+        self.phone.name = 'Renamed phone'
+        self.phone.save()
+        self.assertContains(self.client.get(self.phones_url), 'Renamed phone')
+        self.assertContains(self.client.get(self.detail_url), 'Renamed phone')
+
+    def test_image_and_tag_changes_expire_detail_page(self):
+        self.client.get(self.detail_url)
+        ProductImage.objects.create(product=self.phone, image='product_images/3.png')
+        self.assertContains(self.client.get(self.detail_url), 'product_images/3.png')
+
+        tag = Tags.objects.create(name='Sale')
+        self.phone.tags.add(tag)
+        self.assertContains(self.client.get(self.detail_url), 'Sale')
+        self.client.get(self.detail_url)
+        tag.name = 'Clearance'
+        tag.save()
+        self.assertContains(self.client.get(self.detail_url), 'Clearance')
+
+    def test_revalidation(self):
+        response = self.client.get(self.detail_url)
+        self.phone.refresh_from_db()
+        self.assertGreaterEqual(parse_http_date(response['Last-Modified']), int(self.phone.updated.timestamp()))
+        self.assertIn('Cookie', response['Vary'])
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get(self.detail_url, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+            self.assertEqual(self.client.get(self.detail_url, HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+                             .status_code, 304)
+
+    def test_reviews_expire_detail_page_and_move_last_modified(self):
+        response = self.client.get(self.detail_url)
+        with mock.patch('apps.pagecache.now', return_value=now() + timedelta(minutes=1)):
+            Review.objects.create(product=self.phone, name='Ann', review_text='Great phone',
+                                  email_address='ann@example.com')
+            revalidated = self.client.get(self.detail_url, HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        self.assertContains(revalidated, 'Great phone')
+        self.assertGreater(parse_http_date(revalidated['Last-Modified']), parse_http_date(response['Last-Modified']))
+
+    def test_facet_changes_move_listing_last_modified(self):
+        response = self.client.get(self.phones_url)
+        with mock.patch('apps.pagecache.now', return_value=now() + timedelta(minutes=1)):
+            bump_facets_version()
+            revalidated = self.client.get(self.phones_url, HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        self.assertEqual(revalidated.status_code, 200)
+        self.assertGreater(parse_http_date(revalidated['Last-Modified']), parse_http_date(response['Last-Modified']))
+
+    def test_logged_in_users_are_not_cached(self):
+        self.client.force_login(User.objects.create_user('buyer', password='secret'))
+        self.client.get(self.phones_url)
+        with CaptureQueriesContext(connection) as ctx:
+            self.client.get(self.phones_url)
+        self.assertTrue(ctx.captured_queries)
+
+    def test_product_cards_are_cached_as_fragments(self):
+        self.client.force_login(User.objects.create_user('buyer', password='secret'))
+        self.client.get(reverse('product_list_page'))
+        self.phone.refresh_from_db()
+        key = make_template_fragment_key('product_card', [self.phone.pk, self.phone.updated.isoformat(),
+                                                          self.phones.slug, self.phones.name])
+        self.assertIn('Phone', cache.get(key))
+
+
+class InstrumentationTest(TestCase):
+    def setUp(self):
+        view_stats.clear()
+        create_product(Category.objects.create(name='Phones'))
+
+    def timings(self, response):
+        return {name: float(duration) for name, duration in
+                re.findall(r'(\w+);dur=([0-9.]+)', response['Server-Timing'])}
+
+    def test_server_timing_and_staff_stats(self):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(reverse('product_list_page'))
+        queries = len(ctx.captured_queries)
+        self.assertIn(f'desc="{queries} queries"', response['Server-Timing'])
+        timings = self.timings(response)
+        self.assertGreater(timings['tpl'], 0)
+        self.assertGreaterEqual(timings['total'], timings['tpl'])
+
+        self.client.force_login(User.objects.create_user('buyer', password='secret'))
+        self.assertEqual(self.client.get(reverse('instrumentation_stats')).status_code, 403)
+        self.client.force_login(User.objects.create_user('staff', password='secret', is_staff=True))
+        stats = self.client.get(reverse('instrumentation_stats')).json()['views']
+        self.assertEqual(stats['product_list_page']['requests'], 1)
+        self.assertEqual(stats['product_list_page']['queries']['p50'], queries)
+
+    def test_repeated_query_is_reported(self):
+        recorder = QueryRecorder()
+        with connection.execute_wrapper(recorder):
+            for pk in range(3):
+                list(Product.objects.filter(pk=pk))
+        self.assertEqual((recorder.count, recorder.duplicates), (3, 2))
+        self.assertEqual(recorder.repeated(3)[0][1], 3)
+
+    def test_sampled_profile_dump(self):
+        with tempfile.TemporaryDirectory() as directory:
+            with override_settings(INSTRUMENTATION_PROFILE_RATE=1, INSTRUMENTATION_PROFILE_VIEWS=['product_list_page'],
+                                   INSTRUMENTATION_PROFILE_DIR=directory):
+                self.client.get(reverse('product_list_page'))
+                self.client.get(reverse('search_autocomplete'), {'q': 'ph'})
+            self.assertEqual([name.split('-')[0] for name in os.listdir(directory)], ['product_list_page'])
+
+
+class CountingEmailBackend(EmailBackend):
+    opened = 0
+
+    def open(self):
+        type(self).opened += 1
+        return True
+
+    def send_messages(self, messages):
+        if any(recipient.startswith('bounce') for message in messages for recipient in message.to):
+            raise smtplib.SMTPRecipientsRefused({})
+        return super().send_messages(messages)
+
+
+@override_settings(EMAIL_RATE_LIMIT=0, EMAIL_RETRY_BACKOFF=60, EMAIL_MAX_ATTEMPTS=2)
+class EmailQueueTest(TestCase):
+    def setUp(self):
+        CountingEmailBackend.opened = 0
+
+    def test_messages_are_sent_in_batches_over_one_connection(self):
+        queue_email('Hello', 'Body', [f'user{i}@example.com' for i in range(5)])
+        self.assertEqual(deliver_queued(batch_size=2, connection=CountingEmailBackend()), (5, 0))
+        self.assertEqual(CountingEmailBackend.opened, 1)
+        self.assertEqual(sorted(message.to[0] for message in mail.outbox),
+                         [f'user{i}@example.com' for i in range(5)])
+        self.assertFalse(OutgoingEmail.objects.exclude(status=OutgoingEmail.Status.SENT).exists())
+
+    def test_empty_queue_does_not_connect(self):
+        self.assertEqual(deliver_queued(connection=CountingEmailBackend()), (0, 0))
+        self.assertEqual(CountingEmailBackend.opened, 0)
+
+    def test_keyed_message_is_queued_once_per_recipient(self):
+        self.assertEqual(queue_email('Hello', 'Body', ['a@example.com', 'A@example.com '], dedupe_key='event:1'), 1)
+        self.assertEqual(queue_email('Hello', 'Body', ['a@example.com', 'b@example.com'], dedupe_key='event:1'), 1)
+        self.assertEqual(queue_email('Hello', 'Body', ['a@example.com'], dedupe_key='event:2'), 1)
+        self.assertEqual(OutgoingEmail.objects.count(), 3)
+
+    def test_repeated_message_without_key_is_queued_again(self):
+        self.assertEqual(queue_email('Hello', 'Body', ['a@example.com']), 1)
+        self.assertEqual(queue_email('Hello', 'Body', ['a@example.com']), 1)
+        self.assertEqual(OutgoingEmail.objects.filter(recipient='a@example.com').count(), 2)
+
+    @override_settings(EMAIL_RECIPIENT_HOURLY_LIMIT=2)
+    def test_recipient_hourly_limit(self):
+        for i in range(3):
+            queue_email('Hello', f'Body {i}', ['a@example.com'])
+        self.assertEqual(OutgoingEmail.objects.filter(recipient='a@example.com').count(), 2)
+
+    def test_failed_message_is_retried_with_backoff_then_given_up(self):
+        queue_email('Hello', 'Body', ['bounce@example.com', 'ok@example.com'])
+        self.assertEqual(deliver_queued(connection=CountingEmailBackend()), (1, 1))
+        email = OutgoingEmail.objects.get(recipient='bounce@example.com')
+        self.assertEqual((email.status, email.attempts), (OutgoingEmail.Status.PENDING, 1))
+        self.assertGreater(email.next_attempt_at, now())
+
+        self.assertEqual(deliver_queued(connection=CountingEmailBackend()), (0, 0))
+        OutgoingEmail.objects.filter(pk=email.pk).update(next_attempt_at=now())
+        self.assertEqual(deliver_queued(connection=CountingEmailBackend()), (0, 1))
+        email.refresh_from_db()
+        self.assertEqual((email.status, email.attempts), (OutgoingEmail.Status.FAILED, 2))
+        self.assertEqual(len(mail.outbox), 1)
+
+    def test_registration_queues_and_delivers_welcome_email(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('register_page'), {
+                'first_name': 'New', 'last_name': 'User', 'email': 'new@example.com', 'username': 'new',
+                'password': 'secret-123', 'password2': 'secret-123',
+            })
+        self.assertEqual(OutgoingEmail.objects.get().status, OutgoingEmail.Status.SENT)
+        self.assertEqual(mail.outbox[0].to, ['new@example.com'])
+
+    def test_registration_survives_unreachable_broker(self):
+        def delay():
+            raise OSError('broker down')
+
+        with mock.patch('apps.tasks.deliver_queued_emails.delay', delay), \
+                self.assertLogs('django.test', 'ERROR'), self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(reverse('register_page'), {
+                'first_name': 'New', 'last_name': 'User', 'email': 'new@example.com', 'username': 'new',
+                'password': 'secret-123', 'password2': 'secret-123',
+            })
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(OutgoingEmail.objects.get().status, OutgoingEmail.Status.PENDING)
+
+
+class InventoryTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        category = Category.objects.create(name='Phones')
+        self.phone = create_product(category, quantity=5)
+        self.case = create_product(category, name='Case', quantity=2)
+        self.user = User.objects.create_user('buyer', password='secret')
+        self.other = User.objects.create_user('other', password='secret')
+
+    def stock(self):
+        return dict(Product.objects.filter(pk__in=[self.phone.pk, self.case.pk]).values_list('pk', 'quantity'))
+
+    def holds(self, user):
+        return dict(StockReservation.objects.filter(user=user).values_list('product_id', 'quantity'))
+
+    def test_reservations_follow_the_cart(self):
+        CartItem.objects.create(user=self.user, product=self.phone, quantity=3)
+        CartItem.objects.create(user=self.user, product=self.case, quantity=1)
+        short, expires_at = reserve_cart(self.user)
+        self.assertEqual(short, [])
+        self.assertAlmostEqual(expires_at.timestamp(), now().timestamp() + 15 * 60, delta=5)
+        self.assertEqual(self.stock(), {self.phone.pk: 2, self.case.pk: 1})
+
+        CartItem.objects.filter(user=self.user, product=self.phone).update(quantity=4)
+        CartItem.objects.filter(user=self.user, product=self.case).delete()
+        reserve_cart(self.user)
+        self.assertEqual(self.holds(self.user), {self.phone.pk: 4})
+        self.assertEqual(self.stock(), {self.phone.pk: 1, self.case.pk: 2})
+
+    def test_take_stock_guards_each_row(self):
+        with CaptureQueriesContext(connection) as ctx:
+            self.assertEqual(take_stock({self.phone.pk: 3, self.case.pk: 3}), [self.case.pk])
+        self.assertEqual(self.stock(), {self.phone.pk: 2, self.case.pk: 2})
+        self.assertFalse([query for query in ctx.captured_queries if 'FOR UPDATE' in query['sql']])
+        with CaptureQueriesContext(connection) as ctx:
+            self.assertEqual(take_stock({self.phone.pk: 2, self.case.pk: 2}), [])
+        self.assertEqual(self.stock(), {self.phone.pk: 0, self.case.pk: 0})
+        self.assertEqual(len([query for query in ctx.captured_queries if query['sql'].startswith('UPDATE')]), 1)
+
+    def test_held_units_are_not_sold_to_others(self):
+        CartItem.objects.create(user=self.user, product=self.case, quantity=2)
+        reserve_cart(self.user)
+        CartItem.objects.create(user=self.other, product=self.case, quantity=1)
+        short, _ = reserve_cart(self.other)
+        self.assertEqual(short, [self.case])
+        self.assertEqual(self.holds(self.other), {})
+        with self.assertRaises(InsufficientStockError):
+            place_order(create_order(self.other))
+
+        place_order(create_order(self.user))
+        self.assertEqual(self.stock()[self.case.pk], 0)
+        self.assertFalse(StockReservation.objects.exists())
+
+    def test_order_uses_holds_and_returns_the_rest(self):
+        CartItem.objects.create(user=self.user, product=self.phone, quantity=3)
+        CartItem.objects.create(user=self.user, product=self.case, quantity=2)
+        reserve_cart(self.user)
+        CartItem.objects.filter(user=self.user, product=self.phone).update(quantity=1)
+        CartItem.objects.filter(user=self.user, product=self.case).delete()
+        place_order(create_order(self.user))
+        self.assertEqual(self.stock(), {self.phone.pk: 4, self.case.pk: 2})
+        self.assertFalse(StockReservation.objects.exists())
+
+    def test_sweep_releases_only_expired_holds(self):
+        CartItem.objects.create(user=self.user, product=self.phone, quantity=3)
+        CartItem.objects.create(user=self.other, product=self.phone, quantity=1)
+        reserve_cart(self.user)
+        reserve_cart(self.other)
+        StockReservation.objects.filter(user=self.user).update(expires_at=now() - timedelta(seconds=1))
+        self.assertEqual(self.stock()[self.phone.pk], 1)
+
+        release_stock_reservations.delay()
+        self.assertEqual(self.stock()[self.phone.pk], 4)
+        self.assertEqual(self.holds(self.other), {self.phone.pk: 1})
+        self.assertEqual(self.holds(self.user), {})
+
+    def test_only_selling_out_marks_products_updated(self):
+        updated = Product.objects.get(pk=self.phone.pk).updated
+        CartItem.objects.create(user=self.user, product=self.phone, quantity=4)
+        reserve_cart(self.user)
+        self.assertEqual(Product.objects.get(pk=self.phone.pk).updated, updated)
+        CartItem.objects.filter(user=self.user).update(quantity=5)
+        reserve_cart(self.user)
+        self.assertGreater(Product.objects.get(pk=self.phone.pk).updated, updated)
+
+    def test_cart_cannot_hold_more_than_stock(self):
+        with self.assertRaisesMessage(CartError, 'Only 2 of Case left in stock.'):
+            apply_cart_operations(self.user, [{'op': 'set', 'product': self.case.pk, 'quantity': 3}])
+        apply_cart_operations(self.user, [{'op': 'set', 'product': self.case.pk, 'quantity': 2}])
+        reserve_cart(self.user)
+        # The user's own hold still counts as theirs.
+        apply_cart_operations(self.user, [{'op': 'set', 'product': self.case.pk, 'quantity': 2}])
+        with self.assertRaises(CartError):
+            apply_cart_operations(self.other, [{'op': 'add', 'product': self.case.pk}])
+
+    def test_starting_checkout_reserves_the_cart(self):
+        CartItem.objects.create(user=self.user, product=self.phone, quantity=1)
+        CartItem.objects.create(user=self.user, product=self.case, quantity=2)
+        CartItem.objects.filter(product=self.case).update(quantity=3)
+        self.client.force_login(self.user)
+        response = self.client.get(reverse('checkout_page'))
+        self.assertEqual(response.context['short_products'], [self.case])
+        self.assertIsNone(response.context['reserved_until'])
+        self.assertContains(response, 'not held yet')
+        self.assertEqual(self.holds(self.user), {})
+
+        self.assertRedirects(self.client.post(reverse('checkout_page')), reverse('checkout_page'))
+        self.assertEqual(self.holds(self.user), {self.phone.pk: 1})
+        response = self.client.get(reverse('checkout_page'))
+        self.assertContains(response, 'Case.')
+        self.assertEqual(response.context['short_products'], [self.case])
+        self.assertIsNotNone(response.context['reserved_until'])
+        self.assertEqual(self.holds(self.user), {self.phone.pk: 1})
+
+    @override_settings(STOCK_RESERVATION_MAX_HOLD=30 * 60)
+    def test_renewing_holds_cannot_outlive_the_maximum(self):
+        CartItem.objects.create(user=self.user, product=self.phone, quantity=1)
+        reserve_cart(self.user)
+        started = now() - timedelta(minutes=29)
+        StockReservation.objects.filter(user=self.user).update(created_at=started)
+        _, expires_at = reserve_cart(self.user)
+        self.assertEqual(expires_at, started + timedelta(minutes=30))
+        self.assertEqual(StockReservation.objects.get(user=self.user).expires_at, expires_at)
+
+    @override_settings(STOCK_CACHE_TIMEOUT=60)
+    def test_listing_reads_cached_stock_levels(self):
+        self.client.force_login(self.user)
+        self.client.get(reverse('product_list_page'))
+        self.assertEqual(cache.get(stock_key(self.case.pk)), 2)
+        self.assertEqual(get_stock_levels([self.phone.pk, self.case.pk]), {self.phone.pk: 5, self.case.pk: 2})
+
+        CartItem.objects.create(user=self.other, product=self.case, quantity=2)
+        with self.captureOnCommitCallbacks(execute=True):
+            reserve_cart(self.other)
+        self.assertIsNone(cache.get(stock_key(self.case.pk)))
+        response = self.client.get(reverse('product_list_page'))
+        self.assertEqual({product.pk: product.in_stock for product in response.context['products']},
+                         {self.phone.pk: True, self.case.pk: False})
+
+
+class PlaceOrderTest(TestCase):
+    def setUp(self):
+        category = Category.objects.create(name='Phones')
+        self.phone = create_product(category, quantity=5)
+        self.case = create_product(category, name='Case', quantity=1)
+        self.user = User.objects.create_user('buyer', password='secret')
+
+    def test_cart_is_moved_into_order(self):
+        CartItem.objects.create(user=self.user, product=self.phone, quantity=2)
+        CartItem.objects.create(user=self.user, product=self.case, quantity=1)
+        order = create_order(self.user)
+        place_order(order)
+        self.assertEqual(OrderItem.objects.filter(order=order).count(), 2)
+        self.assertFalse(CartItem.objects.filter(user=self.user).exists())
+        self.phone.refresh_from_db()
+        self.assertEqual(self.phone.quantity, 3)
+
+    def test_query_count_does_not_grow_with_cart_lines(self):
+        # Enough stock that no product sells out, which costs one more UPDATE.
+        Product.objects.filter(pk=self.case.pk).update(quantity=5)
+        order = create_order(self.user)
+        CartItem.objects.create(user=self.user, product=self.phone, quantity=1)
+        with CaptureQueriesContext(connection) as one:
+            place_order(order)
+        order = create_order(self.user)
+        CartItem.objects.create(user=self.user, product=self.phone, quantity=1)
+        CartItem.objects.create(user=self.user, product=self.case, quantity=1)
+        with CaptureQueriesContext(connection) as two:
+            place_order(order)
+        # Stock for every product in the cart is taken with one UPDATE.
+        self.assertEqual(len(two), len(one))
+
+    def test_insufficient_stock_writes_nothing(self):
+        CartItem.objects.create(user=self.user, product=self.phone, quantity=2)
+        CartItem.objects.create(user=self.user, product=self.case, quantity=3)
+        with self.assertRaises(InsufficientStockError) as ctx:
+            place_order(create_order(self.user))
+        self.assertEqual(ctx.exception.products, [self.case])
+        self.phone.refresh_from_db()
+        self.assertEqual(self.phone.quantity, 5)
+        self.assertFalse(Order.objects.exists())
+        self.assertEqual(CartItem.objects.filter(user=self.user).count(), 2)
+
+    def test_empty_cart(self):
+        with self.assertRaises(EmptyCartError):
+            place_order(create_order(self.user))
+
+    def test_checkout_view_reports_insufficient_stock(self):
+        CartItem.objects.create(user=self.user, product=self.case, quantity=3)
+        address = create_order(self.user).address
+        self.client.force_login(self.user)
+        response = self.client.post(reverse('order_create_page'), {'payment_method': 'paypal', 'address': address.pk})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('Not enough stock for: Case.', response.context['form'].non_field_errors())
+        self.assertEqual([item.product for item in response.context['cart_items']], [self.case])
+        self.assertEqual(list(response.context['addresses']), [address])
+        self.assertEqual(response.context['short_products'], [self.case])
+        self.assertGreater(response.context['total'], 0)
+        self.assertFalse(Order.objects.exists())
+
+
+class OrderTotalsTest(TestCase):
+    def setUp(self):
+        SiteSettings.objects.create(tax=10)
+        category = Category.objects.create(name='Phones')
+        self.phone = create_product(category, quantity=10, discount=10, shipping_cost=50)
+        self.user = User.objects.create_user('buyer', password='secret', is_staff=True)
+
+    def test_totals_are_stored_at_checkout(self):
+        CartItem.objects.create(user=self.user, product=self.phone, quantity=2)
+        order = create_order(self.user)
+        place_order(order)
+        Product.objects.filter(pk=self.phone.pk).update(price=5000)
+
+        order = Order.objects.get(pk=order.pk)
+        self.assertEqual((order.subtotal, order.shipping_cost, order.tax_rate, order.tax_amount, order.total),
+                         (1800, 50, 10, 185, 2035))
+        order_item = order.order_items.get()
+        self.assertEqual((order_item.unit_price, order_item.discount, order_item.price), (1000, 10, 900))
+
+    def test_backfill_command(self):
+        order = create_order(self.user)
+        order.save()
+        OrderItem.objects.create(order=order, product=self.phone, quantity=1)
+        call_command('backfill_order_totals', stdout=StringIO())
+        order.refresh_from_db()
+        self.assertEqual(order.total, 1045)
+        self.assertEqual(order.order_items.get().unit_price, 1000)
+
+    def test_order_list_sorts_by_total(self):
+        for quantity in (1, 3, 2):
+            CartItem.objects.create(user=self.user, product=self.phone, quantity=quantity)
+            place_order(create_order(self.user))
+        self.client.force_login(self.user)
+        response = self.client.get(reverse('order_list_page'), {'ordering': '-total'})
+        totals = [order.total for order in response.context['orders']]
+        self.assertEqual(totals, sorted(totals, reverse=True))
+        self.assertContains(response, f'${totals[0]:,}')
+
+
+class OrderListPaginationTest(TestCase):
+    def setUp(self):
+        SiteSettings.objects.create(tax=10)
+        self.staff = User.objects.create_user('staff', password='secret', is_staff=True)
+        self.client.force_login(self.staff)
+
+    def create_orders(self, count, **kwargs):
+        for _ in range(count):
+            user = User.objects.create(username=f'buyer{Order.objects.count()}')
+            order = create_order(user)
+            for field, value in kwargs.items():
+                setattr(order, field, value)
+            order.save()
+
+    def _count_queries(self, **params):
+        self.client.get(reverse('order_list_page'), params)
+        with CaptureQueriesContext(connection) as ctx:
+            self.client.get(reverse('order_list_page'), params)
+        return len(ctx.captured_queries)
+
+    def test_query_count_does_not_depend_on_orders(self):
+        self.create_orders(2)
+        few = self._count_queries()
+        self.create_orders(10)
+        self.assertEqual(few, self._count_queries())
+
+    def test_cursor_walks_every_order_once(self):
+        self.create_orders(25)
+        Order.objects.filter(pk__lte=15).update(created_at=now())
+        seen, params = [], {}
+        while True:
+            page = self.client.get(reverse('order_list_page'), params).context['page_obj']
+            seen.extend(order.pk for order in page)
+            if not page.has_next():
+                break
+            params = {'after': page.next_cursor}
+        self.assertEqual(seen, list(Order.objects.order_by('-created_at', '-id').values_list('pk', flat=True)))
+
+        previous = self.client.get(reverse('order_list_page'), {'before': page.previous_cursor}).context['page_obj']
+        self.assertEqual([order.pk for order in previous], seen[10:20])
+
+    def test_ascending_orderings_break_ties_by_ascending_id(self):
+        self.create_orders(25)
+        Order.objects.update(created_at=now())
+        for ordering in ('created_at', 'total'):
+            seen, params = [], {'ordering': ordering}
+            while True:
+                page = self.client.get(reverse('order_list_page'), params).context['page_obj']
+                seen.extend(order.pk for order in page)
+                if not page.has_next():
+                    break
+                params = {'ordering': ordering, 'after': page.next_cursor}
+            self.assertEqual(seen, list(Order.objects.order_by(ordering, 'id').values_list('pk', flat=True)))
+
+    def test_status_filter(self):
+        self.create_orders(2)
+        self.create_orders(1, status=Order.Status.COMPLETED)
+        response = self.client.get(reverse('order_list_page'), {'status': Order.Status.COMPLETED})
+        self.assertEqual([order.status for order in response.context['orders']], [Order.Status.COMPLETED])
+
+    def test_invalid_cursor(self):
+        self.assertEqual(self.client.get(reverse('order_list_page'), {'after': 'garbage'}).status_code, 404)
+
+
+class InvoiceTest(TestCase):
+    def setUp(self):
+        self.media = tempfile.mkdtemp()
+        self.override = override_settings(MEDIA_ROOT=os.path.join(self.media, 'media'),
+                                          INVOICE_ROOT=os.path.join(self.media, 'invoices'))
+        self.override.enable()
+        product = create_product(Category.objects.create(name='Phones'), quantity=5)
+        self.user = User.objects.create_user('buyer', password='secret', email='buyer@example.com')
+        CartItem.objects.create(user=self.user, product=product, quantity=2)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.order = create_order(self.user)
+            place_order(self.order)
+
+    def tearDown(self):
+        self.override.disable()
+        shutil.rmtree(self.media)
+
+    def test_checkout_renders_invoice_and_queues_confirmation(self):
+        self.assertTrue(invoice_storage().exists(invoice_name(self.order)))
+        self.assertFalse(default_storage.exists(invoice_name(self.order)))
+        self.assertEqual(mail.outbox[0].subject, f'Order #{self.order.pk} confirmation')
+        # A retried task does not email the customer twice.
+        confirm_order(self.order.pk)
+        self.assertEqual(OutgoingEmail.objects.filter(subject=f'Order #{self.order.pk} confirmation').count(), 1)
+
+    def test_download(self):
+        self.client.force_login(self.user)
+        with self.assertNumQueries(3):
+            response = self.client.get(reverse('download_pdf', args=[self.order.pk]))
+        self.assertEqual(response['Content-Type'], 'application/pdf')
+        self.assertTrue(b''.join(response.streaming_content).startswith(b'%PDF'))
+
+        self.client.force_login(User.objects.create_user('other', password='secret'))
+        self.assertEqual(self.client.get(reverse('download_pdf', args=[self.order.pk])).status_code, 404)
+
+    @override_settings(INVOICE_X_ACCEL_PREFIX='/protected-invoices/')
+    def test_download_through_x_accel_redirect(self):
+        self.client.force_login(self.user)
+        response = self.client.get(reverse('download_pdf', args=[self.order.pk]))
+        self.assertEqual(response['X-Accel-Redirect'], f'/protected-invoices/{invoice_name(self.order)}')
+
+    def test_changed_order_gets_new_invoice(self):
+        old = invoice_name(self.order)
+        self.order.status = Order.Status.COMPLETED
+        self.order.save()
+        new = get_invoice(self.order)
+        self.assertNotEqual(old, new)
+        self.assertFalse(invoice_storage().exists(old))
+        self.assertTrue(invoice_storage().exists(new))
+
+    def test_bulk_build_for_date_range(self):
+        shutil.rmtree(os.path.join(self.media, 'invoices'))
+        day = self.order.created_at
+        self.assertEqual(build_invoices_between(day - timedelta(days=1), day + timedelta(days=1)), 1)
+        self.assertTrue(invoice_storage().exists(invoice_name(self.order)))
+        self.assertEqual(build_invoices_between(day + timedelta(days=1), day + timedelta(days=2)), 0)
+
+
+class ConcurrentCheckoutTest(TransactionTestCase):
+    def setUp(self):
+        self.media = tempfile.mkdtemp()
+        self.override = override_settings(MEDIA_ROOT=self.media, INVOICE_ROOT=self.media)
+        self.override.enable()
+
+    def tearDown(self):
+        self.override.disable()
+        shutil.rmtree(self.media)
+
+    def test_parallel_checkouts_never_oversell(self):
+        category = Category.objects.create(name='Phones')
+        product = create_product(category, quantity=3)
+        orders = []
+        for i in range(6):
+            user = User.objects.create_user(f'buyer{i}', password='secret')
+            CartItem.objects.create(user=user, product=product, quantity=1)
+            orders.append(create_order(user))
+
+        barrier = threading.Barrier(len(orders))
+        results = []
+
+        def checkout(order):
+            barrier.wait()
+            try:
+                # The in-memory SQLite test database locks whole tables, so losers of a lock retry.
+                while True:
+                    try:
+                        place_order(order)
+                        results.append(True)
+                        return
+                    except InsufficientStockError:
+                        results.append(False)
+                        return
+                    except OperationalError:
+                        time.sleep(0.01)
+            finally:
+                close_old_connections()
+
+        threads = [threading.Thread(target=checkout, args=(order,)) for order in orders]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        product.refresh_from_db()
+        self.assertEqual(results.count(True), 3)
+        self.assertEqual(product.quantity, 0)
+        self.assertEqual(OrderItem.objects.filter(product=product).count(), 3)
+
+
+class BenchmarkTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.media = tempfile.mkdtemp()
+        self.override = override_settings(MEDIA_ROOT=self.media, INVOICE_ROOT=self.media)
+        self.override.enable()
+
+    def tearDown(self):
+        self.override.disable()
+        shutil.rmtree(self.media)
+
+    def test_seeded_flows_run_without_errors(self):
+        self.assertEqual(seed(products=30, users=2, carts=2, orders=1), 30)
+        self.assertEqual(ProductImage.objects.count(), 60)
+        self.assertEqual(Order.objects.count(), 2)
+
+        results = ShopBenchmark().run(2, warmup=1)
+        self.assertEqual(list(results), FLOWS)
+        for flow, result in results.items():
+            self.assertEqual((flow, result['requests'], result['errors']), (flow, 2, 0))
+            self.assertGreater(result['queries'], 0)
+        self.assertEqual(Order.objects.count(), 5)
+
+    def test_compare_flags_regressions(self):
+        baseline = {'list': {'requests': 10, 'errors': 0, 'p95_ms': 20.0, 'queries': 5}}
+        self.assertEqual(compare(baseline, baseline), [])
+        self.assertEqual(compare({'list': {**baseline['list'], 'p95_ms': 30.0}}, baseline), [])
+        self.assertEqual(len(compare({'list': {**baseline['list'], 'queries': 6}}, baseline)), 1)
+        self.assertEqual(len(compare({'list': {**baseline['list'], 'p95_ms': 40.0}}, baseline)), 1)
+        self.assertEqual(len(compare({'list': {**baseline['list'], 'errors': 1}}, {})), 1)
+
+
+class QueryCountTest(QueryCountMixin, TestCase):
+    """Every URL in ``apps.urls`` at 1, 10 and 100 rows of the data it shows, with its query budget pinned."""
+
+    def setUp(self):
+        reset_caches()
+        self.media = tempfile.mkdtemp()
+        self.override = override_settings(MEDIA_ROOT=self.media, INVOICE_ROOT=self.media)
+        self.override.enable()
+        self.phones = Category.objects.create(name='Phones')
+        self.android = Category.objects.create(name='Android', parent=self.phones)
+        self.user = User.objects.create_user('buyer', password='secret', email='buyer@example.com')
+
+    def tearDown(self):
+        self.override.disable()
+        shutil.rmtree(self.media)
+
+    def get(self, name, *args, status=200, **params):
+        response = self.client.get(reverse(name, args=args), params)
+        self.assertEqual(response.status_code, status)
+        return response
+
+    def post(self, name, *args, status=302, data=None, **extra):
+        response = self.client.post(reverse(name, args=args), data, **extra)
+        self.assertEqual(response.status_code, status)
+        return response
+
+    def add_products(self, count):
+        add_products(count, self.android)
+
+    def add_cart_items(self, count):
+        add_cart_items(self.user, count, self.android)
+
+    def test_query_counter(self):
+        self.add_products(1)
+        reset_caches()
+        with QueryCounter() as counter:
+            self.get('product_list_page')
+        self.assertGreater(counter.rendering, 0)
+        self.assertLess(counter.rendering, counter.count)
+        reset_caches()
+        with self.assertRaisesMessage(AssertionError, f'{counter.count} queries executed, 1 expected'):
+            with self.queryBudget(exactly=1):
+                self.get('product_list_page')
+        reset_caches()
+        with self.assertRaisesMessage(AssertionError, '[template]'):
+            with self.queryBudget(rendering=0):
+                self.get('product_list_page')
+
+        reset_caches()
+        with QueryCounter() as outer:
+            with QueryCounter() as inner:
+                self.get('product_list_page')
+        self.assertEqual((outer.count, outer.rendering), (inner.count, inner.rendering))
+        self.assertEqual((inner.count, inner.rendering), (counter.count, counter.rendering))
+
+        @QueryCounter(at_most=1)
+        def count_products():
+            return Product.objects.count()
+
+        self.assertEqual(count_products(), 1)
+        with self.assertRaisesMessage(AssertionError, 'The query count grows with the data, {2: 4, 10: 12}'):
+            self.assertQueriesConstant(self.add_products,
+                                       lambda: [product.category for product in Product.objects.all()], scales=(2, 10))
+
+    def test_catalog_pages(self):
+        self.assertQueriesConstant(self.add_products, lambda: self.get('product_list_page'), exactly=7,
+                                   rendering=1)
+        self.assertQueriesConstant(self.add_products, lambda: self.get('category_product_list_page', self.android.slug),
+                                   exactly=7, rendering=1)
+        self.client.force_login(self.user)
+        self.assertQueriesConstant(self.add_products, lambda: self.get('product_list_page'), exactly=11,
+                                   rendering=2)
+
+    def test_product_detail(self):
+        product = add_products(1, self.android)[0]
+        self.assertQueriesConstant(lambda count: add_reviews(product, count),
+                                   lambda: self.get('product_detail_page', product.pk), exactly=6, rendering=1)
+
+    def test_json_endpoints(self):
+        self.assertQueriesConstant(self.add_products, lambda: self.get('catalog_json'), exactly=2)
+        self.assertQueriesConstant(self.add_products, lambda: self.get('category_catalog_json', self.phones.slug),
+                                   exactly=3)
+        self.assertQueriesConstant(self.add_products, lambda: self.get('search_autocomplete', q='product'),
+                                   exactly=2)
+        self.client.force_login(self.user)
+        self.assertQueriesConstant(self.add_cart_items, lambda: self.get('cart_summary'), exactly=3)
+        product = add_products(1, self.android)[0]
+        self.assertQueriesConstant(
+            self.add_cart_items,
+            lambda: self.post('cart_items', status=200, content_type='application/json',
+                              data={'operations': [{'op': 'add', 'product': product.pk}]}),
+            exactly=11)
+
+    def test_account_pages(self):
+        SocialApp.objects.create(provider='google', name='Google', client_id='id').sites.add(Site.objects.get_current())
+        for name, queries, rendering in ('login_page', 3, 2), ('register_page', 2, 1):
+            reset_caches()
+            with self.subTest(name), self.queryBudget(exactly=queries, rendering=rendering):
+                self.get(name)
+        self.client.force_login(self.user)
+        reset_caches()
+        with self.queryBudget(exactly=5, rendering=2):
+            self.get('settings_page')
+        reset_caches()
+        with self.queryBudget(exactly=4):
+            self.get('logout_page', status=302)
+
+    def test_cart_pages(self):
+        self.client.force_login(self.user)
+        self.assertQueriesConstant(self.add_cart_items, lambda: self.get('cart_page'), exactly=8, rendering=4)
+        product = add_products(1, self.android)[0]
+        self.assertQueriesConstant(self.add_cart_items, lambda: self.get('add_cart_page', product.pk, status=302),
+                                   exactly=12)
+        doomed = []
+
+        def add(count):
+            self.add_cart_items(count)
+            doomed.append(CartItem.objects.filter(user=self.user).latest('pk').pk)
+
+        self.assertQueriesConstant(add, lambda: self.post('cart_delete_page', doomed[-1]), exactly=2)
+
+    def test_favorites(self):
+        self.client.force_login(self.user)
+        self.assertQueriesConstant(lambda count: add_favorites(self.user, count, self.android),
+                                   lambda: self.get('favorites_page'), exactly=7, rendering=4)
+        fresh = []
+
+        def add(count):
+            add_favorites(self.user, count, self.android)
+            fresh.append(add_products(1, self.android)[0].pk)
+
+        self.assertQueriesConstant(add, lambda: self.get('add_favourites_page', fresh[-1], status=302), exactly=7)
+        self.assertQueriesConstant(add, lambda: self.post('remove_from_favorites', fresh[-1]), exactly=3)
+
+    def test_address_pages(self):
+        self.client.force_login(self.user)
+        reset_caches()
+        with self.queryBudget(exactly=5, rendering=4):
+            self.get('create_address_page')
+        reset_caches()
+        with self.queryBudget(exactly=3):
+            self.post('create_address_page', data={'city': 'Tashkent', 'street': 'Street 1', 'zip_code': 100000,
+                                                   'phone': '901234567', 'full_name': 'Buyer'})
+        reset_caches()
+        with self.queryBudget(exactly=7, rendering=4):
+            self.get('update_address_page', Address.objects.get(user=self.user).pk)
+
+    def test_checkout(self):
+        self.client.force_login(self.user)
+        add_address(self.user)
+        self.assertQueriesConstant(self.add_cart_items, lambda: self.get('checkout_page'), exactly=11,
+                                   rendering=4)
+
+    def test_start_checkout(self):
+        self.client.force_login(self.user)
+        self.assertQueriesConstant(self.add_cart_items, lambda: self.post('checkout_page'), exactly=12)
+
+    def test_place_order(self):
+        self.client.force_login(self.user)
+        address = add_address(self.user)
+        size = [0]
+
+        def fill_cart(count):
+            # Every order empties the cart, so each scale fills a new one.
+            size[0] += count
+            self.add_cart_items(size[0])
+
+        self.assertQueriesConstant(
+            fill_cart, lambda: self.post('order_create_page', data={'payment_method': Order.PaymentMethod.PAYPAL,
+                                                                    'address': address.pk}),
+            exactly=20)
+        self.assertEqual(Order.objects.filter(owner=self.user).count(), 3)
+
+    def test_orders(self):
+        self.client.force_login(self.user)
+        self.assertQueriesConstant(lambda count: add_orders(self.user, count, self.android),
+                                   lambda: self.get('order_list_page'), exactly=6, rendering=2)
+        order = add_orders(self.user, 1, self.android, items=0)[0]
+        self.assertQueriesConstant(lambda count: add_order_items(order, count, self.android),
+                                   lambda: self.get('order_detail_page', order.pk), exactly=8, rendering=2)
+
+        orders, size = [], [0]
+
+        def add_order(count):
+            size[0] += count
+            orders.append(add_orders(self.user, 1, self.android, items=size[0])[0])
+
+        self.assertQueriesConstant(add_order, lambda: self.get('download_pdf', orders[-1].pk), exactly=6)
+        self.assertQueriesConstant(add_order, lambda: self.post('order_delete_page', orders[-1].pk), exactly=4)
+
+    def test_instrumentation_stats(self):
+        self.client.force_login(User.objects.create_user('staff', password='secret', is_staff=True))
+        reset_caches()
+        with self.queryBudget(exactly=2):
+            self.get('instrumentation_stats')
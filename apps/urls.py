@@ -3,12 +3,18 @@ from django.urls import path
 
 from apps.views import (ProductListView, ProductDetailView, SettingsUpdateView, LogoutView, RegisterCreateView,
                         CustomLoginView, CartListView, CartItemDeleteView, AddressCreateView, AddressUpdateView,
-                        AddToCartView, update_quantity, CheckoutListView, OrderListView, OrderDeleteView,
-                        OrderCreateView, OrderDetailView)
+                        AddToCartView, CartItemsView, CheckoutListView, OrderListView, OrderDeleteView,
+                        OrderCreateView, OrderDetailView, search_autocomplete, FavouriteListView, AddToFavouriteView,
+                        RemoveFromFavoritesView, InvoiceDownloadView, InstrumentationStatsView, CartSummaryView,
+                        CatalogJsonView)
 
 urlpatterns = [
     path('', ProductListView.as_view(), name='product_list_page'),
+    path('category/<slug:category_slug>', ProductListView.as_view(), name='category_product_list_page'),
     path('product/<int:pk>', ProductDetailView.as_view(), name='product_detail_page'),
+    path('search/autocomplete', search_autocomplete, name='search_autocomplete'),
+    path('api/catalog', CatalogJsonView.as_view(), name='catalog_json'),
+    path('api/catalog/<slug:category_slug>', CatalogJsonView.as_view(), name='category_catalog_json'),
     #
     #
     #
@@ -24,11 +30,12 @@ urlpatterns = [
     path('remove-cart/delete/<int:pk>/', CartItemDeleteView.as_view(), name='cart_delete_page'),
     #
     #
-    # path('favorites', FavouriteView.as_view(), name='favorites_page'),
-    # path('add-to-favourite/<int:pk>/', AddToFavouriteView.as_view(), name='add_favourites_page'),
-    # path('remove-favorite/<int:pk>/', RemoveFromFavoritesView.as_view(), name='remove_from_favorites'),
+    path('favorites', FavouriteListView.as_view(), name='favorites_page'),
+    path('add-to-favourite/<int:pk>/', AddToFavouriteView.as_view(), name='add_favourites_page'),
+    path('remove-favorite/<int:pk>/', RemoveFromFavoritesView.as_view(), name='remove_from_favorites'),
     #
-    path('update-quantity/<int:pk>/', update_quantity, name='update_quantity'),
+    path('cart/items', CartItemsView.as_view(), name='cart_items'),
+    path('cart/summary', CartSummaryView.as_view(), name='cart_summary'),
     path('chekout', CheckoutListView.as_view(), name='checkout_page'),
     #
     #
@@ -39,5 +46,8 @@ urlpatterns = [
     path('orders', OrderListView.as_view(), name='order_list_page'),
     path('order-detail/<int:pk>', OrderDetailView.as_view(), name='order_detail_page'),
     path('order-create', OrderCreateView.as_view(), name='order_create_page'),
-    path('order-delete/<int:pk>', OrderDeleteView.as_view(), name='order_delete_page')
+    path('order-delete/<int:pk>', OrderDeleteView.as_view(), name='order_delete_page'),
+    path('order-invoice/<int:pk>', InvoiceDownloadView.as_view(), name='download_pdf'),
+    #
+    path('internal/metrics', InstrumentationStatsView.as_view(), name='instrumentation_stats'),
 ]
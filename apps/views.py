@@ -1,52 +1,111 @@
+import json
+import math
+import os
+
+from asgiref.sync import sync_to_async
+
+from django.conf import settings
 from django.contrib.auth import logout
-from django.contrib.auth.mixins import LoginRequiredMixin
+from django.contrib.auth.mixins import LoginRequiredMixin, UserPassesTestMixin
 from django.contrib.auth.views import LoginView
-from django.db.models import Sum, F
-from django.http import JsonResponse
+from django.core.exceptions import PermissionDenied
+from django.db.models import Case, When
+from django.core.paginator import InvalidPage
+from django.http import JsonResponse, Http404, HttpResponse, FileResponse
 from django.shortcuts import redirect, get_object_or_404
-from django.urls import reverse_lazy
+from django.urls import reverse_lazy, reverse
 from django.views import View
 from django.views.generic import ListView, UpdateView, CreateView, DetailView, DeleteView, TemplateView
 
+from apps.cart import CartError, aget_user_cart_summary, apply_cart_operations, checkout_totals, get_cart_summary
+from apps.cache import get_category_tree, get_category_tree_version, get_category
+from apps.categories import subtree_filter
+from apps.favorites import get_liked_product_ids, mark_liked
+from apps.facets import FACET_PARAM, FACETS_VERSION_KEY, parse_facets, filter_by_facets, get_facet_counts
 from apps.forms import UserRegisterModelForm, OrderCreateModelForm
-from apps.models import Product, Category, CartItem, User, Address, Order, OrderItem, SiteSettings
+from apps.instrumentation import view_stats
+from apps.inventory import checkout_status, mark_in_stock, reserve_cart
+from apps.invoices import get_invoice, invoice_name, invoice_queryset, invoice_storage
+from apps.models import Product, CartItem, User, Address, Order, Favorite
+from apps.orders import CheckoutError
+from apps.pagecache import AnonymousPageCacheMixin, listing_tag, product_tag
+from apps.pagination import CursorPaginator
+from apps.search import search_products, autocomplete
+from apps.tasks import send_to_email
 
 
 class CategoryMixin:
     def get_context_data(self, object_list=None, **kwargs):
         context = super().get_context_data(object_list=object_list, **kwargs)
-        context['categories'] = Category.objects.all()
+        context['category_tree_version'] = get_category_tree_version()
+        context['categories'] = get_category_tree(context['category_tree_version'])
         return context
 
 
-class ProductListView(CategoryMixin, ListView):
-    queryset = Product.objects.order_by('-created_at')
+class ProductListView(AnonymousPageCacheMixin, CategoryMixin, ListView):
+    queryset = Product.objects.for_listing().order_by('-created_at')
     template_name = 'apps/product/product-list.html'
     context_object_name = 'products'
     paginate_by = 2
 
+    def get_category(self):
+        slug = self.kwargs.get('category_slug') or self.request.GET.get('category')
+        if not slug:
+            return None
+        if (category := get_category(slug)) is None:
+            raise Http404('No category found matching the query')
+        return category
+
+    def get_page_cache_tags(self):
+        category = self.get_category()
+        return super().get_page_cache_tags() + [FACETS_VERSION_KEY, listing_tag(category['id'] if category else None)]
+
     def get_queryset(self):
         qs = super().get_queryset()
-        if category_slug := self.request.GET.get('category'):
-            return qs.filter(category__slug=category_slug).all()
+        if settings.STOCK_CACHE_TIMEOUT:
+            qs = qs.defer('quantity')
+        self.category = self.get_category()
+        if self.category is not None:
+            qs = qs.filter(**subtree_filter(self.category))
+        self.selected_facets = parse_facets(self.request.GET.getlist(FACET_PARAM))
+        if self.selected_facets:
+            qs = filter_by_facets(qs, self.selected_facets)
+        if query := self.request.GET.get('q', '').strip():
+            product_ids = search_products(query)
+            qs = qs.filter(pk__in=product_ids).order_by(
+                Case(*(When(pk=pk, then=rank) for rank, pk in enumerate(product_ids)))
+            )
         return qs
 
-    def get_context_data(self, **kwargs):
-        context = super().get_context_data(**kwargs)
-        context['cart_len'] = CartItem.objects.count()
-
+    def get_context_data(self, *, object_list=None, **kwargs):
+        context = super().get_context_data(object_list=object_list, **kwargs)
+        context['category'] = self.category
+        mark_liked(context['products'], get_liked_product_ids(self.request))
+        if settings.STOCK_CACHE_TIMEOUT:
+            mark_in_stock(context['products'])
+        self.last_modified = max((product.updated for product in context['products']), default=None)
+        context['facets'] = [
+            (key, [(value, count, value in self.selected_facets.get(key, ())) for value, count in values])
+            for key, values in get_facet_counts(self.category)
+        ]
+        params = self.request.GET.copy()
+        params.pop('page', None)
+        context['query'] = params.urlencode()
         return context
 
 
-class ProductDetailView(CategoryMixin, DetailView):
-    model = Product
+class ProductDetailView(AnonymousPageCacheMixin, CategoryMixin, DetailView):
+    queryset = Product.objects.for_detail()
     template_name = 'apps/product/product-details.html'
     context_object_name = 'product'
 
+    def get_page_cache_tags(self):
+        return super().get_page_cache_tags() + [product_tag(self.kwargs['pk'])]
+
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        context['cart_len'] = CartItem.objects.count()
-
+        mark_liked([self.object], get_liked_product_ids(self.request))
+        self.last_modified = self.object.updated
         return context
 
 
@@ -56,9 +115,9 @@ class RegisterCreateView(CategoryMixin, CreateView):
     success_url = reverse_lazy('product_list_page')
 
     def form_valid(self, form):
-        form.save()
-        # send_to_email('Your account has been created!', form.data['email'])
-        # send_to_email.delay('Your account has been created!', form.data['email'])
+        user = form.save()
+        send_to_email('Your account has been created!', form.cleaned_data['email'],
+                      dedupe_key=f'account-created:{user.pk}')
         return super().form_valid(form)
 
     def form_invalid(self, form):
@@ -74,12 +133,6 @@ class SettingsUpdateView(CategoryMixin, LoginRequiredMixin, UpdateView):
     def get_object(self, queryset=None):
         return self.request.user
 
-    def get_context_data(self, **kwargs):
-        context = super().get_context_data(**kwargs)
-        context['categories'] = Category.objects.all()
-        context['cart_len'] = CartItem.objects.count()
-        return context
-
 
 class CustomLoginView(CategoryMixin, LoginView):
     template_name = 'apps/auth/login.html'
@@ -96,12 +149,10 @@ class LogoutView(CategoryMixin, View):
 class AddToCartView(CategoryMixin, View):
     def get(self, request, pk, *args, **kwargs):
         product = get_object_or_404(Product, id=pk)
-        cart_item, created = CartItem.objects.get_or_create(user=request.user, product=product)
-
-        if not created:
-            cart_item.quantity += 1
-            cart_item.save()
-
+        try:
+            apply_cart_operations(request.user, [{'op': 'add', 'product': product.pk}])
+        except CartError:
+            pass  # Sold out; the cart page shows what is there.
         return redirect('cart_page')
 
 
@@ -112,43 +163,90 @@ class CartListView(CategoryMixin, ListView):
     success_url = reverse_lazy('cart_page')
 
     def get_queryset(self):
-        return super().get_queryset().filter(user=self.request.user)
+        return super().get_queryset().filter(user=self.request.user).select_related(
+            'product').prefetch_related('product__images')
 
     def get_context_data(self, *, object_list=None, **kwargs):
         context = super().get_context_data(object_list=object_list, **kwargs)
-        context['categories'] = Category.objects.all()
-        context['cart_len'] = CartItem.objects.count()
-        context['total_sum'] = sum(map(lambda i: i.quantity, CartItem.objects.all()))
-
-        qs = self.get_queryset()
-
-        context.update(
-            **qs.aggregate(
-                total_sum=Sum(F('quantity') * F('product__price') * (100 - F('product__discount')) / 100),
-                total_count=Sum(F('quantity'))
-            )
-        )
+        summary = get_cart_summary(self.request)
+        context['total_sum'] = summary.subtotal
+        context['total_count'] = summary.quantity
         return context
 
 
-def update_quantity(request, pk):
-    if request.method == 'POST':
-        product = get_object_or_404(CartItem, pk=pk)
-        new_quantity = int(request.POST.get('quantity', 1))
-        if new_quantity > 0:
-            product.quantity = new_quantity
-            product.save()
-
-            total_sum = CartItem.objects.aggregate(
-                total_sum=Sum(F('quantity') * F('product__price') * (100 - F('product__discount')) / 100)
-            )['total_sum'] or 0
-
-            total_count = CartItem.objects.aggregate(
-                total_count=Sum('quantity')
-            )['total_count'] or 0
-
-            return JsonResponse({'new_quantity': new_quantity, 'total_sum': total_sum, 'total_count': total_count})
-    return JsonResponse({'error': 'Invalid request'}, status=400)
+def cart_summary_json(summary):
+    return {'count': summary.count, 'total_count': summary.quantity, 'total_sum': summary.subtotal}
+
+
+async def authenticated_user(request):
+    """``request.user`` for async views, which cannot use ``LoginRequiredMixin``'s lazy lookup."""
+    user = await request.auser()
+    if not user.is_authenticated:
+        raise PermissionDenied
+    return user
+
+
+class CartItemsView(View):
+    """JSON endpoint applying ``{"operations": [{"op": "add"|"remove"|"set", "product": id, "quantity": n}]}``."""
+
+    async def post(self, request):
+        user = await authenticated_user(request)
+        try:
+            operations = json.loads(request.body)['operations']
+            # The batch runs in one transaction, which the async ORM cannot open.
+            summary = await sync_to_async(apply_cart_operations)(user, operations)
+        except (ValueError, KeyError, TypeError) as e:
+            return JsonResponse({'error': f'Invalid request: {e}'}, status=400)
+        except CartError as e:
+            return JsonResponse({'error': str(e)}, status=400)
+        return JsonResponse(cart_summary_json(summary))
+
+
+class CartSummaryView(View):
+    async def get(self, request):
+        user = await authenticated_user(request)
+        return JsonResponse(cart_summary_json(await aget_user_cart_summary(user)))
+
+
+class CatalogJsonView(View):
+    """Newest products, optionally under ``category_slug``, as JSON pages selected with ``?page=``."""
+    paginate_by = 24
+
+    async def get(self, request, category_slug=None):
+        queryset = Product.objects.order_by('-created_at')
+        if category_slug:
+            if (category := await sync_to_async(get_category)(category_slug)) is None:
+                raise Http404('No category found matching the query')
+            queryset = queryset.filter(**subtree_filter(category))
+        try:
+            page = int(request.GET.get('page', 1))
+        except ValueError:
+            page = 0
+        if page < 1:
+            return JsonResponse({'error': 'Invalid page'}, status=400)
+
+        count = await queryset.acount()
+        offset = (page - 1) * self.paginate_by
+        products = queryset.values('id', 'name', 'price', 'discount', 'quantity')[offset:offset + self.paginate_by]
+        return JsonResponse({
+            'count': count,
+            'page': page,
+            'num_pages': max(1, math.ceil(count / self.paginate_by)),
+            'results': [
+                {**product, 'current_price': product['price'] - product['price'] * product['discount'] // 100,
+                 'url': reverse('product_detail_page', args=(product['id'],))}
+                async for product in products
+            ],
+        })
+
+
+async def search_autocomplete(request):
+    product_ids = await sync_to_async(autocomplete)(request.GET.get('q', ''))
+    names = {pk: name async for pk, name in Product.objects.filter(pk__in=product_ids).values_list('pk', 'name')}
+    return JsonResponse({'results': [
+        {'id': pk, 'name': names[pk], 'url': reverse('product_detail_page', args=(pk,))}
+        for pk in product_ids if pk in names
+    ]})
 
 
 class CartItemDeleteView(CategoryMixin, DeleteView):
@@ -167,12 +265,6 @@ class AddressCreateView(CategoryMixin, CreateView):
         form.instance.user = self.request.user
         return super().form_valid(form)
 
-    def get_context_data(self, **kwargs):
-        context = super().get_context_data(**kwargs)
-        context['cart_len'] = CartItem.objects.count()
-
-        return context
-
 
 class AddressUpdateView(CategoryMixin, UpdateView):
     model = Address
@@ -180,57 +272,74 @@ class AddressUpdateView(CategoryMixin, UpdateView):
     fields = ('city', 'street', 'phone', 'zip_code')
     success_url = reverse_lazy('checkout_page')
 
+
+class CheckoutMixin:
+    def get_cart_items(self):
+        return CartItem.objects.filter(user=self.request.user).select_related('product')
+
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        context['cart_len'] = CartItem.objects.count()
+        context.setdefault('cart_items', self.get_cart_items())
+        context['short_products'], context['reserved_until'] = checkout_status(self.request.user)
+        context.update(checkout_totals(self.get_cart_items()))
+        context['addresses'] = Address.objects.filter(user=self.request.user)
         return context
 
 
-class CheckoutListView(LoginRequiredMixin, CategoryMixin, ListView):
-    queryset = CartItem.objects.all()
+class CheckoutListView(LoginRequiredMixin, CheckoutMixin, CategoryMixin, ListView):
     template_name = 'apps/product/checkout.html'
     context_object_name = 'cart_items'
 
     def get_queryset(self):
-        return super().get_queryset().filter(user=self.request.user)
+        return self.get_cart_items()
 
-    def get_context_data(self, *, object_list=None, **kwargs):
-        context = super().get_context_data(object_list=object_list, **kwargs)
-        qs = self.get_queryset()
-
-        context.update(
-            **qs.aggregate(
-                subtotal=Sum(F('quantity') * F('product__price') * (100 - F('product__discount')) / 100),
-                shipping_cost=Sum(F('product__shipping_cost')),
-                total=Sum(F('product__shipping_cost')) + Sum(
-                    F('quantity') * F('product__price') * (100 - F('product__discount')) / 100)
-            )
-        )
-        context['addresses'] = Address.objects.filter(user=self.request.user)
-        context['cart_len'] = CartItem.objects.count()
-        return context
+    def post(self, request, *args, **kwargs):
+        # Starting checkout holds the cart's stock for STOCK_RESERVATION_TIMEOUT seconds; the page only reads it.
+        reserve_cart(request.user)
+        return redirect('checkout_page')
 
 
 class OrderListView(CategoryMixin, ListView):
-    queryset = Order.objects.order_by('-created_at')
+    queryset = Order.objects.select_related('owner', 'address')
     template_name = 'apps/orders/order-list.html'
     context_object_name = 'orders'
     paginate_by = 10
+    ordering = '-created_at'
+    orderings = 'created_at', '-created_at', 'total', '-total'
 
     def get_queryset(self):
-        if self.request.user.is_staff or self.request.user.is_superuser:
-            return super().get_queryset()
-        return super().get_queryset().filter(owner=self.request.user)
+        qs = super().get_queryset()
+        if not (self.request.user.is_staff or self.request.user.is_superuser):
+            qs = qs.filter(owner=self.request.user)
+        if (status := self.request.GET.get('status')) in Order.Status.values:
+            qs = qs.filter(status=status)
+        return qs
+
+    def get_ordering(self):
+        ordering = self.request.GET.get('ordering')
+        ordering = ordering if ordering in self.orderings else self.ordering
+        # The id tie-breaker runs the same way, so every ordering reads one of the Order indexes forwards or backwards.
+        return ordering, '-id' if ordering.startswith('-') else 'id'
+
+    def paginate_queryset(self, queryset, page_size):
+        paginator = CursorPaginator(queryset, self.get_ordering(), page_size)
+        try:
+            page = paginator.page(after=self.request.GET.get('after'), before=self.request.GET.get('before'))
+        except InvalidPage as e:
+            raise Http404(str(e))
+        return paginator, page, page.object_list, page.has_other_pages()
 
     def get_context_data(self, *, object_list=None, **kwargs):
         context = super().get_context_data(object_list=object_list, **kwargs)
-        context['tax'] = SiteSettings.objects.first().tax
-        context['cart_len'] = CartItem.objects.count()
+        params = self.request.GET.copy()
+        params.pop('after', None)
+        params.pop('before', None)
+        context['query'] = params.urlencode()
         return context
 
 
 class OrderDetailView(LoginRequiredMixin, CategoryMixin, DetailView):
-    model = Order
+    queryset = Order.objects.select_related('owner', 'address', 'creditcard').prefetch_related('order_items__product')
     template_name = 'apps/orders/order-details.html'
     context_object_name = 'order'
 
@@ -239,19 +348,29 @@ class OrderDetailView(LoginRequiredMixin, CategoryMixin, DetailView):
             return super().get_queryset()
         return super().get_queryset().filter(owner=self.request.user)
 
-    def get_context_data(self, *, object_list=None, **kwargs):
-        context = super().get_context_data(object_list=object_list, **kwargs)
-        qs = OrderItem.objects.filter(order_id=context['order'].id)
 
-        context.update(
-            **qs.aggregate(
-                subtotal=Sum(F('quantity') * (F('product__price') * (
-                        100 - F('product__discount')) / 100)),
-                shipping_cost=Sum(F('product__shipping_cost'))
-            )
-        )
-        context['tax'] = SiteSettings.objects.first().tax
-        return context
+class InvoiceDownloadView(LoginRequiredMixin, View):
+    def get(self, request, pk):
+        orders = Order.objects.all()
+        if not (request.user.is_staff or request.user.is_superuser):
+            orders = orders.filter(owner=request.user)
+        order = get_object_or_404(orders, pk=pk)
+        storage = invoice_storage()
+        if not storage.exists(invoice_name(order)):
+            # The worker has not made it yet; render it here with the items loaded in one go.
+            order = invoice_queryset().get(pk=order.pk)
+        name = get_invoice(order, storage)
+
+        filename = f'invoice-{order.pk}.pdf'
+        if settings.INVOICE_X_ACCEL_PREFIX:
+            response = HttpResponse(content_type='application/pdf')
+            response['X-Accel-Redirect'] = settings.INVOICE_X_ACCEL_PREFIX + name
+            response['Content-Disposition'] = f'attachment; filename="{filename}"'
+        else:
+            response = FileResponse(storage.open(name, 'rb'), as_attachment=True, filename=filename,
+                                    content_type='application/pdf')
+        response['Cache-Control'] = 'private, no-cache'
+        return response
 
 
 class OrderDeleteView(DeleteView):
@@ -259,7 +378,7 @@ class OrderDeleteView(DeleteView):
     success_url = reverse_lazy('order_list_page')
 
 
-class OrderCreateView(LoginRequiredMixin, CategoryMixin, CreateView):
+class OrderCreateView(LoginRequiredMixin, CheckoutMixin, CategoryMixin, CreateView):
     model = Order
     template_name = 'apps/product/checkout.html'
     form_class = OrderCreateModelForm
@@ -267,51 +386,45 @@ class OrderCreateView(LoginRequiredMixin, CategoryMixin, CreateView):
 
     def form_valid(self, form):
         form.instance.owner = self.request.user
-        return super().form_valid(form)
+        try:
+            return super().form_valid(form)
+        except CheckoutError as e:
+            form.add_error(None, str(e))
+            return self.form_invalid(form)
 
-    def form_invalid(self, form):
-        return super().form_invalid(form)
 
-# class FavouriteView(View):
-#     template_name = 'apps/product/favourite.html'
-#
-#     def get(self, request, *args, **kwargs):
-#         favourite_items = Favorite.objects.filter(user=request.user)
-#         for item in favourite_items:
-#             item.total_price = item.product.current_price
-#
-#         context = {
-#             'favourite_items': favourite_items,
-#         }
-#         return render(request, self.template_name, context)
-#
-#
-# class AddToFavouriteView(View):
-#     def get(self, request, pk):
-#         product = get_object_or_404(Product, id=pk)
-#         favorite, created = Favorite.objects.get_or_create(user=request.user, product=product)
-#
-#         if not created:
-#             product.is_favorited_by_user = True
-#             product.save()
-#         return redirect('favorites_page')
-#
-#
-# # class RemoveFromFavoritesView(LoginRequiredMixin, View):
-# #
-# #     def get(self, request, *args, **kwargs):
-# #         item_id = self.request.GET.get('item_id')
-# #         if item_id:
-# #             try:
-# #                 cart_item = Favorite.objects.get(id=item_id, user=request.user)
-# #                 cart_item.delete()
-# #             except Favorite.DoesNotExist:
-# #                 pass
-# #         return redirect('favorites_page')
-#
-# class RemoveFromFavoritesView(LoginRequiredMixin, DeleteView):
-#     queryset = Favorite.objects.all()
-#     success_url = reverse_lazy('favorites_page')
-#
-#     def get_queryset(self):
-#         return super().get_queryset().filter(user=self.request.user)
+class FavouriteListView(LoginRequiredMixin, CategoryMixin, ListView):
+    template_name = 'apps/product/favourites.html'
+    context_object_name = 'favourite_items'
+
+    def get_queryset(self):
+        return Favorite.objects.filter(user=self.request.user).select_related(
+            'product__category').prefetch_related('product__images').order_by('-id')
+
+
+class AddToFavouriteView(LoginRequiredMixin, View):
+    def get(self, request, pk):
+        product = get_object_or_404(Product, id=pk)
+        Favorite.objects.get_or_create(user=request.user, product=product, defaults={'quantity': 1, 'is_like': True})
+        return redirect('favorites_page')
+
+
+class RemoveFromFavoritesView(LoginRequiredMixin, View):
+    def post(self, request, pk):
+        Favorite.objects.filter(user=request.user, product_id=pk).delete()
+        return redirect('favorites_page')
+
+
+class InstrumentationStatsView(LoginRequiredMixin, UserPassesTestMixin, View):
+    """Latency and query percentiles per view for this process, for staff only."""
+    raise_exception = True
+
+    def test_func(self):
+        return self.request.user.is_staff
+
+    def get(self, request):
+        return JsonResponse({'pid': os.getpid(), 'views': view_stats.summary()})
+
+    def delete(self, request):
+        view_stats.clear()
+        return JsonResponse({'pid': os.getpid(), 'views': {}})